@@ -0,0 +1,46 @@
+#Compare the factorizations of the conv blocks. Run from the repo root with python -m benchmarks.conv_block
+import argparse
+import torch
+from benchmarks import fixtures
+from benchmarks import measure
+from pytorch_lightning import seed_everything
+from src.models import Hang2020
+
+BLOCKS = ["dense", "separable", "spectral"]
+NETWORKS = {"vanilla_CNN": Hang2020.vanilla_CNN, "Hang2020": Hang2020.Hang2020}
+
+def run(bands=369, classes=10, image_size=11, batch_size=256, epochs=10):
+    """Parameters, FLOPs and cpu latency at full band depth and accuracy on the bundled fixtures for each network and conv block
+    Returns:
+        results: list of (network, block, parameters, MFLOPs per crop, latency ms per batch, fixture accuracy)
+    """
+    dm = fixtures.fixture_data_module()
+    inputs = torch.randn(batch_size, bands, image_size, image_size)
+    results = []
+    for name, network in NETWORKS.items():
+        for block in BLOCKS:
+            seed_everything(0)
+            model = network(bands=bands, classes=classes, block=block)
+            parameters = measure.count_parameters(model)
+            flops = measure.count_flops(model, inputs[:1])
+            latency = measure.latency(model, inputs)
+            
+            #The fixtures are RGB crops
+            fixture_model = network(bands=dm.config["bands"], classes=dm.num_classes, block=block)
+            m, accuracy = fixtures.fit_and_score(fixture_model, dm, epochs=epochs)
+            results.append((name, block, parameters, flops / 1e6, latency, accuracy))
+    
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Conv block benchmark")
+    parser.add_argument("--bands", type=int, default=369)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--epochs", type=int, default=10)
+    args, unknown = parser.parse_known_args()
+    
+    results = run(bands=args.bands, batch_size=args.batch_size, epochs=args.epochs)
+    print("{} bands, batch of {}, {} torch threads. Accuracy is on the bundled RGB fixtures after {} epochs".format(args.bands, args.batch_size, torch.get_num_threads(), args.epochs))
+    print("{:>12} {:>10} {:>12} {:>10} {:>12} {:>10}".format("network", "block", "parameters", "MFLOPs", "latency ms", "accuracy"))
+    for name, block, parameters, mflops, latency, accuracy in results:
+        print("{:>12} {:>10} {:>12} {:>10.1f} {:>12.1f} {:>10.3f}".format(name, block, parameters, mflops, latency, accuracy))
@@ -0,0 +1,48 @@
+#Benchmark the distilled spectral student against Hang2020. Run from the repo root with python -m benchmarks.distillation
+import argparse
+import torch
+from benchmarks import fixtures
+from benchmarks import measure
+from src.models import Hang2020
+from src.models import distill
+
+def speed(bands=369, classes=10, image_size=11, pixels=4096):
+    """Pixels per second of the teacher, which needs a patch around each pixel, and of the student on single pixel spectra
+    Returns:
+        results: list of (model, pixels per second, speedup)
+    """
+    teacher = Hang2020.Hang2020(bands=bands, classes=classes)
+    student = distill.spectral_student(bands=bands, classes=classes)
+    teacher_latency = measure.latency(teacher, torch.randn(pixels // 16, bands, image_size, image_size), repeat=5) * 16
+    student.eval()
+    spectra = torch.randn(pixels, bands)
+    with torch.no_grad():
+        student.forward_spectra(spectra)
+        student_latency = measure.best_time(lambda: student.forward_spectra(spectra), repeat=20) * 1000
+    
+    return [("Hang2020", pixels / teacher_latency * 1000, 1.0), ("spectral_student", pixels / student_latency * 1000, teacher_latency / student_latency)]
+
+def accuracy(epochs=10):
+    """Validation accuracy of a teacher trained on the bundled fixtures and of a student distilled from it"""
+    dm = fixtures.fixture_data_module()
+    teacher = Hang2020.Hang2020(bands=dm.config["bands"], classes=dm.num_classes)
+    teacher_m, teacher_accuracy = fixtures.fit_and_score(teacher, dm, epochs=epochs)
+    student = distill.spectral_student(bands=dm.config["bands"], classes=dm.num_classes, neighbourhood=dm.config["student_neighbourhood"])
+    student_m, student_accuracy = fixtures.fit_and_score(student, dm, epochs=epochs, module=distill.DistillationModel, teacher=teacher_m)
+    
+    return teacher_accuracy, student_accuracy
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Distillation benchmark")
+    parser.add_argument("--bands", type=int, default=369)
+    parser.add_argument("--pixels", type=int, default=4096)
+    parser.add_argument("--epochs", type=int, default=10)
+    args, unknown = parser.parse_known_args()
+    
+    print("{} bands, {} pixels, {} torch threads".format(args.bands, args.pixels, torch.get_num_threads()))
+    print("{:>16} {:>12} {:>8}".format("model", "pixels/s", "speedup"))
+    for name, rate, speedup in speed(bands=args.bands, pixels=args.pixels):
+        print("{:>16} {:>12.1f} {:>8.1f}".format(name, rate, speedup))
+    
+    teacher_accuracy, student_accuracy = accuracy(epochs=args.epochs)
+    print("Bundled fixtures after {} epochs: teacher accuracy {:.3f}, student accuracy {:.3f}, gap {:.3f}".format(args.epochs, teacher_accuracy, student_accuracy, teacher_accuracy - student_accuracy))
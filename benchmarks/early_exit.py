@@ -0,0 +1,63 @@
+#Benchmark early exit prediction. Run from the repo root with python -m benchmarks.early_exit
+import argparse
+import torch
+from benchmarks import fixtures
+from benchmarks import measure
+from src import early_exit
+from src.models import Hang2020
+
+EXITS = {0:[0, 0], 1:[1.01, 0], 2:[1.01, 1.01]}
+
+def stage_latency(bands=369, classes=10, image_size=11, batch_size=256):
+    """Latency of a batch when every crown exits at the same attention layer, at full band depth
+    Returns:
+        results: dict of exit layer -> latency ms per batch
+    """
+    model = Hang2020.Hang2020(bands=bands, classes=classes)
+    model.eval()
+    inputs = torch.randn(batch_size, bands, image_size, image_size)
+    results = {}
+    with torch.no_grad():
+        for stage, thresholds in EXITS.items():
+            model.forward_early_exit(inputs, thresholds)
+            results[stage] = measure.best_time(lambda: model.forward_early_exit(inputs, thresholds), repeat=10) * 1000
+    
+    return results
+
+def tradeoff(max_accuracy_drops=(0, 0.01, 0.02, 0.05), epochs=10):
+    """Train with deep supervision on the bundled fixtures, calibrate on the training crops and report on the validation crops for each tolerated accuracy drop"""
+    dm = fixtures.fixture_data_module()
+    model = Hang2020.Hang2020(bands=dm.config["bands"], classes=dm.num_classes, deep_supervision=True)
+    m, accuracy = fixtures.fit_and_score(model, dm, epochs=epochs)
+    results = []
+    for max_accuracy_drop in max_accuracy_drops:
+        thresholds = early_exit.calibrate(m.model, dm.train_dataloader(), max_accuracy_drop=max_accuracy_drop)
+        results.append((max_accuracy_drop, thresholds, early_exit.report(m.model, dm.val_dataloader(), thresholds)))
+    
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Early exit benchmark")
+    parser.add_argument("--bands", type=int, default=369)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--epochs", type=int, default=10)
+    args, unknown = parser.parse_known_args()
+    
+    latency = stage_latency(bands=args.bands, batch_size=args.batch_size)
+    print("{} bands, batch of {}, {} torch threads".format(args.bands, args.batch_size, torch.get_num_threads()))
+    for stage in latency:
+        print("All crowns exit at layer {}: {:.1f} ms, {:.2f} of the full network".format(stage, latency[stage], latency[stage] / latency[2]))
+    
+    print("Bundled fixtures after {} epochs with deep supervision".format(args.epochs))
+    print("{:>9} {:>14} {:>18} {:>9} {:>11} {:>8} {:>13}".format("max drop", "thresholds", "exit distribution", "accuracy", "early exit", "speedup", "expected cost"))
+    for max_accuracy_drop, thresholds, results in tradeoff(epochs=args.epochs):
+        distribution = results["exit_distribution"]
+        expected_cost = sum([distribution[stage] * latency[stage] for stage in distribution]) / latency[2]
+        print("{:>9} {:>14} {:>18} {:>9.3f} {:>11.3f} {:>8.2f} {:>13.2f}".format(
+            max_accuracy_drop,
+            "/".join(["{:.2f}".format(x) for x in thresholds]),
+            "/".join(["{:.2f}".format(distribution[stage]) for stage in distribution]),
+            results["accuracy"],
+            results["early_exit_accuracy"],
+            results["speedup"],
+            expected_cost))
@@ -0,0 +1,58 @@
+#Fit and score models on the crops bundled in tests/data so that architectures can be compared without NEON data
+import os
+import numpy as np
+import tempfile
+from pytorch_lightning import Trainer, seed_everything
+from src import data
+from src import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def fixture_config():
+    """The test configuration, see tests/test_main.py"""
+    config = data.read_config(config_path="{}/config.yml".format(ROOT))
+    config["min_CHM_height"] = None
+    config["iterations"] = 1
+    config["rgb_sensor_pool"] = "{}/tests/data/*.tif".format(ROOT)
+    config["HSI_sensor_pool"] = "{}/tests/data/*.tif".format(ROOT)
+    config["min_samples"] = 1
+    config["crop_dir"] = tempfile.gettempdir()
+    config["bands"] = 3
+    config["classes"] = 2
+    config["top_k"] = 1
+    config["convert_h5"] = False
+    config["workers"] = 0
+    config["gpus"] = 0
+
+    return config
+
+def fixture_data_module(config=None):
+    """Data module of the bundled sample plots"""
+    if config is None:
+        config = fixture_config()
+    dm = data.TreeData(config=config, csv_file="{}/tests/data/sample_neon.csv".format(ROOT), regenerate=False, data_dir="{}/tests/data".format(ROOT))
+    dm.setup()
+
+    return dm
+
+def fit_and_score(model, dm, epochs=10, seed=0, module=main.TreeModel, **kwargs):
+    """Train a network on the fixture data module and return the validation accuracy
+    Args:
+        model: a torch module
+        dm: see fixture_data_module
+        epochs: training epochs
+        seed: random seed, architectures are compared with the same seed
+        module: LightningModule used for training
+        **kwargs: passed to module
+    Returns:
+        m: the trained module
+        accuracy: micro accuracy on the validation crops
+    """
+    seed_everything(seed)
+    m = module(model=model, classes=dm.num_classes, label_dict=dm.species_label_dict, config=dm.config, **kwargs)
+    trainer = Trainer(max_epochs=epochs, gpus=0, checkpoint_callback=False, logger=False, progress_bar_refresh_rate=0, weights_summary=None)
+    trainer.fit(m, datamodule=dm)
+    results = m.predict_dataloader(dm.val_dataloader())
+    accuracy = np.mean(results.pred_label.values == results.label.values)
+
+    return m, accuracy
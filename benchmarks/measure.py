@@ -0,0 +1,70 @@
+#Model size, compute and latency measurements shared by the benchmarks
+import time
+import torch
+from torch import nn
+
+def best_time(fn, repeat=3):
+    """Fastest wall clock time of repeated calls in seconds"""
+    times = []
+    for x in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def count_parameters(model):
+    """Number of parameters of a torch module"""
+    return sum([x.numel() for x in model.parameters()])
+
+def count_flops(model, inputs):
+    """Count the floating point operations of the convolution and linear layers for a single forward pass, a multiply-add is two operations
+    Args:
+        model: a torch module
+        inputs: a batch of input tensors, or a tuple of positional inputs
+    Returns:
+        flops: operations per sample
+    """
+    if not isinstance(inputs, tuple):
+        inputs = (inputs,)
+    counts = []
+
+    def conv_hook(module, input, output):
+        kernel = module.in_channels // module.groups
+        for size in module.kernel_size:
+            kernel = kernel * size
+        counts.append(2 * output.numel() * kernel)
+
+    def linear_hook(module, input, output):
+        counts.append(2 * output.numel() * module.in_features)
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, (nn.Conv1d, nn.Conv2d)):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+
+    model.eval()
+    with torch.no_grad():
+        model(*inputs)
+    for handle in handles:
+        handle.remove()
+
+    return sum(counts) / inputs[0].shape[0]
+
+def latency(model, inputs, repeat=20, warmup=3):
+    """Best cpu latency of a forward pass in milliseconds
+    Args:
+        model: a torch module
+        inputs: a batch of input tensors, or a tuple of positional inputs
+    """
+    if not isinstance(inputs, tuple):
+        inputs = (inputs,)
+    model.eval()
+    with torch.no_grad():
+        for x in range(warmup):
+            model(*inputs)
+        seconds = best_time(lambda: model(*inputs), repeat=repeat)
+
+    return seconds * 1000
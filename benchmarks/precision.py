@@ -0,0 +1,74 @@
+#Compare cpu training and prediction throughput of float32 and channels last, and bf16 autocast if the installed torch supports it. Run from the repo root with python -m benchmarks.precision
+import argparse
+import time
+import torch
+from benchmarks import measure
+from benchmarks import synthetic
+from pytorch_lightning import seed_everything
+from src import main
+from src.models import Hang2020
+
+MODES = [(32, False), (32, True)]
+if main.BF16_SUPPORTED:
+    MODES = MODES + [("bf16", False), ("bf16", True)]
+
+def batches(n, batch_size, bands, image_size, classes, channels_last):
+    """Random training batches in the TreeDataset format"""
+    samples = []
+    for x in range(n):
+        inputs = {"HSI":torch.randn(batch_size, bands, image_size, image_size)}
+        if channels_last:
+            inputs["HSI"] = inputs["HSI"].contiguous(memory_format=torch.channels_last)
+        samples.append((None, inputs, torch.randint(0, classes, (batch_size,))))
+    
+    return samples
+
+def run(bands=369, classes=10, image_size=11, batch_size=64, steps=10):
+    """Training and prediction crops per second for each precision and memory format
+    Returns:
+        results: list of (precision, channels_last, train crops/s, predict crops/s)
+    """
+    config = synthetic.benchmark_config(savedir=None, bands=bands)
+    results = []
+    for precision, channels_last in MODES:
+        config["precision"] = precision
+        config["channels_last"] = channels_last
+        seed_everything(0)
+        m = synthetic.build_model(config, classes=classes, model=Hang2020.Hang2020(bands=bands, classes=classes))
+        train_batches = batches(steps, batch_size, bands, image_size, classes, channels_last)
+        
+        #Training steps
+        m.train()
+        optimizer = torch.optim.Adam(m.model.parameters(), lr=config["lr"])
+        m.training_step(train_batches[0], 0).backward()
+        start = time.perf_counter()
+        for index, batch in enumerate(train_batches):
+            optimizer.zero_grad()
+            loss = m.training_step(batch, index)
+            loss.backward()
+            optimizer.step()
+        train_rate = steps * batch_size / (time.perf_counter() - start)
+        
+        #Prediction
+        m.eval()
+        inputs = train_batches[0][1]
+        with torch.no_grad():
+            m.predict(inputs)
+            seconds = measure.best_time(lambda: m.predict(inputs), repeat=steps)
+        predict_rate = batch_size / seconds
+        results.append((precision, channels_last, train_rate, predict_rate))
+    
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Precision and memory format benchmark")
+    parser.add_argument("--bands", type=int, default=369)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=10)
+    args, unknown = parser.parse_known_args()
+    
+    results = run(bands=args.bands, batch_size=args.batch_size, steps=args.steps)
+    print("{} bands, batch of {}, {} torch threads, torch {}".format(args.bands, args.batch_size, torch.get_num_threads(), torch.__version__))
+    print("{:>9} {:>13} {:>14} {:>16}".format("precision", "channels_last", "train crops/s", "predict crops/s"))
+    for precision, channels_last, train_rate, predict_rate in results:
+        print("{:>9} {:>13} {:>14.1f} {:>16.1f}".format(precision, str(channels_last), train_rate, predict_rate))
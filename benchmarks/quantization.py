@@ -0,0 +1,51 @@
+#Benchmark int8 quantization. Run from the repo root with python -m benchmarks.quantization
+import argparse
+import torch
+from benchmarks import fixtures
+from benchmarks import measure
+from src import quantize
+from src.models import Hang2020
+
+def speed(bands=369, classes=10, image_size=11, batch_size=256, calibration_batches=10):
+    """Crown scoring latency of float, dynamic and static int8 Hang2020 at full band depth
+    Returns:
+        results: list of (mode, latency ms per batch, crowns per second, speedup)
+    """
+    model = Hang2020.Hang2020(bands=bands, classes=classes)
+    inputs = torch.randn(batch_size, bands, image_size, image_size)
+    calibration = [(None, {"HSI":torch.randn(batch_size, bands, image_size, image_size)}, None) for x in range(calibration_batches)]
+    
+    results = []
+    baseline = measure.latency(model, inputs)
+    results.append(("float", baseline, batch_size / baseline * 1000, 1.0))
+    for mode in ["dynamic", "static"]:
+        quantized = quantize.quantize_model(model, mode=mode, data_loader=calibration)
+        latency = measure.latency(quantized, inputs)
+        results.append((mode, latency, batch_size / latency * 1000, baseline / latency))
+    
+    return results
+
+def accuracy(epochs=10, calibration_batches=10):
+    """Accuracy delta of static quantization on the bundled fixtures, calibrated on the training crops"""
+    dm = fixtures.fixture_data_module()
+    model = Hang2020.Hang2020(bands=dm.config["bands"], classes=dm.num_classes)
+    m, float_accuracy = fixtures.fit_and_score(model, dm, epochs=epochs)
+    quantized_m = quantize.quantize(m, mode="static", data_loader=dm.train_dataloader(), calibration_batches=calibration_batches)
+    
+    return quantize.report(m, quantized_m, dm.val_dataloader())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Quantization benchmark")
+    parser.add_argument("--bands", type=int, default=369)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--epochs", type=int, default=10)
+    args, unknown = parser.parse_known_args()
+    
+    print("{} bands, batch of {}, {} torch threads, {} engine".format(args.bands, args.batch_size, torch.get_num_threads(), torch.backends.quantized.engine))
+    print("{:>8} {:>12} {:>10} {:>8}".format("mode", "latency ms", "crowns/s", "speedup"))
+    for mode, latency, rate, speedup in speed(bands=args.bands, batch_size=args.batch_size):
+        print("{:>8} {:>12.1f} {:>10.1f} {:>8.2f}".format(mode, latency, rate, speedup))
+    
+    results = accuracy(epochs=args.epochs)
+    print("Bundled fixtures after {} epochs: float accuracy {:.3f}, static int8 accuracy {:.3f}, delta {:.3f}, predict_dataloader speedup {:.2f}".format(
+        args.epochs, results["accuracy"], results["quantized_accuracy"], results["accuracy_delta"], results["speedup"]))
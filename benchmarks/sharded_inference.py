@@ -0,0 +1,52 @@
+#Benchmark sharded cpu inference. Run from the repo root with python -m benchmarks.sharded_inference
+import argparse
+import os
+import tempfile
+import torch
+from benchmarks import measure
+from benchmarks import synthetic
+from src import shard
+
+def run(n_crowns=2000, bands=369, max_workers=None, threads=1, repeat=2):
+    """Time shard.predict_crowns with an increasing number of workers against a single process baseline
+    Returns:
+        results: list of (workers, seconds, crowns per second, speedup, efficiency)
+    """
+    if max_workers is None:
+        max_workers = shard.default_workers(threads)
+    
+    savedir = tempfile.mkdtemp()
+    synthetic.write_HSI_tile(savedir, bands=bands)
+    crowns = synthetic.random_crowns(n_crowns)
+    config = synthetic.benchmark_config(savedir, bands=bands)
+    m = synthetic.build_model(config)
+    model_path = "{}/model.pt".format(savedir)
+    m.save_model(model_path)
+    
+    #Single process baseline with the same thread count as a worker
+    torch.set_num_threads(threads)
+    baseline = measure.best_time(lambda: m.predict_crowns(crowns), repeat=repeat)
+    results = [(0, baseline, n_crowns / baseline, 1.0, 1.0)]
+    
+    workers = 1
+    while workers <= max_workers:
+        seconds = measure.best_time(lambda: shard.predict_crowns(model_path, crowns, workers=workers, threads=threads), repeat=repeat)
+        speedup = baseline / seconds
+        results.append((workers, seconds, n_crowns / seconds, speedup, speedup / workers))
+        workers = workers * 2
+    
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Sharded inference benchmark")
+    parser.add_argument("--n_crowns", type=int, default=2000)
+    parser.add_argument("--bands", type=int, default=369)
+    parser.add_argument("--max_workers", type=int, default=None)
+    parser.add_argument("--threads", type=int, default=1)
+    args, unknown = parser.parse_known_args()
+    
+    results = run(n_crowns=args.n_crowns, bands=args.bands, max_workers=args.max_workers, threads=args.threads)
+    print("{} cores, {} crowns, {} torch threads per worker. Worker timings include process start and model loading".format(os.cpu_count(), args.n_crowns, args.threads))
+    print("{:>8} {:>10} {:>12} {:>8} {:>10}".format("workers", "seconds", "crowns/s", "speedup", "efficiency"))
+    for workers, seconds, rate, speedup, efficiency in results:
+        print("{:>8} {:>10.2f} {:>12.1f} {:>8.2f} {:>10.2f}".format(workers if workers else "baseline", seconds, rate, speedup, efficiency))
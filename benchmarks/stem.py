@@ -0,0 +1,44 @@
+#Compare the Hang2020 stems. Run from the repo root with python -m benchmarks.stem
+import argparse
+import torch
+from benchmarks import fixtures
+from benchmarks import measure
+from pytorch_lightning import seed_everything
+from src.models import Hang2020
+
+STEMS = [None, "shared", "reduce"]
+
+def run(bands=369, classes=10, image_size=11, batch_size=256, epochs=10):
+    """Parameters, FLOPs and cpu latency at full band depth and accuracy on the bundled fixtures for each stem
+    Returns:
+        results: list of (stem, parameters, MFLOPs per crop, latency ms per batch, fixture accuracy)
+    """
+    dm = fixtures.fixture_data_module()
+    inputs = torch.randn(batch_size, bands, image_size, image_size)
+    results = []
+    for stem in STEMS:
+        seed_everything(0)
+        model = Hang2020.Hang2020(bands=bands, classes=classes, stem=stem)
+        parameters = measure.count_parameters(model)
+        flops = measure.count_flops(model, inputs[:1])
+        latency = measure.latency(model, inputs)
+        
+        #The fixtures are RGB crops
+        fixture_model = Hang2020.Hang2020(bands=dm.config["bands"], classes=dm.num_classes, stem=stem)
+        m, accuracy = fixtures.fit_and_score(fixture_model, dm, epochs=epochs)
+        results.append((stem, parameters, flops / 1e6, latency, accuracy))
+    
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Hang2020 stem benchmark")
+    parser.add_argument("--bands", type=int, default=369)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--epochs", type=int, default=10)
+    args, unknown = parser.parse_known_args()
+    
+    results = run(bands=args.bands, batch_size=args.batch_size, epochs=args.epochs)
+    print("{} bands, batch of {}, {} torch threads. Accuracy is on the bundled RGB fixtures after {} epochs".format(args.bands, args.batch_size, torch.get_num_threads(), args.epochs))
+    print("{:>8} {:>12} {:>10} {:>12} {:>10}".format("stem", "parameters", "MFLOPs", "latency ms", "accuracy"))
+    for stem, parameters, mflops, latency, accuracy in results:
+        print("{:>8} {:>12} {:>10.1f} {:>12.1f} {:>10.3f}".format(str(stem), parameters, mflops, latency, accuracy))
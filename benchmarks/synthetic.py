@@ -0,0 +1,64 @@
+#Synthetic sensor tiles, crowns and models shared by the benchmarks. Benchmarks do not need NEON data
+import os
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+from src import data
+from src import main
+from src.models import Hang2020
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def write_HSI_tile(savedir, bands=369, size=200, easting=726000, northing=4699000):
+    """Write a random hyperspectral tile named in the NEON schema
+    Args:
+        savedir: directory to write the tile
+        bands: number of bands
+        size: width and height in 1m pixels
+    Returns:
+        path: path to the tile
+    """
+    path = "{}/NEON_D01_HARV_DP3_{}_{}_reflectance.tif".format(savedir, easting, northing)
+    image = np.random.RandomState(0).randint(0, 10000, size=(bands, size, size)).astype("int16")
+    transform = from_origin(easting, northing + size, 1, 1)
+    with rasterio.open(path, "w", driver="GTiff", height=size, width=size, count=bands, dtype="int16", crs="EPSG:32618", transform=transform) as dst:
+        dst.write(image)
+
+    return path
+
+def random_crowns(n, size=200, easting=726000, northing=4699000, radius=3, seed=0):
+    """Random circular crowns inside a tile, see write_HSI_tile"""
+    random = np.random.RandomState(seed)
+    x = random.uniform(easting + radius, easting + size - radius, n)
+    y = random.uniform(northing + radius, northing + size - radius, n)
+    crowns = gpd.GeoDataFrame({"individual":np.arange(n)}, geometry=[Point(a, b).buffer(radius) for a, b in zip(x, y)], crs="EPSG:32618")
+
+    return crowns
+
+def random_labels(crowns, classes, seed=0):
+    """Labels that depend on location so that a model can be fit to them"""
+    labels = np.floor(crowns.geometry.centroid.x.values) % classes
+
+    return labels.astype(int)
+
+def benchmark_config(savedir, bands=369):
+    """The repo config pointed at synthetic tiles in savedir"""
+    config = data.read_config("{}/config.yml".format(ROOT))
+    config["HSI_sensor_pool"] = "{}/*.tif".format(savedir)
+    config["rgb_sensor_pool"] = "{}/*.tif".format(savedir)
+    config["convert_h5"] = False
+    config["bands"] = bands
+
+    return config
+
+def build_model(config, classes=10, model=None):
+    """A TreeModel with random weights, defaults to Hang2020"""
+    if model is None:
+        model = Hang2020.Hang2020(bands=config["bands"], classes=classes)
+    label_dict = {"taxon_{}".format(x):x for x in range(classes)}
+    m = main.TreeModel(model=model, classes=classes, label_dict=label_dict, config=config)
+    m.eval()
+
+    return m
@@ -0,0 +1,60 @@
+#Distill a trained model into a per pixel spectral student
+import comet_ml
+from src import data
+from src import start_cluster
+from src.main import build_trainer, load_model
+from src.models import distill
+from pytorch_lightning.loggers import CometLogger
+import numpy as np
+
+def main(config_path="config.yml", csv_file="data/raw/neon_vst_data_2021.csv", data_dir=None):
+    """Distill config["teacher_model"] into a spectral student and save it to the data directory. Spawned training and dask worker processes import this file, so it runs only from the main guard
+    Args:
+        config_path: path to config.yml
+        csv_file: raw NEON field data, see data.TreeData
+        data_dir: optional data location, see data.TreeData
+    Returns:
+        m: trained distillation model
+    """
+    #Create datamodule
+    config = data.read_config(config_path)
+    client = start_cluster.start_from_config(config)
+    teacher = load_model(config["teacher_model"])
+    data_module = data.TreeData(csv_file=csv_file, regenerate=False, client=client, config=config, metadata=hasattr(teacher.model, "metadata_model"), data_dir=data_dir)
+    data_module.setup()
+    if client:
+        client.close()
+    data_module.client = None
+    comet_logger = CometLogger(project_name="DeepTreeAttention", workspace=data_module.config["comet_workspace"],auto_output_logging = "simple")
+
+    model = distill.spectral_student(bands=data_module.config["bands"], classes=data_module.num_classes, neighbourhood=data_module.config["student_neighbourhood"])
+    m = distill.DistillationModel(
+        model=model,
+        teacher=teacher,
+        classes=data_module.num_classes,
+        label_dict=data_module.species_label_dict,
+        config=data_module.config)
+    comet_logger.experiment.log_parameters(m.config)
+
+    trainer = build_trainer(data_module.config, logger=comet_logger)
+    trainer.fit(m, datamodule=data_module)
+
+    #Evaluate and save once, other distributed processes stop here
+    if not trainer.is_global_zero:
+        return m
+
+    #Accuracy gap to the teacher
+    student_results = m.predict_dataloader(data_module.val_dataloader())
+    teacher_results = teacher.predict_dataloader(data_module.val_dataloader())
+    student_accuracy = np.mean(student_results.pred_label == student_results.label)
+    teacher_accuracy = np.mean(teacher_results.pred_label == teacher_results.label)
+    comet_logger.experiment.log_metric("student accuracy", student_accuracy)
+    comet_logger.experiment.log_metric("teacher accuracy", teacher_accuracy)
+    comet_logger.experiment.log_metric("accuracy gap", teacher_accuracy - student_accuracy)
+
+    m.save_model("{}/student.pt".format(data_module.data_dir))
+
+    return m
+
+if __name__ == "__main__":
+    main()
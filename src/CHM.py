@@ -1,11 +1,17 @@
 #CHM height module. Given a x,y location and a pool of CHM images, find the matching location and extract the crown level CHM measurement
+from collections import ChainMap
+from distributed import wait
 import glob
+import hashlib
+import os
 import numpy as np 
 from src import neon_paths
 import rasterstats
 import geopandas as gpd
 import pandas as pd
 
+CACHE_COLUMNS = ["individualID", "geometry_hash", "CHM_path", "CHM_mtime_ns", "CHM_height"]
+
 def non_zero_99_quantile(x):
     """Get height quantile of all cells that are no zero"""
     mdata = np.ma.masked_where(x < 0.5, x)
@@ -13,17 +19,67 @@ def non_zero_99_quantile(x):
     percentile = np.nanpercentile(mdata, 99)
     return (percentile)
 
-def postprocess_CHM(df, lookup_pool):
-    """Field measured height must be within min_diff meters of canopy model"""
+def geometry_hash(geom):
+    """Stable hash of a shapely geometry, used to detect moved stems"""
+    return hashlib.md5(geom.wkb).hexdigest()
+
+def read_cache(cache_path):
+    """Read a CHM height cache from csv
+    Args:
+        cache_path: path to csv file, if it does not exist an empty cache is returned
+    Returns:
+        cache: dict of (individualID, geometry_hash, CHM_path, CHM_mtime_ns) -> CHM_height
+    """
+    cache = {}
+    if cache_path is None or not os.path.exists(cache_path):
+        return cache
+    
+    df = pd.read_csv(cache_path)
+    #Caches written before modification times were stored as integer nanoseconds are rebuilt
+    if "CHM_mtime_ns" not in df.columns:
+        return cache
+    for row in df.itertuples(index=False):
+        cache[(row.individualID, row.geometry_hash, row.CHM_path, int(row.CHM_mtime_ns))] = row.CHM_height
+    
+    return cache
+
+def write_cache(cache, cache_path):
+    """Write a CHM height cache to csv, see read_cache"""
+    records = [list(key) + [value] for key, value in cache.items()]
+    df = pd.DataFrame(records, columns=CACHE_COLUMNS)
+    df.to_csv(cache_path, index=False)
+
+def postprocess_CHM(df, lookup_pool, cache=None):
+    """Field measured height must be within min_diff meters of canopy model
+    Args:
+        df: geodataframe of a single plot
+        lookup_pool: list of CHM paths
+        cache: optional dict of (individualID, geometry_hash, CHM_path, CHM_mtime_ns) -> CHM_height, see read_cache. Only misses are extracted from the CHM and the cache is updated in place.
+    """
     #Extract zonal stats
     try:
         CHM_path = neon_paths.find_sensor_path(lookup_pool=lookup_pool, bounds=df.total_bounds)
     except Exception as e:
         raise ValueError("Cannot find CHM path for {} from plot {} in lookup_pool: {}".format(df.total_bounds, df.plotID.unique(),e))
-    draped_boxes = rasterstats.zonal_stats(df.geometry.__geo_interface__,
-                                           CHM_path,
-                                           add_stats={'q99': non_zero_99_quantile})
-    df["CHM_height"] = [x["q99"] for x in draped_boxes]
+    
+    if cache is None:
+        draped_boxes = rasterstats.zonal_stats(df.geometry.__geo_interface__,
+                                               CHM_path,
+                                               add_stats={'q99': non_zero_99_quantile})
+        df["CHM_height"] = [x["q99"] for x in draped_boxes]
+    else:
+        #Integer nanoseconds survive the csv round trip exactly, float seconds may not
+        CHM_mtime_ns = os.stat(CHM_path).st_mtime_ns
+        keys = [(individual, geometry_hash(geom), CHM_path, CHM_mtime_ns) for individual, geom in zip(df.individualID, df.geometry)]
+        misses = [index for index, key in enumerate(keys) if key not in cache]
+        if misses:
+            missing_geoms = df.geometry.iloc[misses]
+            draped_boxes = rasterstats.zonal_stats(missing_geoms.__geo_interface__,
+                                                   CHM_path,
+                                                   add_stats={'q99': non_zero_99_quantile})
+            for index, x in zip(misses, draped_boxes):
+                cache[keys[index]] = x["q99"]
+        df["CHM_height"] = [cache[key] for key in keys]
 
     #if height is null, assign it
     df.height.fillna(df["CHM_height"], inplace=True)
@@ -31,32 +87,78 @@ def postprocess_CHM(df, lookup_pool):
     return df
 
         
-def CHM_height(shp, CHM_pool):
+def plot_CHM(df, lookup_pool, cache=None):
+    """Wrapper for dask, extract CHM heights for one plot and return the new cache entries alongside the result
+    Returns:
+        df: plot with CHM_height, see postprocess_CHM
+        entries: dict of cache entries computed for this plot
+    """
+    if cache is None:
+        return postprocess_CHM(df, lookup_pool=lookup_pool), {}
+    
+    #Writes go to the first mapping, the shared cache is only read
+    entries = ChainMap({}, cache)
+    df = postprocess_CHM(df, lookup_pool=lookup_pool, cache=entries)
+    
+    return df, entries.maps[0]
+    
+def CHM_height(shp, CHM_pool, cache_path=None, client=None):
         """For each plotID extract the heights from LiDAR derived CHM
         Args:
             shp: shapefile of data to filter
-            config: DeepTreeAttention config file dict, parsed, see config.yml
+            CHM_pool: glob to search CHM images
+            cache_path: optional csv of previously extracted heights keyed by individualID, geometry, CHM tile and modification time. Only new or changed records are extracted from the CHM.
+            client: optional dask client
         """    
         filtered_results = []
-        lookup_pool = glob.glob(CHM_pool, recursive=True)        
-        for name, group in shp.groupby("plotID"):
-            try:
-                result = postprocess_CHM(group, lookup_pool=lookup_pool)
-                filtered_results.append(result)
-            except Exception as e:
-                print("plotID {} raised: {}".format(name,e))
-                
+        lookup_pool = neon_paths.sensor_index(glob.glob(CHM_pool, recursive=True))
+        if cache_path is None:
+            cache = None
+        else:
+            cache = read_cache(cache_path)
+        
+        if client:
+            #Send the CHM index and cache to each worker once
+            scattered_pool = client.scatter([lookup_pool], broadcast=True)[0]
+            if cache is None:
+                scattered_cache = None
+            else:
+                scattered_cache = client.scatter([cache], broadcast=True)[0]
+            futures = {}
+            for name, group in shp.groupby("plotID"):
+                futures[name] = client.submit(plot_CHM, group, lookup_pool=scattered_pool, cache=scattered_cache)
+            wait(list(futures.values()))
+            
+            for name, future in futures.items():
+                try:
+                    result, entries = future.result()
+                    filtered_results.append(result)
+                    if cache is not None:
+                        cache.update(entries)
+                except Exception as e:
+                    print("plotID {} raised: {}".format(name,e))
+        else:
+            for name, group in shp.groupby("plotID"):
+                try:
+                    result = postprocess_CHM(group, lookup_pool=lookup_pool, cache=cache)
+                    filtered_results.append(result)
+                except Exception as e:
+                    print("plotID {} raised: {}".format(name,e))
+        
+        if cache_path is not None:
+            write_cache(cache, cache_path)
+            
         filtered_shp = gpd.GeoDataFrame(pd.concat(filtered_results,ignore_index=True))
         
         return filtered_shp
     
-def filter_CHM(shp, CHM_pool, min_CHM_height=1, min_CHM_diff=4):
+def filter_CHM(shp, CHM_pool, min_CHM_height=1, min_CHM_diff=4, cache_path=None, client=None):
     
     if min_CHM_height is None:
         return shp
     
     #extract CHM height
-    shp = CHM_height(shp, CHM_pool)
+    shp = CHM_height(shp, CHM_pool, cache_path=cache_path, client=client)
     
     #Remove NULL CHM_heights
     #shp = shp[~(shp.CHM_height.isnull())]
@@ -66,4 +168,4 @@ def filter_CHM(shp, CHM_pool, min_CHM_height=1, min_CHM_diff=4):
     #remove CHM points under 4m diff  
     shp = shp[(shp.height.isnull()) | (abs(shp.height - shp.CHM_height) < min_CHM_diff)]  
     
-    return shp
\ No newline at end of file
+    return shp
@@ -0,0 +1,95 @@
+#On disk cache of raw DeepForest predictions. Boxes are stored as geoparquet, one file per RGB window, and evicted by size.
+import glob
+import hashlib
+import json
+import os
+import geopandas as gpd
+
+#Hashes of release weights by path, modification time and size, so that each file is read once per process
+_weights_hashes = {}
+
+def release_version(deepforest_model):
+    """Hash of the release weights loaded with use_release, None if the model was not created from a release.
+    Every release is written to the same file name, so the contents rather than the name identify the weights"""
+    state_dict = getattr(deepforest_model, "release_state_dict", None)
+    if state_dict is None:
+        return None
+
+    stat = os.stat(state_dict)
+    lookup = (os.path.abspath(state_dict), stat.st_mtime_ns, stat.st_size)
+    if lookup not in _weights_hashes:
+        weights_hash = hashlib.md5()
+        with open(state_dict, "rb") as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b""):
+                weights_hash.update(chunk)
+        _weights_hashes[lookup] = weights_hash.hexdigest()
+
+    return _weights_hashes[lookup]
+
+def cache_key(rgb_path, bounds, expand, release):
+    """Hash an RGB tile, its modification time, the window bounds, expand size and model release into a cache key"""
+    key = [os.path.abspath(rgb_path), os.path.getmtime(rgb_path), [round(float(x), 3) for x in bounds], expand, release]
+    key = hashlib.md5(json.dumps(key).encode()).hexdigest()
+
+    return key
+
+def read(cache_dir, key):
+    """Read boxes from the cache
+    Args:
+        cache_dir: directory of cached predictions
+        key: see cache_key
+    Returns:
+        hit: whether the key was found
+        boxes: geodataframe of boxes, None if the key was not found or the window had no predictions
+    """
+    path = "{}/{}.parquet".format(cache_dir, key)
+    empty_path = "{}/{}.empty".format(cache_dir, key)
+    if os.path.exists(path):
+        #Mark as recently used for eviction
+        os.utime(path)
+        return True, gpd.read_parquet(path)
+    elif os.path.exists(empty_path):
+        os.utime(empty_path)
+        return True, None
+    else:
+        return False, None
+
+def write(cache_dir, key, boxes):
+    """Write boxes to the cache. The cache is not evicted here, see evict
+    Args:
+        cache_dir: directory of cached predictions
+        key: see cache_key
+        boxes: geodataframe of boxes or None if the window had no predictions
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    if boxes is None:
+        open("{}/{}.empty".format(cache_dir, key), "w").close()
+    else:
+        #Write to a temporary file first so that concurrent workers never read a partial file
+        path = "{}/{}.parquet".format(cache_dir, key)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        boxes.to_parquet(tmp_path)
+        os.replace(tmp_path, path)
+
+def evict(cache_dir, max_size):
+    """Remove least recently used entries until the cache is under max_size GB. Called once per run by the driver, see generate.points_to_crowns"""
+    files = glob.glob("{}/*.parquet".format(cache_dir)) + glob.glob("{}/*.empty".format(cache_dir))
+    entries = []
+    for path in files:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    total_size = sum([x[1] for x in entries])
+    max_bytes = max_size * 1e9
+    for mtime, size, path in entries:
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size = total_size - size
@@ -1,10 +1,10 @@
 #Ligthning data module
 import argparse
 from . import __file__
-from distributed import as_completed
 import glob
 import geopandas as gpd
 import json
+import math
 import numpy as np
 import os
 import pandas as pd
@@ -17,6 +17,7 @@ from src import augmentation
 from shapely.geometry import Point
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 import yaml
 import warnings
@@ -85,15 +86,16 @@ def filter_data(path, config):
 
     return shp
 
-def sample_plots(shp, test_fraction=0.1, min_samples=5):
+def sample_plots(shp, test_fraction=0.1, min_samples=5, seed=None):
     """Sample and split a pandas dataframe based on plotID
     Args:
         shp: pandas dataframe of filtered tree locations
         test_fraction: proportion of plots in test datasets
         min_samples: minimum number of samples per class
+        seed: optional random seed of the plot sample, so that the split does not depend on the process it runs in
     """
     #split by plot level
-    test_plots = shp.plotID.drop_duplicates().sample(frac=test_fraction)
+    test_plots = shp.plotID.drop_duplicates().sample(frac=test_fraction, random_state=seed)
     
     #in case of debug, there may be not enough plots to sample, grab the first for testing
     if test_plots.empty:
@@ -118,16 +120,20 @@ def train_test_split(shp, savedir, config, client = None):
     Returns:
         None: train.shp and test.shp are written as side effect
         """    
-    #set seed.
+    #set seed. Each iteration gets its own seed so that dask workers draw the same splits as a serial run
     np.random.seed(1)
+    seeds = np.random.randint(0, 2**31 - 1, size=config["iterations"])
     most_species = 0
     if client:
         futures = [ ]
-        for x in np.arange(config["iterations"]):
-            future = client.submit(sample_plots, shp=shp, min_samples=config["min_samples"], test_fraction=config["test_fraction"])
+        #Send the data to the workers once instead of once per iteration
+        shp_future = client.scatter(shp, broadcast=True)
+        for seed in seeds:
+            future = client.submit(sample_plots, shp=shp_future, min_samples=config["min_samples"], test_fraction=config["test_fraction"], seed=int(seed), pure=False)
             futures.append(future)
         
-        for x in as_completed(futures):
+        #Read results in iteration order, ties go to the earliest iteration as in a serial run
+        for x in futures:
             train, test = x.result()
             if len(train.taxonID.unique()) > most_species:
                 print(len(train.taxonID.unique()))
@@ -135,8 +141,8 @@ def train_test_split(shp, savedir, config, client = None):
                 saved_test = test
                 most_species = len(train.taxonID.unique())            
     else:
-        for x in np.arange(config["iterations"]):
-            train, test = sample_plots(shp, min_samples=config["min_samples"], test_fraction=config["test_fraction"])
+        for seed in seeds:
+            train, test = sample_plots(shp, min_samples=config["min_samples"], test_fraction=config["test_fraction"], seed=int(seed))
             if len(train.taxonID.unique()) > most_species:
                 print(len(train.taxonID.unique()))
                 saved_train = train
@@ -215,6 +221,53 @@ def load_image(img_path, image_size):
     
     return image
 
+def channels_last_collate(batch):
+    """Collate a TreeDataset batch and convert the images to channels last memory format, see config["channels_last"]"""
+    batch = torch.utils.data.dataloader.default_collate(batch)
+    inputs = batch[1]
+    if "HSI" in inputs:
+        inputs["HSI"] = inputs["HSI"].contiguous(memory_format=torch.channels_last)
+    
+    return batch
+
+def collate_fn(config):
+    """Collate function of the data loaders for the memory format in the config"""
+    if config["channels_last"]:
+        return channels_last_collate
+    else:
+        return None
+
+class DistributedWeightedSampler(DistributedSampler):
+    """Weighted sampling with replacement for distributed training. All processes draw the same seeded sample and each keeps every num_replicas-th index
+    Args:
+        dataset: dataset to sample
+        weights: sampling weight of each item in dataset
+        num_samples: total number of samples per epoch across processes, defaults to the length of dataset
+        num_replicas: number of processes, defaults to the world size of the process group
+        rank: rank of this process, defaults to the rank in the process group
+        seed: random seed shared by all processes
+    """
+    def __init__(self, dataset, weights, num_samples=None, num_replicas=None, rank=None, seed=0):
+        super(DistributedWeightedSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        self.weights = torch.as_tensor(weights, dtype=torch.double)
+        if num_samples is None:
+            num_samples = len(dataset)
+        self.num_samples = math.ceil(num_samples / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+        
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.multinomial(self.weights, self.total_size, replacement=True, generator=generator).tolist()
+        
+        #Subsample for this process
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        
+        return iter(indices)
+    
+    def __len__(self):
+        return self.num_samples
+
 #Dataset class
 class TreeDataset(Dataset):
     """A csv file with a path to image crop and label
@@ -320,9 +373,9 @@ class TreeData(LightningDataModule):
             #df = df[df.siteID=="HARV"]
             
             #Filter points based on LiDAR height
-            df = CHM.filter_CHM(df, CHM_pool=self.config["CHM_pool"],min_CHM_diff=self.config["min_CHM_diff"], min_CHM_height=self.config["min_CHM_height"])      
+            df = CHM.filter_CHM(df, CHM_pool=self.config["CHM_pool"],min_CHM_diff=self.config["min_CHM_diff"], min_CHM_height=self.config["min_CHM_height"], cache_path=self.config["CHM_cache"], client=self.client)      
             df = df.groupby("taxonID").filter(lambda x: x.shape[0] > self.config["min_samples"])
-            train, test = train_test_split(df,savedir="{}/processed".format(self.data_dir),config=self.config, client=None)   
+            train, test = train_test_split(df,savedir="{}/processed".format(self.data_dir),config=self.config, client=self.client)   
             
             test.to_file("{}/processed/test_points.shp".format(self.data_dir))
             train.to_file("{}/processed/train_points.shp".format(self.data_dir))
@@ -351,7 +404,10 @@ class TreeData(LightningDataModule):
                 rgb_dir=self.config["rgb_sensor_pool"],
                 savedir=None,
                 raw_box_savedir=None, 
-                client=self.client
+                client=self.client,
+                batch_size=self.config["deepforest_batch_size"],
+                cache_dir=self.config["deepforest_cache_dir"],
+                cache_size=self.config["deepforest_cache_size"]
             )
             
             train_crowns.to_file("{}/processed/train_crowns.shp".format(self.data_dir))
@@ -365,7 +421,8 @@ class TreeData(LightningDataModule):
                 convert_h5=self.config["convert_h5"],   
                 rgb_glob=self.config["rgb_sensor_pool"],
                 HSI_tif_dir=self.config["HSI_tif_dir"],
-                client=self.client
+                client=self.client,
+                chunk_size=self.config["crop_chunk_size"]
             )            
                         
             test_crowns = generate.points_to_crowns(
@@ -373,7 +430,10 @@ class TreeData(LightningDataModule):
                 rgb_dir=self.config["rgb_sensor_pool"],
                 savedir=None,
                 raw_box_savedir=None, 
-                client=self.client
+                client=self.client,
+                batch_size=self.config["deepforest_batch_size"],
+                cache_dir=self.config["deepforest_cache_dir"],
+                cache_size=self.config["deepforest_cache_size"]
             )
             test_crowns.to_file("{}/processed/test_crowns.shp".format(self.data_dir))
             
@@ -386,7 +446,8 @@ class TreeData(LightningDataModule):
                 rgb_glob=self.config["rgb_sensor_pool"],                
                 client=self.client,
                 HSI_tif_dir=self.config["HSI_tif_dir"],                
-                convert_h5=self.config["convert_h5"]
+                convert_h5=self.config["convert_h5"],
+                chunk_size=self.config["crop_chunk_size"]
             )  
             
             #Make sure no species were lost during generate
@@ -447,12 +508,17 @@ class TreeData(LightningDataModule):
             image_weight = class_weights[label]
             data_weights.append(1/image_weight)
             
-        sampler = torch.utils.data.sampler.WeightedRandomSampler(weights = data_weights, num_samples=len(ds))
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            #Lightning would replace a plain weighted sampler with an unweighted DistributedSampler
+            sampler = DistributedWeightedSampler(ds, weights=data_weights, num_samples=len(ds))
+        else:
+            sampler = torch.utils.data.sampler.WeightedRandomSampler(weights = data_weights, num_samples=len(ds))
         data_loader = torch.utils.data.DataLoader(
             ds,
             batch_size=self.config["batch_size"],
             num_workers=self.config["workers"],
-            sampler=sampler
+            sampler=sampler,
+            collate_fn=collate_fn(self.config)
         )
         
         return data_loader
@@ -464,6 +530,7 @@ class TreeData(LightningDataModule):
             batch_size=self.config["batch_size"],
             shuffle=False,
             num_workers=self.config["workers"],
+            collate_fn=collate_fn(self.config)
         )
         
         return data_loader
@@ -0,0 +1,107 @@
+#Early exit prediction for Hang2020. Crowns that the intermediate attention heads classify with high confidence skip the later layers
+import time
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+def can_exit_early(model):
+    """Whether a network supports forward_early_exit with trained intermediate heads. Requires a Hang2020 network trained with deep_supervision whose
+    spectral and spatial networks have not been converted to graph modules, for example by quantization"""
+    if not hasattr(model, "forward_early_exit") or not getattr(model, "deep_supervision", False):
+        return False
+    
+    return all([hasattr(x, "stage") for x in [model.spectral_network, model.spatial_network]])
+
+def stage_probabilities(model, data_loader):
+    """Softmax probabilities of every attention layer for a labeled data loader
+    Args:
+        model: a Hang2020 network
+        data_loader: labeled loader, see data.TreeDataset
+    Returns:
+        probabilities: list of three (N, classes) arrays
+        labels: (N,) array
+    """
+    model.eval()
+    probabilities = [[], [], []]
+    labels = []
+    with torch.no_grad():
+        for batch in data_loader:
+            individual, inputs, targets = batch
+            for index, scores in enumerate(model.stage_scores(inputs["HSI"])):
+                probabilities[index].append(F.softmax(scores.float(), dim=1).numpy())
+            labels.append(targets.numpy())
+
+    return [np.concatenate(x) for x in probabilities], np.concatenate(labels)
+
+def calibrate(model, data_loader, max_accuracy_drop=0.01):
+    """Choose the lowest confidence thresholds of the first two attention layers at which crowns that exit are classified at least as well as the final layer classifies the same crowns, less max_accuracy_drop.
+    Exiting crowns are the easy ones, so they are compared with the final layer on the same crowns rather than on all crowns. Each exiting group loses at most max_accuracy_drop, which bounds the drop of the whole cascade
+    Args:
+        model: a Hang2020 network, trained with deep_supervision so that the intermediate heads are meaningful
+        data_loader: labeled loader of held out crops
+        max_accuracy_drop: tolerated drop in accuracy of the cascade relative to the final layer
+    Returns:
+        thresholds: list of two thresholds, a threshold above 1 means no crowns exit at that layer
+    """
+    probabilities, labels = stage_probabilities(model, data_loader)
+    final_correct = probabilities[-1].argmax(1) == labels
+    remaining = np.ones(labels.shape[0], dtype=bool)
+    thresholds = []
+    for index in range(2):
+        confidence = probabilities[index].max(1)
+        correct = probabilities[index].argmax(1) == labels
+        threshold = 1.01
+        #Lower the threshold as long as the crowns above it are accurate enough
+        for candidate in np.sort(np.unique(confidence[remaining]))[::-1]:
+            exits = remaining & (confidence >= candidate)
+            if np.mean(correct[exits]) >= np.mean(final_correct[exits]) - max_accuracy_drop:
+                threshold = float(candidate)
+            else:
+                break
+        thresholds.append(threshold)
+        remaining = remaining & (confidence < threshold)
+
+    return thresholds
+
+def report(model, data_loader, thresholds, repeat=3):
+    """Exit distribution, accuracy and latency of early exit prediction compared with the full model
+    Args:
+        model: a Hang2020 network
+        data_loader: labeled loader
+        thresholds: see calibrate
+        repeat: the fastest of repeat passes is timed
+    Returns:
+        results: dict of exit_distribution (fraction of crowns per layer), accuracy, early_exit_accuracy, seconds, early_exit_seconds and speedup
+    """
+    model.eval()
+    batches = [(inputs["HSI"], targets.numpy()) for individual, inputs, targets in data_loader]
+    labels = np.concatenate([targets for images, targets in batches])
+
+    with torch.no_grad():
+        times = []
+        for x in range(repeat):
+            start = time.perf_counter()
+            predictions = [model(images).argmax(1).numpy() for images, targets in batches]
+            times.append(time.perf_counter() - start)
+        seconds = min(times)
+
+        times = []
+        for x in range(repeat):
+            start = time.perf_counter()
+            outputs = [model.forward_early_exit(images, thresholds) for images, targets in batches]
+            times.append(time.perf_counter() - start)
+        early_exit_seconds = min(times)
+
+    predictions = np.concatenate(predictions)
+    early_exit_predictions = np.concatenate([scores.argmax(1).numpy() for scores, exit_stages in outputs])
+    exit_stages = np.concatenate([exit_stages.numpy() for scores, exit_stages in outputs])
+
+    results = {
+        "exit_distribution": {index: float(np.mean(exit_stages == index)) for index in range(3)},
+        "accuracy": float(np.mean(predictions == labels)),
+        "early_exit_accuracy": float(np.mean(early_exit_predictions == labels)),
+        "seconds": seconds,
+        "early_exit_seconds": early_exit_seconds}
+    results["speedup"] = seconds / early_exit_seconds
+
+    return results
@@ -0,0 +1,121 @@
+#Export trained models to TorchScript for the torch only runtime, see runtime.py
+import json
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torchvision import transforms
+from src import data
+from src.models import metadata
+
+class InferenceModel(nn.Module):
+    """Preprocessing, network and softmax in a single module. The preprocessing matches data.preprocess_image followed by a nearest resize
+    Args:
+        model: Hang2020, metadata_sensor_fusion or any network that takes a batch of images
+        image_size: size of the resized crops
+        metadata: whether the network takes a second input of site indices
+    """
+    def __init__(self, model, image_size, metadata=False):
+        super(InferenceModel, self).__init__()
+        self.model = model
+        self.image_size = image_size
+        self.metadata = metadata
+
+    def preprocess(self, images):
+        """Standardize each pixel across bands and resize a batch of raw crops"""
+        images = images.float()
+        mean = images.mean(dim=1, keepdim=True)
+        std = images.std(dim=1, unbiased=False, keepdim=True)
+        #Constant pixels are centered but not scaled, as in sklearn.preprocessing.scale
+        std = torch.where(std == 0, torch.ones_like(std), std)
+        images = (images - mean) / std
+        images = F.interpolate(images, size=(self.image_size, self.image_size), mode="nearest")
+
+        return images
+
+    def forward(self, images, sites=None):
+        """Class probabilities for a batch of raw crops of the same size"""
+        images = self.preprocess(images)
+        if self.metadata:
+            scores = self.model(images, sites)
+        else:
+            scores = self.model(images)
+
+        return F.softmax(scores, dim=1)
+
+def eager_predict(m, images, sites=None):
+    """Class probabilities of the eager model with the training preprocessing, used to check exports"""
+    preprocessed = []
+    for image in images:
+        image = data.preprocess_image(image.numpy(), channel_is_first=True)
+        image = transforms.functional.resize(image, size=(m.config["image_size"], m.config["image_size"]), interpolation=transforms.InterpolationMode.NEAREST)
+        preprocessed.append(image)
+    inputs = {"HSI": torch.stack(preprocessed)}
+    if sites is not None:
+        inputs["site"] = sites
+    with torch.no_grad():
+        class_probs = m.predict_proba(inputs)
+
+    return class_probs
+
+def example_inputs(m, batch_size=4, crop_size=None, seed=0):
+    """Random raw crops, and site indices for metadata models, to trace and check an export"""
+    if crop_size is None:
+        crop_size = m.config["image_size"] + 4
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.randint(0, 10000, (batch_size, m.config["bands"], crop_size, crop_size), generator=generator).float()
+    if isinstance(m.model, metadata.metadata_sensor_fusion):
+        sites = torch.randint(0, m.model.metadata_model.embedding.num_embeddings, (batch_size,), generator=generator)
+        return images, sites
+
+    return images, None
+
+def export(m, path, check=True, atol=1e-5):
+    """Trace a TreeModel with its preprocessing and save it as TorchScript with the labels and input size
+    Args:
+        m: a main.TreeModel or metadata.MetadataModel
+        path: path to write the TorchScript file
+        check: compare the export with the eager model on random crops
+        atol: absolute tolerance of the class probabilities
+    Returns:
+        path: path to the TorchScript file
+    """
+    m.eval()
+    is_metadata = isinstance(m.model, metadata.metadata_sensor_fusion)
+    inference_model = InferenceModel(m.model, image_size=m.config["image_size"], metadata=is_metadata)
+    inference_model.eval()
+    if is_metadata:
+        #Trace the site lookup rather than the metadata branch
+        m.model.precompute()
+
+    images, sites = example_inputs(m)
+    with torch.no_grad():
+        if is_metadata:
+            traced = torch.jit.trace(inference_model, (images, sites))
+        else:
+            traced = torch.jit.trace(inference_model, images)
+
+    if check:
+        check_parity(m, traced, atol=atol)
+
+    extra_files = {"metadata.json": json.dumps({
+        "labels": [m.index_to_label[x] for x in range(m.classes)],
+        "image_size": m.config["image_size"],
+        "bands": m.config["bands"],
+        "metadata": is_metadata})}
+    torch.jit.save(traced, path, _extra_files=extra_files)
+
+    return path
+
+def check_parity(m, traced, atol=1e-5):
+    """Raise a ValueError if the exported model does not match the eager model on crops of different sizes"""
+    for crop_size in [m.config["image_size"], m.config["image_size"] + 7]:
+        images, sites = example_inputs(m, crop_size=crop_size, seed=crop_size)
+        expected = eager_predict(m, images, sites)
+        with torch.no_grad():
+            if sites is None:
+                result = traced(images)
+            else:
+                result = traced(images, sites)
+        difference = (result - expected).abs().max().item()
+        if difference > atol:
+            raise ValueError("Exported model differs from the eager model by {} for crops of size {}".format(difference, crop_size))
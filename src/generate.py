@@ -6,20 +6,35 @@ import numpy as np
 import shapely
 import os
 import pandas as pd
+from src import box_cache
+from src import neon_paths
 from src.neon_paths import find_sensor_path, lookup_and_convert
 from src import patches
 from distributed import wait   
 from deepforest import main    
+from deepforest import predict as deepforest_predict
+from deepforest import visualize as deepforest_visualize
+import torch
 import traceback
 
-def predict_trees(deepforest_model, rgb_path, bounds, expand=40):
-    """Predict an rgb path at specific utm bounds
-    Args:
-        deepforest_model: a deepforest model object used for prediction
-        rgb_path: full path to image
-        bounds: utm extent given by geopandas.total_bounds
-        expand: numeric meters to add to edges to reduce edge effects
-        """
+#DeepForest model shared by all tasks in this process, see load_deepforest
+_deepforest_model = None
+
+def load_deepforest():
+    """Create the DeepForest release model once per process and reuse it. Dask workers keep the model resident between tasks"""
+    global _deepforest_model
+    if _deepforest_model is None:
+        deepforest_model = main.deepforest()
+        try:
+            deepforest_model.use_release()
+        except:
+            deepforest_model.use_release(check_release=False)
+        _deepforest_model = deepforest_model
+    
+    return _deepforest_model
+
+def expand_bounds(bounds, expand=40):
+    """Grow utm bounds to a square window of expand meters centered on the bounds"""
     #DeepForest is trained on 400m crops, easiest to mantain this approximate size centered on points
     left, bottom, right, top = bounds
     expand_width = (expand - (right - left))/2
@@ -30,18 +45,22 @@ def predict_trees(deepforest_model, rgb_path, bounds, expand=40):
     bottom = bottom - expand_height
     top = top + expand_height 
     
-    src = rasterio.open(rgb_path)
-    pixelSizeX, pixelSizeY  = src.res    
-    img = src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))
-    src.close()
-    
-    #roll to channels last
-    img = np.rollaxis(img, 0,3)
-    boxes = deepforest_model.predict_image(image = img, return_plot=False)
-    
-    if boxes is None:
-        return boxes
+    return left, bottom, right, top
+
+def box_geometry(xmin, ymin, xmax, ymax):
+    """Construct shapely boxes from arrays of coordinates without a per row apply
+    Returns:
+        geometry: array of shapely boxes
+    """
+    xmin, ymin, xmax, ymax = [np.asarray(x, dtype=float) for x in (xmin, ymin, xmax, ymax)]
+    if hasattr(shapely, "box"):
+        #shapely >= 2.0 builds all geometries in a single vectorized call
+        return shapely.box(xmin, ymin, xmax, ymax)
+    else:
+        return gpd.array.from_shapely([shapely.geometry.box(*x) for x in zip(xmin, ymin, xmax, ymax)])
 
+def boxes_to_utm(boxes, left, top, pixelSizeX, pixelSizeY):
+    """Convert image coordinate boxes predicted from a window with a top left origin to utm geometries"""
     #subtract origin. Recall that numpy origin is top left! Not bottom left.
     boxes["xmin"] = (boxes["xmin"] *pixelSizeX) + left
     boxes["xmax"] = (boxes["xmax"] * pixelSizeX) + left
@@ -49,13 +68,126 @@ def predict_trees(deepforest_model, rgb_path, bounds, expand=40):
     boxes["ymax"] = top - (boxes["ymax"] * pixelSizeY)
 
     # combine column to a shapely Box() object, save shapefile
-    boxes['geometry'] = boxes.apply(lambda x: shapely.geometry.box(x.xmin,x.ymin,x.xmax,x.ymax), axis=1)
-    boxes = gpd.GeoDataFrame(boxes, geometry='geometry')    
+    boxes = gpd.GeoDataFrame(boxes, geometry=box_geometry(boxes.xmin, boxes.ymin, boxes.xmax, boxes.ymax))
         
     #Give an id field
     boxes["box_id"] = np.arange(boxes.shape[0])
     
     return boxes
+    
+def predict_trees(deepforest_model, rgb_path, bounds, expand=40, cache_dir=None):
+    """Predict an rgb path at specific utm bounds
+    Args:
+        deepforest_model: a deepforest model object used for prediction
+        rgb_path: full path to image
+        bounds: utm extent given by geopandas.total_bounds
+        expand: numeric meters to add to edges to reduce edge effects
+        cache_dir: optional directory of cached predictions, see box_cache. Cached windows skip inference.
+        """
+    if cache_dir is not None:
+        key = box_cache.cache_key(rgb_path, bounds=bounds, expand=expand, release=box_cache.release_version(deepforest_model))
+        hit, boxes = box_cache.read(cache_dir, key)
+        if hit:
+            return boxes
+        
+    left, bottom, right, top = expand_bounds(bounds, expand=expand)
+    
+    src = rasterio.open(rgb_path)
+    pixelSizeX, pixelSizeY  = src.res    
+    img = src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))
+    src.close()
+    
+    #roll to channels last
+    img = np.rollaxis(img, 0,3)
+    boxes = deepforest_model.predict_image(image = img, return_plot=False)
+    
+    if boxes is not None:
+        boxes = boxes_to_utm(boxes, left=left, top=top, pixelSizeX=pixelSizeX, pixelSizeY=pixelSizeY)
+    
+    if cache_dir is not None:
+        box_cache.write(cache_dir, key, boxes)
+        
+    return boxes
+
+def predict_images(deepforest_model, images):
+    """Run DeepForest on a list of channels last images in a single forward pass. Mirrors deepforest.predict_image for each image, including the non-max suppression across classes
+    Args:
+        deepforest_model: a deepforest model object used for prediction
+        images: list of numpy arrays (height, width, channels) in 0-255 range, sizes may differ
+    Returns:
+        results: list of pandas dataframes of boxes in image coordinates, None for images without predictions
+    """
+    model = deepforest_model.model
+    model.eval()
+    model.score_thresh = deepforest_model.config["score_thresh"]
+    device = next(model.parameters()).device
+    
+    batch = [torch.tensor(np.asarray(x, dtype="float32"), device=device).permute(2, 0, 1) / 255 for x in images]
+    with torch.no_grad():
+        predictions = model(batch)
+    
+    results = []
+    for prediction in predictions:
+        if len(prediction["boxes"]) == 0:
+            results.append(None)
+            continue
+        boxes = deepforest_visualize.format_boxes(prediction)
+        boxes = deepforest_predict.across_class_nms(boxes, iou_threshold=deepforest_model.config["nms_thresh"])
+        boxes["label"] = boxes.label.apply(lambda x: deepforest_model.numeric_to_label_dict[x])
+        results.append(boxes)
+    
+    return results
+
+def predict_trees_batch(deepforest_model, rgb_path, bounds, expand=40, batch_size=8, cache_dir=None):
+    """Predict several utm bounds from the same rgb tile, reading the tile once and batching windows through DeepForest
+    Args:
+        deepforest_model: a deepforest model object used for prediction
+        rgb_path: full path to image
+        bounds: list of utm extents given by geopandas.total_bounds
+        expand: numeric meters to add to edges to reduce edge effects
+        batch_size: number of windows per forward pass
+        cache_dir: optional directory of cached predictions, see box_cache. Only windows missing from the cache are predicted.
+    Returns:
+        results: list of boxes in the same order as bounds, see predict_trees
+    """
+    results = [None for x in bounds]
+    missing = list(range(len(bounds)))
+    if cache_dir is not None:
+        release = box_cache.release_version(deepforest_model)
+        keys = [box_cache.cache_key(rgb_path, bounds=x, expand=expand, release=release) for x in bounds]
+        missing = []
+        for index, key in enumerate(keys):
+            hit, boxes = box_cache.read(cache_dir, key)
+            if hit:
+                results[index] = boxes
+            else:
+                missing.append(index)
+        
+    if len(missing) == 0:
+        return results
+    
+    windows = {index: expand_bounds(bounds[index], expand=expand) for index in missing}
+    src = patches.open_raster(rgb_path)
+    pixelSizeX, pixelSizeY  = src.res
+    for batch_start in range(0, len(missing), batch_size):
+        batch_indices = missing[batch_start:batch_start + batch_size]
+        images = []
+        for index in batch_indices:
+            left, bottom, right, top = windows[index]
+            img = src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))
+            #roll to channels last
+            images.append(np.rollaxis(img, 0,3))
+        
+        predictions = predict_images(deepforest_model, images)
+        for index, boxes in zip(batch_indices, predictions):
+            left, bottom, right, top = windows[index]
+            if boxes is not None:
+                boxes = boxes_to_utm(boxes, left=left, top=top, pixelSizeX=pixelSizeX, pixelSizeY=pixelSizeY)
+            if cache_dir is not None:
+                box_cache.write(cache_dir, keys[index], boxes)
+            results[index] = boxes
+    
+    return results
 
 def choose_box(group, plot_data):
     """Given a set of overlapping bounding boxes and predictions, just choose a closest to stem box by centroid if there are multiples"""
@@ -83,7 +215,7 @@ def create_boxes(plot_data, size=1):
     fixed_boxes["ymax"] = None
     fixed_boxes["ymin"] = None
     
-    fixed_boxes["box_id"] = fixed_boxes.index.to_series().apply(lambda x: "fixed_box_{}".format(x))
+    fixed_boxes["box_id"] = "fixed_box_" + fixed_boxes.index.astype(str)
     
     return fixed_boxes
     
@@ -106,6 +238,18 @@ def process_plot(plot_data, rgb_pool, deepforest_model=None):
     if boxes is None:
         raise ValueError("No trees predicted in plot: {}, skipping.".format(plot_data.plotID.unique()[0]))
     
+    merged_boxes = match_boxes(boxes, plot_data)
+        
+    return merged_boxes, boxes 
+
+def match_boxes(boxes, plot_data):
+    """Associate predicted bounding boxes with the field data of a plot, one box per point and one point per box
+    Args:
+        boxes: geodataframe of utm boxes, see predict_trees
+        plot_data: geopandas dataframe in a utm projection
+    Returns:
+        merged_boxes: geodataframe of bounding box predictions with species labels
+    """
     #Merge results with field data, buffer on edge 
     merged_boxes = gpd.sjoin(boxes, plot_data)
     
@@ -116,45 +260,40 @@ def process_plot(plot_data, rgb_pool, deepforest_model=None):
         created_boxes= create_boxes(missing_ids)
         merged_boxes = merged_boxes.append(created_boxes)
     
-    #If there are multiple boxes per point, take the center box
-    grouped = merged_boxes.groupby("individual")
-    
-    cleaned_boxes = []
-    for value, group in grouped:
-        choosen_box = choose_box(group, plot_data)
-        cleaned_boxes.append(choosen_box)
-    
-    merged_boxes = gpd.GeoDataFrame(pd.concat(cleaned_boxes),crs=merged_boxes.crs)
-    merged_boxes = merged_boxes.drop(columns=["xmin","xmax","ymin","ymax"])
+    #If there are multiple boxes per point, take the box with the centroid closest to the stem
+    crs = merged_boxes.crs
+    merged_boxes = merged_boxes.reset_index(drop=True)
+    stems = plot_data.drop_duplicates("individual").set_index("individual").geometry
+    stem_locations = gpd.GeoSeries(stems.loc[merged_boxes.individual].values, index=merged_boxes.index, crs=crs)
+    merged_boxes["stem_distance"] = merged_boxes.centroid.distance(stem_locations)
+    merged_boxes = merged_boxes.sort_values(["individual","stem_distance"], kind="mergesort").drop_duplicates("individual")
+    merged_boxes = merged_boxes.drop(columns=["xmin","xmax","ymin","ymax","stem_distance"])
     
     ##if there are multiple points per box, take the tallest point.
-    cleaned_points = []
-    for value, group in merged_boxes.groupby("box_id"):
-        if group.shape[0] > 1:
-            print("removing {} points for within a deepforest box".format(group.shape[0]-1))
-            cleaned_points.append(group[group.height == group.height.max()])
-        else:
-            cleaned_points.append(group)
+    n_points = merged_boxes.shape[0]
+    merged_boxes = merged_boxes.sort_values("height", ascending=False, kind="mergesort").drop_duplicates("box_id")
+    if merged_boxes.shape[0] < n_points:
+        print("removing {} points for within a deepforest box".format(n_points - merged_boxes.shape[0]))
      
-    merged_boxes = gpd.GeoDataFrame(pd.concat(cleaned_points),crs=merged_boxes.crs)
-        
-    return merged_boxes, boxes 
-
-def run(plot, df, savedir, raw_box_savedir, rgb_pool=None, saved_model=None, deepforest_model=None):
-    """wrapper function for dask, see main.py"""
+    merged_boxes = gpd.GeoDataFrame(merged_boxes, crs=crs)
     
-    if deepforest_model is None:
-        from deepforest import main
-        deepforest_model = main.deepforest()
-        try:
-            deepforest_model.use_release()
-        except:
-            deepforest_model.use_release(check_release=False)        
+    return merged_boxes
 
+def run(plot, df, savedir, raw_box_savedir, rgb_pool=None, saved_model=None, deepforest_model=None, boxes=None):
+    """wrapper function for dask, see main.py
+    Args:
+        boxes: optional DeepForest boxes already predicted for this plot, see run_tile. If None, the plot is predicted here.
+    """
     #Filter data and process
     plot_data = df[df.plotID == plot]
     try:
-        predicted_trees, raw_boxes = process_plot(plot_data, rgb_pool, deepforest_model)
+        if boxes is None:
+            if deepforest_model is None:
+                deepforest_model = load_deepforest()
+            predicted_trees, raw_boxes = process_plot(plot_data, rgb_pool, deepforest_model)
+        else:
+            predicted_trees = match_boxes(boxes, plot_data)
+            raw_boxes = boxes
     except ValueError as e:
         print(e)
         return None
@@ -171,12 +310,59 @@ def run(plot, df, savedir, raw_box_savedir, rgb_pool=None, saved_model=None, dee
     
     return predicted_trees
 
+def run_tile(rgb_path, plots, df, savedir, raw_box_savedir, deepforest_model=None, batch_size=8, cache_dir=None):
+    """Predict all plots that share an RGB tile in batches and match boxes to field data, see run
+    Args:
+        rgb_path: full path to RGB tile
+        plots: list of plotIDs within the tile
+        df: field data containing at least the rows of the plots
+        batch_size: number of plot windows per DeepForest forward pass
+        cache_dir: optional directory of cached DeepForest predictions, see box_cache
+    Returns:
+        results: list of predicted trees for each plot with matching boxes
+    """
+    if deepforest_model is None:
+        deepforest_model = load_deepforest()
+        
+    bounds = [df[df.plotID == plot].total_bounds for plot in plots]
+    plot_boxes = predict_trees_batch(deepforest_model=deepforest_model, rgb_path=rgb_path, bounds=bounds, batch_size=batch_size, cache_dir=cache_dir)
+    
+    results = []
+    for plot, boxes in zip(plots, plot_boxes):
+        if boxes is None:
+            print("No trees predicted in plot: {}, skipping.".format(plot))
+            continue
+        result = run(plot=plot, df=df, savedir=savedir, raw_box_savedir=raw_box_savedir, boxes=boxes)
+        if result is not None:
+            results.append(result)
+    
+    return results
+
+def plots_by_tile(df, rgb_pool):
+    """Group plotIDs by the RGB tile that contains them
+    Returns:
+        tiles: dict of rgb_path -> list of plotIDs
+    """
+    tiles = {}
+    for plot, plot_data in df.groupby("plotID"):
+        try:
+            rgb_path = find_sensor_path(bounds=plot_data.total_bounds, lookup_pool=rgb_pool)
+        except Exception as e:
+            print("cannot find RGB sensor for {}: {}".format(plot, e))
+            continue
+        tiles.setdefault(rgb_path, []).append(plot)
+    
+    return tiles
+
 def points_to_crowns(
     field_data,
     rgb_dir, 
     savedir,
     raw_box_savedir,
-    client=None):
+    client=None,
+    batch_size=8,
+    cache_dir=None,
+    cache_size=None):
     """Prepare NEON field data int
     Args:
         field_data: shp file with location and class of each field collected point
@@ -184,24 +370,32 @@ def points_to_crowns(
         savedir: direcory to save predicted bounding boxes
         raw_box_savedir: directory save all bounding boxes in the image
         client: dask client object to use
+        batch_size: number of plot windows from the same RGB tile per DeepForest forward pass
+        cache_dir: optional directory of cached DeepForest predictions, plots with cached windows skip inference
+        cache_size: maximum size of the prediction cache in GB, least recently used windows are evicted once all tiles are predicted
     Returns:
         None: .shp bounding boxes are written to savedir
     """ 
     df = gpd.read_file(field_data)
-    plot_names = df.plotID.unique()
     
-    rgb_pool = glob.glob(rgb_dir, recursive=True)
+    rgb_pool = neon_paths.sensor_index(glob.glob(rgb_dir, recursive=True))
+    tiles = plots_by_tile(df, rgb_pool)
     results = []    
     if client:
+        #Partition field data up front, each task only receives the rows of its own plots
+        partitions = [df[df.plotID.isin(plots)] for plots in tiles.values()]
+        partitions = client.scatter(partitions)
         futures = []
-        for plot in plot_names:
+        for (rgb_path, plots), partition in zip(tiles.items(), partitions):
             future = client.submit(
-                run,
-                plot=plot,
-                df=df,
-                rgb_pool=rgb_pool,
+                run_tile,
+                rgb_path=rgb_path,
+                plots=plots,
+                df=partition,
                 savedir=savedir,
-                raw_box_savedir=raw_box_savedir
+                raw_box_savedir=raw_box_savedir,
+                batch_size=batch_size,
+                cache_dir=cache_dir
             )
             futures.append(future)
             
@@ -210,20 +404,22 @@ def points_to_crowns(
         for x in futures:
             try:
                 result = x.result()
-                results.append(result)
+                results.extend(result)
             except:
                 continue
     else:
-        #IMPORTS at runtime due to dask pickling, kinda ugly.
-        deepforest_model = main.deepforest()  
-        deepforest_model.use_release(check_release=False)
+        deepforest_model = load_deepforest()
         
-        for plot in plot_names:
+        for rgb_path, plots in tiles.items():
             try:
-                result = run(plot=plot, df=df, savedir=savedir, raw_box_savedir=raw_box_savedir, rgb_pool=rgb_pool, deepforest_model=deepforest_model)
-                results.append(result)
+                result = run_tile(rgb_path=rgb_path, plots=plots, df=df[df.plotID.isin(plots)], savedir=savedir, raw_box_savedir=raw_box_savedir, deepforest_model=deepforest_model, batch_size=batch_size, cache_dir=cache_dir)
+                results.extend(result)
             except Exception as e:
-                print("{} failed with {}".format(plot, e))
+                print("{} failed with {}".format(rgb_path, e))
+    
+    if cache_dir is not None and cache_size is not None:
+        box_cache.evict(cache_dir, cache_size)
+        
     results = pd.concat(results)
     
     return results
@@ -235,7 +431,55 @@ def write_crop(row, img_path, label_dict, site_dict, savedir):
     
     return annotation
 
-def generate_crops(gdf, sensor_glob, savedir, label_dict, site_dict, client=None, convert_h5=False, rgb_glob=None, HSI_tif_dir=None):
+def write_crops(crowns, img_pool, label_dict, site_dict, savedir, convert_h5=False, rgb_pool=None, HSI_tif_dir=None):
+    """Resolve sensor paths, convert h5 tiles if needed and write crops for a chunk of crowns. Wrapper for dask, see generate_crops
+    Args:
+        crowns: geodataframe of crowns, usually from the same sensor tile
+        img_pool: list or sensor_index of sensor paths
+        rgb_pool: list or sensor_index of RGB paths, only needed if convert_h5 is True
+    Returns:
+        annotations: pandas dataframe of filenames, labels and sites, None if no crops were written
+    """
+    annotations = []
+    for index, row in crowns.iterrows():
+        try:
+            #Check if h5 -> tif conversion is complete
+            if convert_h5:
+                img_path = lookup_and_convert(rgb_pool=rgb_pool, hyperspectral_pool=img_pool, savedir=HSI_tif_dir, bounds=row.geometry.bounds)
+            else:
+                img_path = find_sensor_path(lookup_pool = img_pool, bounds = row.geometry.bounds)  
+        except:
+            print("{} failed to find sensor path with traceback {}".format(row.geometry.bounds, traceback.format_exc()))
+            continue
+        try:
+            annotation = write_crop(row=row, img_path=img_path, savedir=savedir, label_dict=label_dict, site_dict=site_dict)
+        except Exception as e:
+            print("{} failed with {}".format(row,e))
+            continue
+
+        annotations.append(annotation)
+    
+    if len(annotations) == 0:
+        return None
+    
+    annotations = pd.concat(annotations)
+    
+    return annotations
+
+def chunk_crowns(gdf, chunk_size=100):
+    """Split crowns into chunks of at most chunk_size crowns that share a sensor tile
+    Returns:
+        chunks: list of geodataframes
+    """
+    geo_index = [neon_paths.bounds_to_geoindex(x.bounds) for x in gdf.geometry]
+    chunks = []
+    for name, group in gdf.groupby(geo_index):
+        for index in range(0, group.shape[0], chunk_size):
+            chunks.append(group.iloc[index:index + chunk_size])
+    
+    return chunks
+
+def generate_crops(gdf, sensor_glob, savedir, label_dict, site_dict, client=None, convert_h5=False, rgb_glob=None, HSI_tif_dir=None, chunk_size=100):
     """
     Given a shapefile of crowns in a plot, create pixel crops and a dataframe of unique names and labels"
     Args:
@@ -248,29 +492,40 @@ def generate_crops(gdf, sensor_glob, savedir, label_dict, site_dict, client=None
         convert_h5: If HSI data is passed, make sure .tif conversion is complete
         rgb_glob: glob to search images to match when converting h5s -> tif.
         HSI_tif_dir: if converting H5 -> tif, where to save .tif files. Only needed if convert_h5 is True
+        chunk_size: maximum number of crowns from the same tile processed by a single task
     Returns:
        annotations: pandas dataframe of filenames and individual IDs to link with data
     """
+    if convert_h5 and rgb_glob is None:
+        raise ValueError("rgb_glob is None, but convert_h5 is True, please supply glob to search for rgb images")
+    
     annotations = []
     
-    img_pool = glob.glob(sensor_glob, recursive=True)
-    rgb_pool = glob.glob(rgb_glob, recursive=True)
+    img_pool = neon_paths.sensor_index(glob.glob(sensor_glob, recursive=True))
+    if rgb_glob is None:
+        rgb_pool = None
+    else:
+        rgb_pool = neon_paths.sensor_index(glob.glob(rgb_glob, recursive=True))
+    
+    chunks = chunk_crowns(gdf, chunk_size=chunk_size)
     
     if client:
+        #Send the sensor indices once, each task gets a chunk of crowns
+        img_pool = client.scatter([img_pool], broadcast=True)[0]
+        if rgb_pool is not None:
+            rgb_pool = client.scatter([rgb_pool], broadcast=True)[0]
         futures = []
-        for index, row in gdf.iterrows():
-            try:
-                #Check if h5 -> tif conversion is complete
-                if convert_h5:
-                    if rgb_glob is None:
-                        raise ValueError("rgb_glob is None, but convert_h5 is True, please supply glob to search for rgb images")
-                    else:
-                        img_path = lookup_and_convert(rgb_pool=rgb_pool, hyperspectral_pool=img_pool, savedir=HSI_tif_dir, bounds=row.geometry.bounds)
-                else:
-                    img_path = find_sensor_path(lookup_pool = img_pool, bounds = row.geometry.bounds)  
-            except:
-                print("{} failed to find sensor path with traceback {}".format(row.geometry.bounds, traceback.print_exc()))
-            future = client.submit(write_crop,row=row,img_path=img_path, label_dict=label_dict, savedir=savedir, site_dict=site_dict)
+        for chunk in chunks:
+            future = client.submit(
+                write_crops,
+                crowns=chunk,
+                img_pool=img_pool,
+                rgb_pool=rgb_pool,
+                label_dict=label_dict,
+                site_dict=site_dict,
+                savedir=savedir,
+                convert_h5=convert_h5,
+                HSI_tif_dir=HSI_tif_dir)
             futures.append(future)
             
         wait(futures)
@@ -279,30 +534,20 @@ def generate_crops(gdf, sensor_glob, savedir, label_dict, site_dict, client=None
                 annotation = x.result()
                 annotations.append(annotation)                
             except:
-                print("Future failed with {}".format(traceback.print_exc()))
+                print("Future failed with {}".format(traceback.format_exc()))
     else:
-        for index, row in gdf.iterrows():
-            try:
-                #Check if h5 -> tif conversion is complete
-                if convert_h5:
-                    if rgb_glob is None:
-                        raise ValueError("rgb_glob is None, but convert_h5 is True, please supply glob to search for rgb images")
-                    else:
-                        img_path = lookup_and_convert(rgb_pool=rgb_pool, hyperspectral_pool=img_pool, savedir=HSI_tif_dir, bounds=row.geometry.bounds)
-                else:
-                    img_path = find_sensor_path(lookup_pool = img_pool, bounds = row.geometry.bounds)  
-            except:
-                print("{} failed to find sensor path with traceback".format(row.geometry.bounds, traceback.print_exc()))
-                continue
-            try:
-                annotation = write_crop(row=row, img_path=img_path, savedir=savedir, label_dict=label_dict, site_dict=site_dict)
-            except Exception as e:
-                print("{} failed with {}".format(row,e))
-                continue
-    
+        for chunk in chunks:
+            annotation = write_crops(
+                crowns=chunk,
+                img_pool=img_pool,
+                rgb_pool=rgb_pool,
+                label_dict=label_dict,
+                site_dict=site_dict,
+                savedir=savedir,
+                convert_h5=convert_h5,
+                HSI_tif_dir=HSI_tif_dir)
             annotations.append(annotation)
     
     annotations = pd.concat(annotations)
         
     return annotations
-        
\ No newline at end of file
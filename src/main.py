@@ -1,30 +1,32 @@
 #Lightning Data Module
 from . import __file__
+import contextlib
 import geopandas as gpd
 import glob as glob
-from deepforest.main import deepforest
-from descartes import PolygonPatch
 import os
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.collections import PatchCollection
-from pytorch_lightning import LightningModule
+from pytorch_lightning import LightningModule, Trainer
+from pytorch_lightning.callbacks import ModelCheckpoint
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from torch.nn import functional as F
 from torch import optim
 import torch
 from torchvision import transforms
 import torchmetrics
 import tempfile
-import rasterio
-from rasterio.plot import show
 from src import data
-from src import generate
+from src import early_exit
 from src import neon_paths
 from src import patches
-from shapely.geometry import Point, box
+from src import predict
+from src import visualize
 from sklearn import preprocessing
 
+#bfloat16 cpu autocast was added in torch 1.10, requirements.txt pins torch 1.9
+BF16_SUPPORTED = hasattr(torch, "cpu") and hasattr(torch.cpu, "amp")
+
 
 class TreeModel(LightningModule):
     """A pytorch lightning data module
@@ -47,8 +49,13 @@ class TreeModel(LightningModule):
         for x in label_dict:
             self.index_to_label[label_dict[x]] = x 
         
+        #Sensor indices built on first use, see sensor_index
+        self.sensor_indices = {}
+        
         #Create model 
         self.model = model
+        if self.config["channels_last"]:
+            self.model = self.model.to(memory_format=torch.channels_last)
         
         #Metrics
         micro_recall = torchmetrics.Accuracy(average="micro")
@@ -62,25 +69,47 @@ class TreeModel(LightningModule):
         #allow for empty data if data augmentation is generated
         individual, inputs, y = batch
         images = inputs["HSI"]
-        y_hat = self.model.forward(images)
-        loss = F.cross_entropy(y_hat, y)    
+        with self.autocast():
+            y_hat = self.model.forward(images)
+        loss = F.cross_entropy(y_hat.float(), y) + self.auxiliary_loss(y)
         
         return loss
     
+    def autocast(self):
+        """Context for forward passes, bf16 autocast on cpu if config["precision"] is bf16, otherwise float32"""
+        if self.config["precision"] == "bf16":
+            if not BF16_SUPPORTED:
+                raise ValueError("bf16 cpu autocast requires torch >= 1.10, found {}".format(torch.__version__))
+            return torch.cpu.amp.autocast(dtype=torch.bfloat16)
+        
+        return contextlib.nullcontext()
+    
+    def auxiliary_loss(self, y):
+        """Deep supervision loss of the intermediate attention heads from the last forward pass, 0 if the network was not created with deep_supervision"""
+        sensor_model = getattr(self.model, "sensor_model", self.model)
+        intermediate_scores = getattr(sensor_model, "intermediate_scores", [])
+        if not getattr(sensor_model, "deep_supervision", False) or len(intermediate_scores) == 0:
+            return 0
+        losses = [F.cross_entropy(x.float(), y) for x in intermediate_scores]
+        
+        return self.config["deep_supervision_weight"] * sum(losses) / len(losses)
+    
     def validation_step(self, batch, batch_idx):
         """Train on a loaded dataset
         """
         #allow for empty data if data augmentation is generated
         individual, inputs, y = batch
         images = inputs["HSI"]        
-        y_hat = self.model.forward(images)
+        with self.autocast():
+            y_hat = self.model.forward(images)
+        y_hat = y_hat.float()
         loss = F.cross_entropy(y_hat, y)        
         
-        # Log loss and metrics
-        self.log("val_loss", loss, on_epoch=True)
+        # Log loss and metrics, metrics are accumulated over the epoch and synced between distributed processes
+        self.log("val_loss", loss, on_epoch=True, sync_dist=True)
         softmax_prob = F.softmax(y_hat, dim =1)
-        output = self.metrics(softmax_prob, y) 
-        self.log_dict(output)
+        self.metrics.update(softmax_prob, y) 
+        self.log_dict(self.metrics, on_epoch=True)
         
         return loss
     
@@ -115,59 +144,32 @@ class TreeModel(LightningModule):
             return self.index_to_label[index]
                 
     def predict_xy(self, coordinates, fixed_box=True):
-        #TODO update for metadata model
         """Given an x,y location, find sensor data and predict tree crown class. If no predicted crown within 5m an error will be raised (fixed_box=False) or a 1m fixed box will created (fixed_box=True)
+        For many locations use predict.Predictor(model).predict_points, which keeps the model and raster handles between calls
         Args:
             coordinates (tuple): x,y tuple in utm coordinates
             fixed_box (False): If no DeepForest tree is predicted within 5m of centroid, create a 1m fixed box. If false, raise ValueError
         Returns:
             label: species taxa label
+            score: probability of the label
         """
-        #Predict crown
-        gdf = gpd.GeoDataFrame(geometry=[Point(coordinates[0],coordinates[1])])
-        img_pool = glob.glob(self.config["rgb_sensor_pool"], recursive=True)
-        rgb_path = neon_paths.find_sensor_path(lookup_pool=img_pool, bounds=gdf.total_bounds)
-        
-        #DeepForest model to predict crowns
-        deepforest_model = deepforest()
-        deepforest_model.use_release(check_release=False)
-        boxes = generate.predict_trees(deepforest_model=deepforest_model, rgb_path=rgb_path, bounds=gdf.total_bounds, expand=40)
-        boxes['geometry'] = boxes.apply(lambda x: box(x.xmin,x.ymin,x.xmax,x.ymax), axis=1)
-        
-        if boxes.shape[0] > 1:
-            centroid_distances = boxes.centroid.distance(Point(coordinates[0],coordinates[1])).sort_values()
-            centroid_distances = centroid_distances[centroid_distances<5]
-            boxes = boxes[boxes.index == centroid_distances.index[0]]
-        if boxes.empty:
-            if fixed_box:
-                boxes = generate.create_boxes(boxes)
-            else:
-                raise ValueError("No predicted tree centroid within 5 m of point {}, to ignore this error and specify fixed_box=True".format(coordinates))
-            
-        #Create pixel crops
-        img_pool = glob.glob(self.config["HSI_sensor_pool"], recursive=True)        
-        sensor_path = neon_paths.find_sensor_path(lookup_pool=img_pool, bounds=gdf.total_bounds)        
-        crop = patches.crop(
-            bounds=boxes["geometry"].values[0].bounds,
-            sensor_path=sensor_path,
-        )
-     
-        #preprocess and batch
-        image = data.preprocess_image(crop, channel_is_first=True)
-        image = transforms.functional.resize(image, size=(self.config["image_size"],self.config["image_size"]), interpolation=transforms.InterpolationMode.NEAREST)
-        image = torch.unsqueeze(image, dim = 0)
+        predictor = predict.Predictor(self)
+        bounds = (coordinates[0], coordinates[1], coordinates[0], coordinates[1])
+        try:
+            neon_paths.find_sensor_path(lookup_pool=predictor.rgb_pool, bounds=bounds)
+        except Exception as e:
+            raise ValueError("Cannot find an RGB tile for point {}: {}".format(coordinates, e))
+        try:
+            self.find_HSI_path(bounds=bounds)
+        except Exception as e:
+            raise ValueError("Cannot find a hyperspectral tile for point {}: {}".format(coordinates, e))
         
-        #Classify pixel crops
-        self.model.eval() 
-        with torch.no_grad():
-            class_probs = self.model(image)
-            class_probs = F.softmax(class_probs)
-        class_probs = class_probs.numpy()
-        index = np.argmax(class_probs)
-        label = self.index_to_label[index]
+        results = predictor.predict_points([coordinates], fixed_box=fixed_box)
+        if results.pred_taxa.isnull().all():
+            raise ValueError("No predicted tree centroid within 5 m of point {}, to ignore this error and specify fixed_box=True".format(coordinates))
         
-        #Average score for selected label
-        score = class_probs[:,index]
+        label = results.pred_taxa.iloc[0]
+        score = results.score.iloc[0]
         
         return label, score
     
@@ -204,10 +206,89 @@ class TreeModel(LightningModule):
         
         return label, score
     
+    def sensor_index(self, pool):
+        """Glob and index a sensor pool from the config once, see neon_paths.sensor_index
+        Args:
+            pool: config key of the glob, for example "HSI_sensor_pool"
+        """
+        if pool not in self.sensor_indices:
+            self.sensor_indices[pool] = neon_paths.sensor_index(glob.glob(self.config[pool], recursive=True))
+        
+        return self.sensor_indices[pool]
+    
+    def find_HSI_path(self, bounds):
+        """Find the hyperspectral .tif for utm bounds, converting the .h5 tile if config["convert_h5"] is True"""
+        if self.config["convert_h5"]:
+            HSI_path = neon_paths.lookup_and_convert(
+                rgb_pool=self.sensor_index("rgb_sensor_pool"),
+                hyperspectral_pool=self.sensor_index("HSI_sensor_pool"),
+                savedir=self.config["HSI_tif_dir"],
+                bounds=bounds)
+        else:
+            HSI_path = neon_paths.find_sensor_path(lookup_pool=self.sensor_index("HSI_sensor_pool"), bounds=bounds)
+        
+        return HSI_path
+    
+    def predict_crowns(self, gdf, batch_size=None):
+        """Predict the label of many crowns. Crowns are grouped by sensor tile, cropped in bulk and classified in batches
+        Args:
+            gdf: geodataframe of crown geometries in utm. A site column is passed to metadata models.
+            batch_size: number of crowns per forward pass, defaults to config["predict_batch_size"]
+        Returns:
+            gdf: copy of gdf with pred_taxa, score and one probability column per class. Crowns without sensor data have no prediction
+        """
+        if batch_size is None:
+            batch_size = self.config["predict_batch_size"]
+            
+        results = []
+        #groupby raises on an empty list of keys
+        if not gdf.empty:
+            geo_index = [neon_paths.bounds_to_geoindex(x.bounds) for x in gdf.geometry]
+            for name, group in gdf.groupby(geo_index):
+                try:
+                    sensor_path = self.find_HSI_path(bounds=group.geometry.iloc[0].bounds)
+                except Exception as e:
+                    print("Cannot find sensor path for tile {}: {}".format(name, e))
+                    continue
+                results.append(predict.classify_crowns(self, group, sensor_path=sensor_path, batch_size=batch_size))
+        
+        if len(results) == 0:
+            results = pd.DataFrame(columns=[self.index_to_label[x] for x in range(self.classes)] + ["label", "score"])
+        else:
+            results = pd.concat(results)
+        results = results.rename(columns={"label":"pred_taxa"})
+        gdf = gdf.drop(columns=results.columns, errors="ignore").join(results)
+        
+        return gdf
+    
     def predict(self,inputs):
         """Given a input dictionary, construct args for prediction"""
-        return self.model(inputs["HSI"])
+        images = inputs["HSI"]
+        if self.config["channels_last"]:
+            images = images.contiguous(memory_format=torch.channels_last)
+        with self.autocast():
+            if self.config["early_exit_thresholds"]:
+                if not early_exit.can_exit_early(self.model):
+                    raise ValueError("early_exit_thresholds requires an unquantized Hang2020 network trained with deep_supervision, this network cannot exit early")
+                y_hat, exit_stages = self.model.forward_early_exit(images, self.config["early_exit_thresholds"])
+            else:
+                y_hat = self.model(images)
+        
+        return y_hat.float()
+    
+    def predict_proba(self, inputs):
+        """Given a input dictionary, return class probabilities"""
+        return F.softmax(self.predict(inputs), dim=1)
     
+    def save_model(self, path):
+        """Save the network, label dict and config so that the model can be rebuilt for prediction without the data module, see load_model"""
+        torch.save({
+            "module": type(self),
+            "model": self.model,
+            "classes": self.classes,
+            "label_dict": self.label_to_index,
+            "config": self.config}, path)
+        
     def predict_dataloader(self, data_loader, plot_n_individuals=200, experiment=None):
         """Given a file with paths to image crops, create crown predictions 
         The format of image_path inform the crown membership, the files should be named crownid_counter.png where crownid is a
@@ -237,46 +318,104 @@ class TreeModel(LightningModule):
         
         #get just the basename
         df = pd.DataFrame({"pred_label":predictions,"label":labels,"individual":individuals})
-        df["pred_taxa"] = df["pred_label"].apply(lambda x: self.index_to_label[x])        
-        df["true_taxa"] = df["label"].apply(lambda x: self.index_to_label[x])
+        df["pred_taxa"] = df["pred_label"].map(self.index_to_label)        
+        df["true_taxa"] = df["label"].map(self.index_to_label)
  
         if experiment:
-            #load image pool and crown predicrions
-            rgb_pool = glob.glob(self.config["rgb_sensor_pool"], recursive=True)
+            #load crown predictions and render a sample in parallel
             test_crowns = gpd.read_file("{}/data/processed/test_crowns.shp".format(self.ROOT))  
             test_points = gpd.read_file("{}/data/processed/test_points.shp".format(self.ROOT))   
-            
-            plt.ion()
-            for index, row in df.sample(n=plot_n_individuals).iterrows():
-                fig = plt.figure(0)
-                ax = fig.add_subplot(1, 1, 1)                
-                individual = row["individual"]
-                geom = test_crowns[test_crowns.individual == individual].geometry.iloc[0]
-                left, bottom, right, top = geom.bounds
-                
-                #Find image
-                img_path = neon_paths.find_sensor_path(lookup_pool=rgb_pool, bounds=geom.bounds)
-                src = rasterio.open(img_path)
-                img = src.read(window=rasterio.windows.from_bounds(left-10, bottom-10, right+10, top+10, transform=src.transform))  
-                img_transform = src.window_transform(window=rasterio.windows.from_bounds(left-10, bottom-10, right+10, top+10, transform=src.transform))  
-                
-                #Plot crown
-                patches = [PolygonPatch(geom, edgecolor='red', facecolor='none')]
-                show(img, ax=ax, transform=img_transform)                
-                ax.add_collection(PatchCollection(patches, match_original=True))
-                
-                #Plot field coordinate
-                stem = test_points[test_points.individual == individual]
-                stem.plot(ax=ax)
-                
-                plt.savefig("{}/{}.png".format(self.tmpdir, row["individual"]))
-                experiment.log_image("{}/{}.png".format(self.tmpdir, row["individual"]), name = "crown: {}, True: {}, Predicted {}".format(row["individual"], row.true_taxa,row.pred_taxa))
-                src.close()
-                plt.close("all")
-            plt.ioff()
+            sample = df.sample(n=min(plot_n_individuals, df.shape[0]))
+            visualize.render_predictions(
+                sample,
+                crowns=test_crowns,
+                points=test_points,
+                rgb_pool=self.sensor_index("rgb_sensor_pool"),
+                savedir=self.tmpdir,
+                experiment=experiment,
+                workers=self.config["plot_workers"])
             
         return df
     
+    def stream_predictions(self, data_loader, output, top_k=None, aggregate=False):
+        """Predict a data loader batch by batch and append each batch to a parquet file, memory does not grow with the size of the data
+        Args:
+            data_loader: a torch data loader of TreeDataset, with or without labels
+            output: path of the parquet file to write with individual, crown, pred_taxa_{i} and score_{i} for the top k classes and true_taxa if the loader has labels
+            top_k: number of classes to keep per prediction, defaults to config["top_k"]
+            aggregate: if True, also average the class probabilities of all pixels or patches of a crown. The crown is the individual up to the first "_", see predict_dataloader
+        Returns:
+            crowns: if aggregate, a dataframe of crown level predictions with the top k classes, their mean probabilities and the number of votes. Otherwise None
+        """
+        if top_k is None:
+            top_k = self.config["top_k"]
+        top_k = min(top_k, self.classes)
+        taxa = np.array([self.index_to_label[x] for x in range(self.classes)])
+        
+        self.eval()
+        writer = None
+        partial_sums = []
+        vote_sums = None
+        for batch in data_loader:
+            if len(batch) == 3:
+                individual, inputs, targets = batch
+            else:
+                individual, inputs = batch
+                targets = None
+            with torch.no_grad():
+                class_probs = self.predict_proba(inputs)
+            top_probs, top_index = torch.topk(class_probs, k=top_k, dim=1)
+            top_probs = top_probs.numpy()
+            top_index = top_index.numpy()
+            
+            individual = pd.Series(np.asarray(individual))
+            df = pd.DataFrame({"individual":individual, "crown":individual.str.split("_").str[0]})
+            for x in range(top_k):
+                df["pred_taxa_{}".format(x)] = taxa[top_index[:,x]]
+                df["score_{}".format(x)] = top_probs[:,x]
+            if targets is not None:
+                df["true_taxa"] = taxa[targets.numpy()]
+            
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output, table.schema)
+            writer.write_table(table)
+            
+            if aggregate:
+                #Sum probabilities and votes per crown, partial sums are merged periodically to keep memory constant
+                sums = pd.DataFrame(class_probs.numpy(), index=df.crown.values)
+                sums["votes"] = 1
+                if targets is not None:
+                    sums["label"] = targets.numpy()
+                partial_sums.append(sums)
+                if len(partial_sums) >= 50:
+                    vote_sums = combine_votes(partial_sums, vote_sums)
+                    partial_sums = []
+        
+        if writer is not None:
+            writer.close()
+        
+        if not aggregate:
+            return None
+        
+        vote_sums = combine_votes(partial_sums, vote_sums)
+        if vote_sums is None:
+            return pd.DataFrame()
+        
+        votes = vote_sums["votes"].values
+        class_probs = vote_sums[list(range(self.classes))].values / votes[:, None]
+        top_index = np.argsort(-class_probs, axis=1)[:, :top_k]
+        top_probs = np.take_along_axis(class_probs, top_index, axis=1)
+        
+        crowns = pd.DataFrame({"crown":vote_sums.index.values, "votes":votes})
+        for x in range(top_k):
+            crowns["pred_taxa_{}".format(x)] = taxa[top_index[:,x]]
+            crowns["score_{}".format(x)] = top_probs[:,x]
+        if "label" in vote_sums.columns:
+            crowns["true_taxa"] = taxa[vote_sums["label"].values.astype(int)]
+        
+        return crowns
+        
     def evaluate_crowns(self, data_loader, experiment=None):
         """Crown level measure of accuracy
         Args:
@@ -288,4 +427,66 @@ class TreeModel(LightningModule):
         """
         results = self.predict_dataloader(data_loader=data_loader, experiment=experiment)
 
-        return results
\ No newline at end of file
+        return results
+
+def combine_votes(partial_sums, vote_sums=None):
+    """Merge per batch crown sums from TreeModel.stream_predictions into a single table"""
+    if vote_sums is not None:
+        partial_sums = [vote_sums] + partial_sums
+    if len(partial_sums) == 0:
+        return None
+    combined = pd.concat(partial_sums)
+    aggregations = {x:"sum" for x in combined.columns}
+    if "label" in combined.columns:
+        aggregations["label"] = "first"
+    combined = combined.groupby(level=0).agg(aggregations)
+    
+    return combined
+
+def load_model(path):
+    """Load a model written by TreeModel.save_model onto the cpu
+    Args:
+        path: path to saved model
+    Returns:
+        m: a TreeModel, or the subclass that was saved, in eval mode
+    """
+    saved = torch.load(path, map_location="cpu")
+    m = saved["module"](model=saved["model"], classes=saved["classes"], label_dict=saved["label_dict"], config=saved["config"])
+    m.eval()
+    
+    return m
+
+def build_trainer(config, logger=None, **kwargs):
+    """Create a trainer from the config
+    Args:
+        config: DeepTreeAttention config dict. accelerator ddp_cpu trains num_processes processes per node on num_nodes cpu nodes with the gloo backend, 
+            dp uses gpus on a single node
+        logger: optional lightning logger
+        **kwargs: passed to Trainer
+    Returns:
+        trainer: a pytorch lightning Trainer. Only run post training code where trainer.is_global_zero
+    """
+    if config["accelerator"] == "ddp_cpu":
+        os.environ.setdefault("PL_TORCH_DISTRIBUTED_BACKEND", "gloo")
+        #Spawned training processes hand the trained weights back to this process through the checkpoint, without one the module stays untrained
+        callbacks = kwargs.pop("callbacks", []) + [ModelCheckpoint(dirpath=tempfile.mkdtemp())]
+        trainer = Trainer(
+            accelerator="ddp_cpu",
+            num_processes=config["num_processes"],
+            num_nodes=config["num_nodes"],
+            fast_dev_run=config["fast_dev_run"],
+            max_epochs=config["epochs"],
+            callbacks=callbacks,
+            logger=logger,
+            **kwargs)
+    else:
+        trainer = Trainer(
+            gpus=config["gpus"],
+            accelerator=config["accelerator"] if config["gpus"] else None,
+            fast_dev_run=config["fast_dev_run"],
+            max_epochs=config["epochs"],
+            checkpoint_callback=False,
+            logger=logger,
+            **kwargs)
+    
+    return trainer
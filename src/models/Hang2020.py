@@ -12,10 +12,28 @@ def global_spectral_pool(x):
     return global_pool
     
 class conv_module(Module):
-    def __init__(self, in_channels, filters, maxpool_kernel=None):
-        """Define a simple conv block with batchnorm and optional max pooling"""
+    def __init__(self, in_channels, filters, maxpool_kernel=None, block="dense"):
+        """Define a simple conv block with batchnorm and optional max pooling
+        Args:
+            block: factorization of the 3x3 convolution. "dense" for a full convolution, "separable" for a depthwise 3x3 followed by a 1x1 convolution,
+                "spectral" for a 1x1 convolution that reduces the bands to filters followed by a 3x3 convolution. Blocks that widen the channels have nothing to reduce and use the full convolution
+        """
         super(conv_module, self).__init__()
-        self.conv_layer = nn.Conv2d(in_channels, out_channels=filters, kernel_size = (3,3), padding="same") 
+        if block not in ["dense", "separable", "spectral"]:
+            raise ValueError("Unknown block {}, choose from 'dense', 'separable' or 'spectral'".format(block))
+        if block == "spectral" and in_channels <= filters:
+            block = "dense"
+            
+        if block == "dense":
+            self.conv_layer = nn.Conv2d(in_channels, out_channels=filters, kernel_size = (3,3), padding="same") 
+        elif block == "separable":
+            self.conv_layer = nn.Sequential(
+                nn.Conv2d(in_channels, out_channels=in_channels, kernel_size=(3,3), padding="same", groups=in_channels),
+                nn.Conv2d(in_channels, out_channels=filters, kernel_size=1))
+        elif block == "spectral":
+            self.conv_layer = nn.Sequential(
+                nn.Conv2d(in_channels, out_channels=filters, kernel_size=1),
+                nn.Conv2d(filters, out_channels=filters, kernel_size=(3,3), padding="same"))
         self.bn1 = nn.BatchNorm2d(filters)                    
         self.maxpool_kernal = maxpool_kernel
         if maxpool_kernel:
@@ -34,11 +52,11 @@ class vanilla_CNN(Module):
     """
     A baseline model without spectral convolutions or spatial/spectral attention 
     """
-    def __init__(self, bands, classes):
+    def __init__(self, bands, classes, block="dense"):
         super(vanilla_CNN, self).__init__()
-        self.conv1 = conv_module(in_channels=bands, filters=32)
-        self.conv2 = conv_module(in_channels=32, filters=64, maxpool_kernel=(2,2))
-        self.conv3 = conv_module(in_channels=64, filters=128, maxpool_kernel=(2,2)) 
+        self.conv1 = conv_module(in_channels=bands, filters=32, block=block)
+        self.conv2 = conv_module(in_channels=32, filters=64, maxpool_kernel=(2,2), block=block)
+        self.conv3 = conv_module(in_channels=64, filters=128, maxpool_kernel=(2,2), block=block) 
         # The size of the fully connected layer Assumes a certain band convo, TODO make this flexible by band number.
         self.fc1 = nn.Linear(in_features=512,out_features=classes)
     
@@ -90,8 +108,8 @@ class spatial_attention(Module):
         self.class_pool = nn.MaxPool2d(pool_size)
         self.fc1 = nn.Linear(in_features=in_features, out_features=classes)
         
-    def forward(self, x):
-        """Calculate attention and class scores for batch"""
+    def forward(self, x, classify=True):
+        """Calculate attention and class scores for batch, class scores are None if classify is False"""
         #Global pooling and add dimensions to keep the same shape
         pooled_features = self.channel_pool(x)
         pooled_features = F.relu(pooled_features)
@@ -104,6 +122,8 @@ class spatial_attention(Module):
         
         #Add dummy dimension to make the shapes the same
         attention = torch.mul(x, attention)
+        if not classify:
+            return attention, None
         
         # Classification Head
         pooled_attention_features = self.class_pool(attention)
@@ -138,8 +158,8 @@ class spectral_attention(Module):
         #TODO Does this pool size change base on in_features?
         self.fc1 = nn.Linear(in_features=filters, out_features=classes)
         
-    def forward(self, x):
-        """Calculate attention and class scores for batch"""
+    def forward(self, x, classify=True):
+        """Calculate attention and class scores for batch, class scores are None if classify is False"""
         #Global pooling and add dimensions to keep the same shape
         pooled_features = global_spectral_pool(x)
         
@@ -152,6 +172,8 @@ class spectral_attention(Module):
         #Add dummy dimension to make the shapes the same
         attention = attention.unsqueeze(-1)
         attention = torch.mul(x, attention)
+        if not classify:
+            return attention, None
         
         # Classification Head
         pooled_attention_features = global_spectral_pool(attention)
@@ -165,71 +187,227 @@ class spatial_network(Module):
     """
         Learn spatial features with alternating convolutional and attention pooling layers
     """
-    def __init__(self, bands, classes):
+    def __init__(self, bands, classes, shared_stem=False, block="dense"):
         super(spatial_network, self).__init__()
         
-        #First submodel is 32 filters
-        self.conv1 = conv_module(in_channels=bands, filters=32)
+        #First submodel is 32 filters, computed once by Hang2020 when the stem is shared
+        if shared_stem:
+            self.conv1 = nn.Identity()
+        else:
+            self.conv1 = conv_module(in_channels=bands, filters=32, block=block)
         self.attention_1 = spatial_attention(filters=32, classes = classes)
     
-        self.conv2 = conv_module(in_channels=32, filters=64, maxpool_kernel=(2,2))
+        self.conv2 = conv_module(in_channels=32, filters=64, maxpool_kernel=(2,2), block=block)
         self.attention_2 = spatial_attention(filters=64, classes = classes)
     
-        self.conv3 = conv_module(in_channels=64, filters=128, maxpool_kernel=(2,2))
+        self.conv3 = conv_module(in_channels=64, filters=128, maxpool_kernel=(2,2), block=block)
         self.attention_3 = spatial_attention(filters=128, classes = classes)
+        
+        #Classification heads computed by forward, "all" for the three attention layers or "final" for the last layer only
+        self.heads = "all"
     
     def forward(self, x):
-        """The forward method is written for training the joint scores of the three attention layers"""
+        """The forward method is written for training the joint scores of the three attention layers. Heads that are not computed are None, see self.heads"""
+        intermediate_heads = self.heads == "all"
         x = self.conv1(x)
-        x, scores1 = self.attention_1(x)
+        x, scores1 = self.attention_1(x, classify=intermediate_heads)
         x = self.conv2(x, pool = True)
-        x, scores2 = self.attention_2(x)
+        x, scores2 = self.attention_2(x, classify=intermediate_heads)
         x = self.conv3(x, pool = True)        
         x, scores3 = self.attention_3(x)
         
         return [scores1,scores2,scores3]
     
+    def stage(self, x, index):
+        """Run a single conv and attention layer, index 0 to 2, for staged prediction. Returns the attention features and class scores"""
+        if index == 0:
+            x = self.conv1(x)
+            return self.attention_1(x)
+        elif index == 1:
+            x = self.conv2(x, pool = True)
+            return self.attention_2(x)
+        else:
+            x = self.conv3(x, pool = True)
+            return self.attention_3(x)
+    
 class spectral_network(Module):
     """
         Learn spectral features with alternating convolutional and attention pooling layers
     """
-    def __init__(self, bands, classes):
+    def __init__(self, bands, classes, shared_stem=False, block="dense"):
         super(spectral_network, self).__init__()
         
-        #First submodel is 32 filters
-        self.conv1 = conv_module(in_channels=bands, filters=32)
+        #First submodel is 32 filters, computed once by Hang2020 when the stem is shared
+        if shared_stem:
+            self.conv1 = nn.Identity()
+        else:
+            self.conv1 = conv_module(in_channels=bands, filters=32, block=block)
         self.attention_1 = spectral_attention(filters=32, classes = classes)
     
-        self.conv2 = conv_module(in_channels=32, filters=64, maxpool_kernel=(2,2))
+        self.conv2 = conv_module(in_channels=32, filters=64, maxpool_kernel=(2,2), block=block)
         self.attention_2 = spectral_attention(filters=64, classes = classes)
     
-        self.conv3 = conv_module(in_channels=64, filters=128, maxpool_kernel=(2,2))
+        self.conv3 = conv_module(in_channels=64, filters=128, maxpool_kernel=(2,2), block=block)
         self.attention_3 = spectral_attention(filters=128, classes = classes)
+        
+        #Classification heads computed by forward, "all" for the three attention layers or "final" for the last layer only
+        self.heads = "all"
     
     def forward(self, x):
-        """The forward method is written for training the joint scores of the three attention layers"""
+        """The forward method is written for training the joint scores of the three attention layers. Heads that are not computed are None, see self.heads"""
+        intermediate_heads = self.heads == "all"
         x = self.conv1(x)
-        x, scores1 = self.attention_1(x)
+        x, scores1 = self.attention_1(x, classify=intermediate_heads)
         x = self.conv2(x, pool = True)
-        x, scores2 = self.attention_2(x)
+        x, scores2 = self.attention_2(x, classify=intermediate_heads)
         x = self.conv3(x, pool = True)        
         x, scores3 = self.attention_3(x)
         
         return [scores1,scores2,scores3]
+    
+    def stage(self, x, index):
+        """Run a single conv and attention layer, index 0 to 2, for staged prediction. Returns the attention features and class scores"""
+        if index == 0:
+            x = self.conv1(x)
+            return self.attention_1(x)
+        elif index == 1:
+            x = self.conv2(x, pool = True)
+            return self.attention_2(x)
+        else:
+            x = self.conv3(x, pool = True)
+            return self.attention_3(x)
+        
+class band_reduction(Module):
+    """A 1x1 convolution that projects all bands to a small number of learned bands before the spectral and spatial networks"""
+    def __init__(self, bands, reduced_bands):
+        super(band_reduction, self).__init__()
+        self.conv_layer = nn.Conv2d(bands, out_channels=reduced_bands, kernel_size=1)
+        self.bn1 = nn.BatchNorm2d(reduced_bands)
+        
+    def forward(self, x):
+        x = self.conv_layer(x)
+        x = self.bn1(x)
+        x = F.relu(x)
         
+        return x
+    
 class Hang2020(Module):
-    def __init__(self, bands, classes):
+    """Joint spectral and spatial attention networks
+    Args:
+        bands: number of input bands
+        classes: number of classes
+        stem: first layer over all bands. None gives each network its own conv block, "shared" computes a single conv block used by both networks, 
+            "reduce" projects the bands to reduced_bands with a 1x1 convolution before the separate conv blocks of each network
+        reduced_bands: number of output bands of the "reduce" stem
+        deep_supervision: compute the intermediate attention heads in training mode and keep them in self.intermediate_scores for an auxiliary loss. 
+            Otherwise, and always in eval mode, only the final heads are computed
+        block: convolution of each conv block, see conv_module
+    """
+    def __init__(self, bands, classes, stem=None, reduced_bands=32, deep_supervision=False, block="dense"):
         super(Hang2020, self).__init__()    
-        self.spectral_network = spectral_network(bands, classes)
-        self.spatial_network = spatial_network(bands, classes)
+        self.stem_type = stem
+        self.deep_supervision = deep_supervision
+        self.intermediate_scores = []
+        if stem is None:
+            self.stem = nn.Identity()
+            network_bands = bands
+        elif stem == "shared":
+            self.stem = conv_module(in_channels=bands, filters=32, block=block)
+            network_bands = 32
+        elif stem == "reduce":
+            self.stem = band_reduction(bands, reduced_bands)
+            network_bands = reduced_bands
+        else:
+            raise ValueError("Unknown stem {}, choose from None, 'shared' or 'reduce'".format(stem))
+        
+        self.spectral_network = spectral_network(network_bands, classes, shared_stem=stem == "shared", block=block)
+        self.spatial_network = spatial_network(network_bands, classes, shared_stem=stem == "shared", block=block)
         
         #Learnable weight
-        self.alpha = nn.Parameter(torch.tensor(0.5, dtype=float), requires_grad=True)
+        self.alpha = nn.Parameter(torch.tensor(0.5, dtype=torch.float), requires_grad=True)
+        
+        self.train()
+    
+    def set_heads(self, heads):
+        """Select the classification heads of the spectral and spatial networks, "all" or "final" """
+        if heads not in ["all", "final"]:
+            raise ValueError("Unknown heads {}, choose from 'all' or 'final'".format(heads))
+        self.spectral_network.heads = heads
+        self.spatial_network.heads = heads
+        
+    def train(self, mode=True):
+        """Switch training mode and the heads computed by forward"""
+        super(Hang2020, self).train(mode)
+        if mode and self.deep_supervision:
+            self.set_heads("all")
+        else:
+            self.set_heads("final")
+        
+        return self
+        
+    def stage_scores(self, x):
+        """Joint class scores of the three attention layers, the last matches forward. Intermediate heads are only trained with deep_supervision
+        Returns:
+            scores: list of three (N, classes) tensors
+        """
+        x = self.stem(x)
+        weighted_average = torch.sigmoid(self.alpha)
+        spectral_x, spatial_x = x, x
+        scores = []
+        for index in range(3):
+            spectral_x, spectral_scores = self.spectral_network.stage(spectral_x, index)
+            spatial_x, spatial_scores = self.spatial_network.stage(spatial_x, index)
+            scores.append(spectral_scores * weighted_average + spatial_scores * (1-weighted_average))
+        
+        return scores
+    
+    def forward_early_exit(self, x, thresholds):
+        """Stop at the first attention layer whose softmax confidence reaches its threshold, crowns that exit are not passed to later layers
+        Args:
+            x: batch of images
+            thresholds: confidence thresholds of the first two attention layers, see early_exit.calibrate
+        Returns:
+            scores: (N, classes) joint class scores of the exit layer
+            exit_stages: (N,) index of the exit layer, 0 to 2
+        """
+        x = self.stem(x)
+        weighted_average = torch.sigmoid(self.alpha)
+        remaining = torch.arange(x.shape[0], device=x.device)
+        exit_stages = torch.full((x.shape[0],), 2, dtype=torch.long, device=x.device)
+        spectral_x, spatial_x = x, x
+        scores = None
+        for index in range(3):
+            spectral_x, spectral_scores = self.spectral_network.stage(spectral_x, index)
+            spatial_x, spatial_scores = self.spatial_network.stage(spatial_x, index)
+            joint_score = spectral_scores * weighted_average + spatial_scores * (1-weighted_average)
+            if scores is None:
+                scores = torch.zeros(x.shape[0], joint_score.shape[1], dtype=joint_score.dtype, device=x.device)
+            if index == 2:
+                scores[remaining] = joint_score
+                break
+            
+            confidence = F.softmax(joint_score, dim=1).max(dim=1).values
+            exits = confidence >= thresholds[index]
+            scores[remaining[exits]] = joint_score[exits]
+            exit_stages[remaining[exits]] = index
+            
+            #Continue with the remaining crowns
+            remaining = remaining[~exits]
+            spectral_x = spectral_x[~exits]
+            spatial_x = spatial_x[~exits]
+            if remaining.shape[0] == 0:
+                break
+        
+        return scores, exit_stages
         
     def forward(self, x):
+        x = self.stem(x)
         spectral_scores = self.spectral_network(x)
         spatial_scores = self.spatial_network(x)
         
+        #Intermediate heads for the auxiliary loss
+        self.intermediate_scores = [score for score in spectral_scores[:-1] + spatial_scores[:-1] if score is not None]
+        
         #Take the final attention scores
         spectral_classes = spectral_scores[-1]
         spatial_classes = spatial_scores[-1]
@@ -239,5 +417,3 @@ class Hang2020(Module):
         joint_score = spectral_classes * self.weighted_average + spatial_classes * (1-self.weighted_average)
         
         return joint_score
-        
-    
@@ -0,0 +1,111 @@
+#Knowledge distillation of a trained model into a per pixel spectral student
+from src import main
+from torch.nn import Module
+from torch.nn import functional as F
+from torch import nn
+import torch
+
+class spectral_student(Module):
+    """A small MLP on the spectrum of the center pixels of a crop, fast enough to run on every pixel of a tile
+    Args:
+        bands: number of input bands
+        classes: number of classes
+        neighbourhood: width of the center window averaged into a single spectrum, 1 for the center pixel
+        hidden: width of the hidden layers
+    """
+    def __init__(self, bands, classes, neighbourhood=1, hidden=64):
+        super(spectral_student, self).__init__()
+        self.neighbourhood = neighbourhood
+        self.fc1 = nn.Linear(in_features=bands, out_features=hidden)
+        self.bn1 = nn.BatchNorm1d(hidden)
+        self.fc2 = nn.Linear(in_features=hidden, out_features=hidden)
+        self.fc3 = nn.Linear(in_features=hidden, out_features=classes)
+
+    def center_spectra(self, x):
+        """Average the center neighbourhood of a batch of crops into one spectrum per crop"""
+        height, width = x.shape[2], x.shape[3]
+        top = (height - self.neighbourhood) // 2
+        left = (width - self.neighbourhood) // 2
+        window = x[:, :, top:top + self.neighbourhood, left:left + self.neighbourhood]
+
+        return torch.mean(window, dim=(2,3))
+
+    def forward_spectra(self, x):
+        """Class scores for a batch of spectra of shape (N, bands)"""
+        x = self.fc1(x)
+        x = self.bn1(x)
+        x = F.relu(x)
+        x = self.fc2(x)
+        x = F.relu(x)
+        x = self.fc3(x)
+
+        return x
+
+    def forward(self, x):
+        """Class scores for a batch of crops, as yielded by data.TreeDataset"""
+        return self.forward_spectra(self.center_spectra(x))
+
+    def predict_pixels(self, image):
+        """Class scores of every pixel of a preprocessed (bands, height, width) image, see data.preprocess_image
+        Returns:
+            scores: (classes, height, width) tensor
+        """
+        bands, height, width = image.shape
+        spectra = image.reshape(bands, height * width).T
+        scores = self.forward_spectra(spectra)
+
+        return scores.T.reshape(-1, height, width)
+
+class DistillationModel(main.TreeModel):
+    """Train a student network on the soft predictions of a trained teacher and the labels. Validation and prediction use the student
+    Args:
+        model: student network, for example spectral_student
+        teacher: a trained main.TreeModel or subclass, it is frozen
+        temperature: softmax temperature of the soft targets, defaults to config["distill_temperature"]
+        alpha: weight of the soft target loss, the label loss is weighted 1 - alpha. Defaults to config["distill_alpha"]
+    """
+    def __init__(self, model, teacher, classes, label_dict, config, temperature=None, alpha=None):
+        super(DistillationModel, self).__init__(model=model, classes=classes, label_dict=label_dict, config=config)
+        self.teacher = teacher
+        for parameter in self.teacher.parameters():
+            parameter.requires_grad = False
+        self.teacher.eval()
+
+        if temperature is None:
+            temperature = self.config["distill_temperature"]
+        if alpha is None:
+            alpha = self.config["distill_alpha"]
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def train(self, mode=True):
+        """Switch training mode of the student, the teacher always stays in eval mode"""
+        super(DistillationModel, self).train(mode)
+        self.teacher.eval()
+
+        return self
+
+    def save_model(self, path):
+        """Save the student as a main.TreeModel, see main.load_model"""
+        student = main.TreeModel(model=self.model, classes=self.classes, label_dict=self.label_to_index, config=self.config)
+        student.save_model(path)
+
+    def distillation_loss(self, y_hat, teacher_probs, y):
+        """Temperature scaled KL divergence to the teacher and cross entropy to the labels"""
+        soft_targets = F.softmax(torch.log(teacher_probs + 1e-8) / self.temperature, dim=1)
+        soft_loss = F.kl_div(F.log_softmax(y_hat / self.temperature, dim=1), soft_targets, reduction="batchmean")
+        hard_loss = F.cross_entropy(y_hat, y)
+
+        return self.alpha * self.temperature ** 2 * soft_loss + (1 - self.alpha) * hard_loss
+
+    def training_step(self, batch, batch_idx):
+        """Train the student on a loaded dataset
+        """
+        individual, inputs, y = batch
+        with torch.no_grad():
+            teacher_probs = self.teacher.predict_proba(inputs)
+        with self.autocast():
+            y_hat = self.model.forward(inputs["HSI"])
+        loss = self.distillation_loss(y_hat.float(), teacher_probs, y)
+
+        return loss
@@ -23,18 +23,72 @@ class metadata(Module):
         return x
     
 class metadata_sensor_fusion(Module):
-    """A joint fusion model of HSI sensor data and metadata"""
-    def __init__(self, bands, sites, classes):
+    """A joint fusion model of HSI sensor data and metadata. In eval mode the metadata branch depends only on the site, 
+    it is computed once for all sites and looked up, see precompute
+    Args:
+        stem: first layer of the sensor model, see Hang2020
+        deep_supervision: train the intermediate heads of the sensor model, see Hang2020
+        block: convolution of each conv block of the sensor model, see conv_module
+    """
+    def __init__(self, bands, sites, classes, stem=None, deep_supervision=False, block="dense"):
         super(metadata_sensor_fusion,self).__init__()   
         
+        self.sites = sites
         self.metadata_model = metadata(sites, classes)
-        self.sensor_model = Hang2020(bands, classes)
+        self.sensor_model = Hang2020(bands, classes, stem=stem, deep_supervision=deep_supervision, block=block)
                 
         #Fully connected concat learner
         self.fc1 = nn.Linear(in_features = classes * 2 , out_features = classes)
+        
+        #(sites, classes) output of the metadata branch, not saved with the weights
+        self.register_buffer("site_table", None, persistent=False)
+    
+    def precompute(self):
+        """Compute the metadata branch for every site in eval mode
+        Returns:
+            site_table: (sites, classes) tensor
+        """
+        training = self.metadata_model.training
+        self.metadata_model.eval()
+        with torch.no_grad():
+            sites = torch.arange(self.sites, device=self.fc1.weight.device)
+            self.site_table = self.metadata_model(sites)
+        self.metadata_model.train(training)
+        
+        return self.site_table
+    
+    def train(self, mode=True):
+        """Switch training mode, the site table is recomputed on the next eval forward pass"""
+        super(metadata_sensor_fusion, self).train(mode)
+        self.site_table = None
+        
+        return self
+    
+    def _load_from_state_dict(self, *args, **kwargs):
+        #New weights invalidate the site table
+        self.site_table = None
+        super(metadata_sensor_fusion, self)._load_from_state_dict(*args, **kwargs)
+    
+    def site_prior(self, sites):
+        """Class probabilities of the metadata branch for each site, without the image branch or the fusion layer
+        Args:
+            sites: site indices
+        Returns:
+            class_probs: (len(sites), classes) tensor
+        """
+        if self.site_table is None:
+            self.precompute()
+        metadata_scores = self.site_table[torch.as_tensor(sites, dtype=torch.long, device=self.site_table.device)]
+        
+        return F.softmax(metadata_scores, dim=1)
     
     def forward(self, images, metadata):
-        metadata_softmax = self.metadata_model(metadata)
+        if self.training:
+            metadata_softmax = self.metadata_model(metadata)
+        else:
+            if self.site_table is None:
+                self.precompute()
+            metadata_softmax = self.site_table[metadata.long()]
         sensor_softmax = self.sensor_model(images)
         concat_features = torch.cat([metadata_softmax, sensor_softmax], dim=1)
         concat_features = self.fc1(concat_features)
@@ -55,9 +109,10 @@ class MetadataModel(main.TreeModel):
         individual, inputs, y = batch
         images = inputs["HSI"]
         metadata = inputs["site"]
-        y_hat = self.model.forward(images, metadata)
+        with self.autocast():
+            y_hat = self.model.forward(images, metadata)
         
-        loss = F.cross_entropy(y_hat, y)    
+        loss = F.cross_entropy(y_hat.float(), y) + self.auxiliary_loss(y)
         
         return loss
     
@@ -69,21 +124,33 @@ class MetadataModel(main.TreeModel):
         images = inputs["HSI"]   
         metadata = inputs["site"]
         
-        y_hat = self.model.forward(images, metadata)
+        with self.autocast():
+            y_hat = self.model.forward(images, metadata)
+        y_hat = y_hat.float()
         loss = F.cross_entropy(y_hat, y)        
         
-        # Log loss and metrics
-        self.log("val_loss", loss, on_epoch=True)
+        # Log loss and metrics, metrics are accumulated over the epoch and synced between distributed processes
+        self.log("val_loss", loss, on_epoch=True, sync_dist=True)
         
         if not self.training:
             y_hat = F.softmax(y_hat, dim = 1)
             
-        output = self.metrics(y_hat, y) 
-        self.log_dict(output)
+        self.metrics.update(y_hat, y) 
+        self.log_dict(self.metrics, on_epoch=True)
         
         return loss
         
     def predict(self, inputs):
-        feature = self.model(inputs["HSI"], inputs["site"])
-        return F.softmax(feature, dim=1)
+        if self.config["early_exit_thresholds"]:
+            raise ValueError("early_exit_thresholds is not supported by metadata models, leave it blank")
+        images = inputs["HSI"]
+        if self.config["channels_last"]:
+            images = images.contiguous(memory_format=torch.channels_last)
+        with self.autocast():
+            feature = self.model(images, inputs["site"])
+        return F.softmax(feature.float(), dim=1)
+    
+    def predict_proba(self, inputs):
+        """predict already returns class probabilities"""
+        return self.predict(inputs)
     
\ No newline at end of file
@@ -22,17 +22,44 @@ def bounds_to_geoindex(bounds):
 
     return geoindex
 
+def sensor_index(lookup_pool):
+    """Index a pool of sensor paths by NEON geoindex to avoid scanning the pool for each lookup
+    Args:
+        lookup_pool: list of sensor paths, usually from glob
+    Returns:
+        index: dict of geoindex {easting}_{northing} -> sorted list of paths, accepted as lookup_pool by find_sensor_path
+    """
+    index = {}
+    for path in lookup_pool:
+        basename = os.path.basename(path)
+        for geo_index in set(re.findall("\d+000_\d+000", basename)):
+            index.setdefault(geo_index, []).append(path)
+    
+    for geo_index in index:
+        index[geo_index].sort()
+        
+    return index
+
+def match_geoindex(lookup_pool, geo_index):
+    """Find all paths matching a geoindex in a list of paths or a sensor_index"""
+    if isinstance(lookup_pool, dict):
+        match = list(lookup_pool.get(geo_index, []))
+    else:
+        match = [x for x in lookup_pool if geo_index in x]
+    
+    return match
+
 def find_sensor_path(lookup_pool, shapefile=None, bounds=None):
     """Find a hyperspec path based on the shapefile using NEONs schema
     Args:
         bounds: Optional: list of top, left, bottom, right bounds, usually from geopandas.total_bounds. Instead of providing a shapefile
-        lookup_pool: glob string to search for matching files for geoindex
+        lookup_pool: list of paths to search for matching files for geoindex, or a dict from sensor_index
     Returns:
         year_match: full path to sensor tile
     """
     if shapefile is None:
         geo_index = bounds_to_geoindex(bounds=bounds)
-        match = [x for x in lookup_pool if geo_index in x]
+        match = match_geoindex(lookup_pool, geo_index)
         match.sort()
         try:
             year_match = match[-1]
@@ -43,7 +70,7 @@ def find_sensor_path(lookup_pool, shapefile=None, bounds=None):
         #Get file metadata from name string
         basename = os.path.splitext(os.path.basename(shapefile))[0]
         geo_index = re.search("(\d+_\d+)_image", basename).group(1)
-        match = [x for x in lookup_pool if geo_index in x]
+        match = match_geoindex(lookup_pool, geo_index)
         match.sort()
         try:
             year_match = match[-1]
@@ -1,12 +1,47 @@
 #Patches
+from collections import OrderedDict
+import os
+import threading
 import rasterio
 
+#Maximum number of open raster handles kept by each thread, see open_raster
+MAX_OPEN_RASTERS = 16
+_handles = threading.local()
+
+def open_raster(path):
+    """Open a raster for reading and keep the handle for later calls from the same process and thread.
+    Least recently used handles are closed once more than MAX_OPEN_RASTERS are open. Do not close the returned handle."""
+    if getattr(_handles, "pid", None) != os.getpid():
+        #Handles are not shared with forked processes
+        _handles.pid = os.getpid()
+        _handles.rasters = OrderedDict()
+    
+    rasters = _handles.rasters
+    src = rasters.get(path)
+    if src is None or src.closed:
+        src = rasterio.open(path)
+        rasters[path] = src
+        if len(rasters) > MAX_OPEN_RASTERS:
+            oldest_path, oldest = rasters.popitem(last=False)
+            oldest.close()
+    else:
+        rasters.move_to_end(path)
+    
+    return src
+
+def close_rasters():
+    """Close all raster handles opened by this thread"""
+    rasters = getattr(_handles, "rasters", {})
+    for src in rasters.values():
+        src.close()
+    rasters.clear()
+    
 def crop(bounds, sensor_path, savedir = None, basename = None):
     """Given a 4 pointed bounding box, crop sensor data"""
     left, bottom, right, top = bounds 
     height = top - bottom
     width = right - left
-    src = rasterio.open(sensor_path)        
+    src = open_raster(sensor_path)        
     img = src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))    
     if savedir:
         filename = "{}/{}.tif".format(savedir, basename)
@@ -51,7 +86,7 @@ def bounds_to_pixel(bounds, img_path, savedir=None, basename=None,width=11, heig
     counter = 0
     filenames = []   
     crops = []
-    src = rasterio.open(img_path)    
+    src = open_raster(img_path)    
     img_centroids = row_col_from_bounds(bounds, src)
     for indices in img_centroids:
         row, col = indices
@@ -0,0 +1,272 @@
+#Tile scale prediction. Delineate every crown in an RGB tile with DeepForest and classify each crown from the matching hyperspectral tile.
+import glob
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import torch
+from torchvision import transforms
+from src import data
+from src import generate
+from src import neon_paths
+from src import patches
+
+def block_windows(width, height, block_size=400, overlap=100):
+    """Split a raster into overlapping blocks. Each block owns a non-overlapping core so that every crown is kept by a single block
+    Args:
+        width: raster width in pixels
+        height: raster height in pixels
+        block_size: size of the core of each block in pixels
+        overlap: pixels added to each side of the core, should be larger than half of the largest crown
+    Returns:
+        blocks: list of (rasterio window, core) where core is (col_min, row_min, col_max, row_max) in raster pixels
+    """
+    blocks = []
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            core = (col, row, min(col + block_size, width), min(row + block_size, height))
+            col_off = max(col - overlap, 0)
+            row_off = max(row - overlap, 0)
+            col_end = min(core[2] + overlap, width)
+            row_end = min(core[3] + overlap, height)
+            window = rasterio.windows.Window(col_off=col_off, row_off=row_off, width=col_end - col_off, height=row_end - row_off)
+            blocks.append((window, core))
+
+    return blocks
+
+def predict_tile_crowns(deepforest_model, rgb_path, block_size=400, overlap=100, batch_size=8):
+    """Predict all crowns in an RGB tile by streaming overlapping blocks through DeepForest. Only one batch of blocks is held in memory
+    Args:
+        deepforest_model: a deepforest model object used for prediction
+        rgb_path: full path to RGB tile
+        block_size: size of the core of each block in pixels, see block_windows
+        overlap: pixels shared with neighbouring blocks
+        batch_size: number of blocks per DeepForest forward pass
+    Returns:
+        crowns: geodataframe of utm boxes, None if no crowns were predicted
+    """
+    results = []
+    with rasterio.open(rgb_path) as src:
+        pixelSizeX, pixelSizeY = src.res
+        crs = src.crs
+        blocks = block_windows(src.width, src.height, block_size=block_size, overlap=overlap)
+        for index in range(0, len(blocks), batch_size):
+            batch = blocks[index:index + batch_size]
+            #roll to channels last
+            images = [np.rollaxis(src.read(window=window), 0, 3) for window, core in batch]
+            predictions = generate.predict_images(deepforest_model, images)
+            for (window, core), boxes in zip(batch, predictions):
+                if boxes is None:
+                    continue
+
+                #Keep boxes centered in the core of this block, neighbouring blocks own the rest
+                center_x = (boxes.xmin + boxes.xmax) / 2 + window.col_off
+                center_y = (boxes.ymin + boxes.ymax) / 2 + window.row_off
+                boxes = boxes[(center_x >= core[0]) & (center_x < core[2]) & (center_y >= core[1]) & (center_y < core[3])]
+                if boxes.empty:
+                    continue
+
+                left, top = src.transform * (window.col_off, window.row_off)
+                boxes = generate.boxes_to_utm(boxes.copy(), left=left, top=top, pixelSizeX=pixelSizeX, pixelSizeY=pixelSizeY)
+                results.append(boxes)
+
+    if len(results) == 0:
+        return None
+
+    crowns = gpd.GeoDataFrame(pd.concat(results, ignore_index=True), crs=crs)
+    crowns["box_id"] = np.arange(crowns.shape[0])
+
+    return crowns
+
+def load_crop(geom, sensor_path, image_size):
+    """Crop a crown from sensor data and preprocess it for the model, see data.load_image"""
+    crop = patches.crop(bounds=geom.bounds, sensor_path=sensor_path)
+    image = data.preprocess_image(crop, channel_is_first=True)
+    image = transforms.functional.resize(image, size=(image_size, image_size), interpolation=transforms.InterpolationMode.NEAREST)
+
+    return image
+
+def classify_crowns(model, crowns, sensor_path, batch_size=256):
+    """Classify crowns from a single sensor tile in batches
+    Args:
+        model: a main.TreeModel
+        crowns: geodataframe of crown geometries. A site column is passed to metadata models.
+        sensor_path: path to the hyperspectral tile
+        batch_size: number of crowns per forward pass
+    Returns:
+        results: dataframe with the crown index, label, score and one probability column per class. Crowns that could not be cropped have no label
+    """
+    model.eval()
+    class_columns = [model.index_to_label[x] for x in range(model.classes)]
+    results = []
+    for index in range(0, crowns.shape[0], batch_size):
+        batch = crowns.iloc[index:index + batch_size]
+        images = []
+        valid = []
+        for crown_index, geom in zip(batch.index, batch.geometry):
+            try:
+                images.append(load_crop(geom, sensor_path, image_size=model.config["image_size"]))
+                valid.append(crown_index)
+            except Exception as e:
+                print("Crown {} could not be cropped from {}: {}".format(crown_index, sensor_path, e))
+        if len(valid) == 0:
+            continue
+
+        inputs = {"HSI": torch.stack(images)}
+        if "site" in batch.columns:
+            inputs["site"] = torch.tensor(batch.loc[valid, "site"].values, dtype=torch.int)
+        with torch.no_grad():
+            class_probs = model.predict_proba(inputs).numpy()
+
+        result = pd.DataFrame(class_probs, columns=class_columns, index=valid)
+        result["label"] = [class_columns[x] for x in class_probs.argmax(1)]
+        result["score"] = class_probs.max(1)
+        results.append(result)
+
+    if len(results) == 0:
+        return pd.DataFrame(columns=class_columns + ["label", "score"])
+
+    results = pd.concat(results)
+
+    return results
+
+def predict_tile(model, rgb_path, HSI_path, savedir, deepforest_model=None, block_size=400, overlap=100, deepforest_batch_size=8, batch_size=256):
+    """Delineate and classify every crown in a tile and write a shapefile of crowns with taxonID, taxonScore and per class probabilities
+    Args:
+        model: a main.TreeModel
+        rgb_path: full path to RGB tile
+        HSI_path: full path to the hyperspectral .tif covering the same tile
+        savedir: directory to write {rgb basename}_species.shp
+        deepforest_model: optional deepforest model, defaults to the release model
+        block_size: see predict_tile_crowns
+        overlap: see predict_tile_crowns
+        deepforest_batch_size: number of RGB blocks per DeepForest forward pass
+        batch_size: number of crowns per classification forward pass
+    Returns:
+        filename: path to written shapefile, None if no crowns were predicted
+    """
+    if deepforest_model is None:
+        deepforest_model = generate.load_deepforest()
+
+    crowns = predict_tile_crowns(deepforest_model, rgb_path, block_size=block_size, overlap=overlap, batch_size=deepforest_batch_size)
+    if crowns is None:
+        print("No crowns predicted in {}".format(rgb_path))
+        return None
+
+    results = classify_crowns(model, crowns, sensor_path=HSI_path, batch_size=batch_size)
+    #DeepForest label and score columns describe the crown, taxonID and taxonScore the species
+    crowns = crowns.drop(columns=["xmin","xmax","ymin","ymax"]).join(results.rename(columns={"label":"taxonID", "score":"taxonScore"}))
+
+    basename = os.path.splitext(os.path.basename(rgb_path))[0]
+    filename = "{}/{}_species.shp".format(savedir, basename)
+    crowns.to_file(filename)
+
+    return filename
+
+def predict_tiles(model, rgb_paths, HSI_glob, savedir, **kwargs):
+    """Predict a list of RGB tiles, for example all tiles from a NEON site. Hyperspectral tiles are matched by geoindex
+    Args:
+        model: a main.TreeModel
+        rgb_paths: list of RGB tiles
+        HSI_glob: glob to search hyperspectral .tif files
+        savedir: directory to write outputs
+        **kwargs: passed to predict_tile
+    Returns:
+        filenames: list of written shapefiles
+    """
+    HSI_pool = neon_paths.sensor_index(glob.glob(HSI_glob, recursive=True))
+    filenames = []
+    for rgb_path in rgb_paths:
+        try:
+            with rasterio.open(rgb_path) as src:
+                bounds = src.bounds
+            HSI_path = neon_paths.find_sensor_path(lookup_pool=HSI_pool, bounds=bounds)
+            filename = predict_tile(model, rgb_path=rgb_path, HSI_path=HSI_path, savedir=savedir, **kwargs)
+        except Exception as e:
+            print("{} failed with {}".format(rgb_path, e))
+            continue
+        if filename is not None:
+            filenames.append(filename)
+
+    return filenames
+
+class Predictor():
+    """A long lived predictor for many x,y queries. Sensor indices and the DeepForest model are loaded once and raster handles are reused between calls
+    Args:
+        model: a main.TreeModel
+        deepforest_model: optional deepforest model, defaults to the release model shared by this process
+        expand: size in meters of the window predicted by DeepForest around each point
+        max_distance: maximum distance in meters between a point and the centroid of its crown
+    """
+    def __init__(self, model, deepforest_model=None, expand=40, max_distance=5):
+        self.model = model
+        self.config = model.config
+        self.expand = expand
+        self.max_distance = max_distance
+        if deepforest_model is None:
+            deepforest_model = generate.load_deepforest()
+        self.deepforest_model = deepforest_model
+        
+        #Build the indices up front so that queries do not glob
+        self.rgb_pool = model.sensor_index("rgb_sensor_pool")
+        model.sensor_index("HSI_sensor_pool")
+        self.model.eval()
+        
+    def find_crowns(self, points):
+        """Find the DeepForest crown closest to each point
+        Args:
+            points: geodataframe of utm points
+        Returns:
+            crowns: list of crown geometries in the order of points, None if no crown centroid is within max_distance
+        """
+        crowns = [None for x in range(points.shape[0])]
+        geo_index = [neon_paths.bounds_to_geoindex(x.bounds) for x in points.geometry]
+        for name, group in points.reset_index(drop=True).groupby(geo_index):
+            try:
+                rgb_path = neon_paths.find_sensor_path(lookup_pool=self.rgb_pool, bounds=group.geometry.iloc[0].bounds)
+            except Exception as e:
+                print("Cannot find RGB tile {}: {}".format(name, e))
+                continue
+            bounds = [x.bounds for x in group.geometry]
+            window_boxes = generate.predict_trees_batch(
+                deepforest_model=self.deepforest_model,
+                rgb_path=rgb_path,
+                bounds=bounds,
+                expand=self.expand,
+                batch_size=self.config["deepforest_batch_size"])
+            for index, point, boxes in zip(group.index, group.geometry, window_boxes):
+                if boxes is None:
+                    continue
+                distances = boxes.centroid.distance(point)
+                if distances.min() < self.max_distance:
+                    crowns[index] = boxes.geometry.loc[distances.idxmin()]
+        
+        return crowns
+        
+    def predict_points(self, coordinates, fixed_box=True):
+        """Predict the species of the tree at each x,y location
+        Args:
+            coordinates: sequence of x,y tuples or a (n, 2) array in utm coordinates
+            fixed_box: If no DeepForest tree is predicted within max_distance of a point, classify a 1m fixed box around the point. If False, the point has no prediction
+        Returns:
+            results: geodataframe of crowns with x, y, fixed_box, pred_taxa, score and one probability column per class
+        """
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+        points = gpd.GeoDataFrame({"x":coordinates[:,0], "y":coordinates[:,1]}, geometry=gpd.points_from_xy(coordinates[:,0], coordinates[:,1]))
+        crowns = self.find_crowns(points)
+        
+        points["fixed_box"] = [x is None for x in crowns]
+        fixed_boxes = points.buffer(1).envelope
+        geometry = [fixed_boxes.iloc[index] if crown is None else crown for index, crown in enumerate(crowns)]
+        crowns = gpd.GeoDataFrame(points[["x","y","fixed_box"]], geometry=geometry)
+        
+        if fixed_box:
+            results = self.model.predict_crowns(crowns)
+        else:
+            results = self.model.predict_crowns(crowns[~crowns.fixed_box])
+            results = crowns.drop(columns="geometry").join(results.drop(columns=["x","y","fixed_box"]))
+            results = gpd.GeoDataFrame(results, geometry=crowns.geometry)
+            
+        return results
+
@@ -0,0 +1,154 @@
+#Int8 post training quantization for cpu inference of the Hang2020 family
+import copy
+import time
+import numpy as np
+import torch
+from torch import nn
+from torch.quantization import quantize_fx
+from src.models import Hang2020
+from src.models import metadata
+
+def explicit_padding(model):
+    """Replace padding="same" with the equivalent integer padding, quantized convolutions require integer padding"""
+    for module in model.modules():
+        if isinstance(module, (nn.Conv1d, nn.Conv2d)) and module.padding == "same":
+            if any([x % 2 == 0 for x in module.kernel_size]):
+                raise ValueError("Cannot convert same padding of an even kernel {}".format(module.kernel_size))
+            module.padding = tuple([x // 2 for x in module.kernel_size])
+
+    return model
+
+def quantizable_networks(model):
+    """Find the convolutional networks to quantize statically
+    Args:
+        model: Hang2020, metadata_sensor_fusion or vanilla_CNN
+    Returns:
+        networks: list of (parent module, attribute name). The attention head weights and the metadata embedding stay in float
+    """
+    if isinstance(model, metadata.metadata_sensor_fusion):
+        return quantizable_networks(model.sensor_model)
+    elif isinstance(model, Hang2020.Hang2020):
+        networks = [(model, "spectral_network"), (model, "spatial_network")]
+        if len(list(model.stem.parameters())) > 0:
+            networks.append((model, "stem"))
+        return networks
+    elif isinstance(model, Hang2020.vanilla_CNN):
+        return [(None, None)]
+    else:
+        raise ValueError("Static quantization is not supported for {}".format(type(model).__name__))
+
+def qconfig_dict(network, backend="fbgemm"):
+    """FX quantization config of a network. The linear classification heads of the attention layers stay in float
+    Args:
+        network: a network returned by quantizable_networks
+        backend: see quantize_model
+    Returns:
+        qconfig_dict: dict for quantize_fx.prepare_fx
+    """
+    heads = [name for name, module in network.named_modules() if isinstance(module, (Hang2020.spatial_attention, Hang2020.spectral_attention))]
+    
+    return {
+        "": torch.quantization.get_default_qconfig(backend),
+        "module_name": [("{}.fc1".format(name), None) for name in heads]}
+
+def calibrate(model, data_loader, batches=10):
+    """Run training crops through a prepared model to record activation ranges"""
+    model.eval()
+    with torch.no_grad():
+        for index, batch in enumerate(data_loader):
+            if index == batches:
+                break
+            individual, inputs, targets = batch
+            if isinstance(model, metadata.metadata_sensor_fusion):
+                model(inputs["HSI"], inputs["site"])
+            else:
+                model(inputs["HSI"])
+
+def quantize_model(model, mode="static", data_loader=None, calibration_batches=10, backend="fbgemm"):
+    """Quantize a network to int8
+    Args:
+        model: Hang2020, metadata_sensor_fusion or vanilla_CNN, the network is copied
+        mode: "dynamic" quantizes the weights of linear layers only, which shrinks the classification heads but barely changes the speed of these convolutional networks.
+            "static" also quantizes convolutions and activations with ranges calibrated on data_loader
+        data_loader: loader of training crops, required for static quantization
+        calibration_batches: number of batches used for calibration
+        backend: quantized engine, fbgemm for x86 and qnnpack for arm. The global engine is restored afterwards, predict with torch.backends.quantized.engine set to the same backend
+    Returns:
+        quantized: quantized copy of the network in eval mode
+    """
+    if mode not in ["dynamic", "static"]:
+        raise ValueError("Unknown quantization mode {}, choose from 'dynamic' or 'static'".format(mode))
+    if mode == "static" and data_loader is None:
+        raise ValueError("Static quantization requires a data_loader of training crops for calibration")
+
+    previous_engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        quantized = copy.deepcopy(model)
+        quantized.eval()
+        if mode == "dynamic":
+            return torch.quantization.quantize_dynamic(quantized, {nn.Linear}, dtype=torch.qint8)
+
+        explicit_padding(quantized)
+        networks = quantizable_networks(quantized)
+        if networks == [(None, None)]:
+            quantized = quantize_fx.prepare_fx(quantized, qconfig_dict(quantized, backend=backend))
+        else:
+            for parent, name in networks:
+                network = getattr(parent, name)
+                setattr(parent, name, quantize_fx.prepare_fx(network, qconfig_dict(network, backend=backend)))
+
+        calibrate(quantized, data_loader, batches=calibration_batches)
+
+        if networks == [(None, None)]:
+            quantized = quantize_fx.convert_fx(quantized)
+        else:
+            for parent, name in networks:
+                setattr(parent, name, quantize_fx.convert_fx(getattr(parent, name)))
+        quantized.eval()
+    finally:
+        torch.backends.quantized.engine = previous_engine
+
+    return quantized
+
+def quantize(m, mode="static", data_loader=None, calibration_batches=10, backend="fbgemm"):
+    """Quantize a TreeModel for cpu prediction
+    Args:
+        m: a main.TreeModel or subclass
+        mode: see quantize_model
+        data_loader: loader of training crops, for example TreeData.train_dataloader()
+        calibration_batches: number of batches used for calibration
+        backend: see quantize_model
+    Returns:
+        quantized_m: a new module of the same class with a quantized network. All prediction methods, for example predict_crowns and predict_dataloader, can be used on cpu
+    """
+    model = quantize_model(m.model, mode=mode, data_loader=data_loader, calibration_batches=calibration_batches, backend=backend)
+    quantized_m = type(m)(model=model, classes=m.classes, label_dict=m.label_to_index, config=m.config)
+    quantized_m.eval()
+
+    return quantized_m
+
+def report(m, quantized_m, data_loader, repeat=3):
+    """Compare accuracy and speed of a float and a quantized model on labeled crops
+    Args:
+        m: a main.TreeModel
+        quantized_m: see quantize
+        data_loader: labeled loader, for example TreeData.val_dataloader()
+        repeat: the fastest of repeat passes is timed
+    Returns:
+        results: dict of accuracy, quantized_accuracy, accuracy_delta, seconds, quantized_seconds and speedup
+    """
+    results = {}
+    for name, model in [("", m), ("quantized_", quantized_m)]:
+        times = []
+        for x in range(repeat):
+            start = time.perf_counter()
+            df = model.predict_dataloader(data_loader)
+            times.append(time.perf_counter() - start)
+        results["{}accuracy".format(name)] = np.mean(df.pred_label.values == df.label.values)
+        results["{}seconds".format(name)] = min(times)
+
+    results["accuracy_delta"] = results["quantized_accuracy"] - results["accuracy"]
+    results["speedup"] = results["seconds"] / results["quantized_seconds"]
+
+    return results
@@ -0,0 +1,60 @@
+#Lean inference runtime for models written by export.py. Only torch and numpy are imported so that workers start quickly
+import json
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+class ExportedModel():
+    """A TorchScript model with its labels
+    Args:
+        path: path to a file written by export.export
+        threads: optional number of torch threads
+    """
+    def __init__(self, path, threads=None):
+        if threads is not None:
+            torch.set_num_threads(threads)
+        extra_files = {"metadata.json": ""}
+        self.model = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+        self.model.eval()
+        metadata = json.loads(extra_files["metadata.json"])
+        self.labels = metadata["labels"]
+        self.image_size = metadata["image_size"]
+        self.bands = metadata["bands"]
+        self.metadata = metadata["metadata"]
+
+    def stack(self, crops):
+        """Resize raw crops of different sizes to the model input size and batch them. The nearest resize commutes with the per pixel standardization of the model"""
+        images = []
+        for crop in crops:
+            image = torch.as_tensor(np.asarray(crop, dtype="float32")).unsqueeze(0)
+            image = F.interpolate(image, size=(self.image_size, self.image_size), mode="nearest")
+            images.append(image)
+
+        return torch.cat(images)
+
+    def predict_proba(self, crops, sites=None):
+        """Class probabilities for a list of raw channels first crops
+        Args:
+            crops: list of (bands, height, width) arrays
+            sites: site index of each crop, required by metadata models
+        Returns:
+            class_probs: (crops, classes) array in the order of labels
+        """
+        images = self.stack(crops)
+        with torch.no_grad():
+            if self.metadata:
+                if sites is None:
+                    raise ValueError("This model requires the site of each crop")
+                class_probs = self.model(images, torch.as_tensor(sites, dtype=torch.long))
+            else:
+                class_probs = self.model(images)
+
+        return class_probs.numpy()
+
+    def predict(self, crops, sites=None):
+        """Label and score of the most likely class for a list of raw crops"""
+        class_probs = self.predict_proba(crops, sites=sites)
+        labels = [self.labels[x] for x in class_probs.argmax(1)]
+        scores = class_probs.max(1)
+
+        return labels, scores
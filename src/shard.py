@@ -0,0 +1,168 @@
+#Sharded cpu inference. Split crowns, crops or tiles across worker processes that each load the model once and use a fixed number of torch threads
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+import rasterio
+import shutil
+import tempfile
+import torch
+from src import data
+from src import main
+from src import neon_paths
+from src import predict
+
+#Model loaded once per worker process, see init_worker
+_model = None
+
+def init_worker(model_path, threads):
+    """Limit torch threads and load the model for all tasks of this process"""
+    global _model
+    torch.set_num_threads(threads)
+    _model = main.load_model(model_path)
+
+def default_workers(threads):
+    """Number of worker processes that fill the machine when each uses threads cores"""
+    return max(os.cpu_count() // threads, 1)
+
+def create_executor(model_path, workers, threads):
+    """Start a process pool of model workers. Workers are spawned rather than forked, forking after torch has started its thread pool can deadlock"""
+    context = multiprocessing.get_context("spawn")
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(model_path, threads))
+
+    return executor
+
+def split_crowns(gdf, shards):
+    """Split crowns into shards of contiguous sensor tiles so that each tile is opened by as few workers as possible
+    Args:
+        gdf: geodataframe of crowns
+        shards: number of shards
+    Returns:
+        shards: list of arrays of row positions in gdf
+    """
+    geo_index = np.array([neon_paths.bounds_to_geoindex(x.bounds) for x in gdf.geometry])
+    order = np.argsort(geo_index, kind="stable")
+    shards = [x for x in np.array_split(order, shards) if len(x) > 0]
+
+    return shards
+
+def predict_crowns_shard(crowns):
+    return _model.predict_crowns(crowns)
+
+def predict_csv_shard(csv_file):
+    metadata = hasattr(_model.model, "metadata_model")
+    ds = data.TreeDataset(csv_file=csv_file, config=_model.config, metadata=metadata)
+    data_loader = torch.utils.data.DataLoader(ds, batch_size=_model.config["batch_size"], shuffle=False, num_workers=0, collate_fn=data.collate_fn(_model.config))
+    
+    return _model.predict_dataloader(data_loader)
+
+def predict_tile_shard(rgb_path, HSI_path, savedir, kwargs):
+    return predict.predict_tile(_model, rgb_path=rgb_path, HSI_path=HSI_path, savedir=savedir, **kwargs)
+
+def predict_crowns(model_path, gdf, workers=None, threads=1, shards_per_worker=4):
+    """Predict crowns in parallel, see main.TreeModel.predict_crowns
+    Args:
+        model_path: path to a model written by main.TreeModel.save_model
+        gdf: geodataframe of crown geometries in utm
+        workers: number of worker processes, defaults to the number of cores divided by threads
+        threads: torch threads per worker
+        shards_per_worker: more shards than workers balance tiles with many crowns
+    Returns:
+        gdf: copy of gdf with pred_taxa, score and one probability column per class, in the order of the input
+    """
+    if gdf.empty:
+        return main.load_model(model_path).predict_crowns(gdf)
+    
+    if workers is None:
+        workers = default_workers(threads)
+
+    shards = split_crowns(gdf, shards=workers * shards_per_worker)
+    with create_executor(model_path, workers=workers, threads=threads) as executor:
+        futures = [executor.submit(predict_crowns_shard, gdf.iloc[x]) for x in shards]
+        results = [future.result() for future in futures]
+
+    #Restore input order
+    results = pd.concat(results)
+    results = results.iloc[np.argsort(np.concatenate(shards), kind="stable")]
+
+    return results
+
+def predict_dataloader(model_path, csv_file, workers=None, threads=1, shards_per_worker=4):
+    """Predict labeled crops in parallel, see main.TreeModel.predict_dataloader. Diagnostics are not rendered
+    Args:
+        model_path: path to a model written by main.TreeModel.save_model
+        csv_file: csv of crops with image_path, label and, for metadata models, site columns, see data.TreeDataset
+        workers: number of worker processes, defaults to the number of cores divided by threads
+        threads: torch threads per worker
+        shards_per_worker: more shards than workers balance slow shards
+    Returns:
+        df: predictions with pred_label, label, individual, pred_taxa and true_taxa in the order of csv_file
+    """
+    annotations = pd.read_csv(csv_file)
+    if annotations.empty:
+        return pd.DataFrame(columns=["pred_label", "label", "individual", "pred_taxa", "true_taxa"])
+    
+    if workers is None:
+        workers = default_workers(threads)
+    
+    #Contiguous shards keep the input order when results are concatenated
+    savedir = tempfile.mkdtemp()
+    shard_files = []
+    for index, rows in enumerate(np.array_split(np.arange(annotations.shape[0]), workers * shards_per_worker)):
+        if len(rows) == 0:
+            continue
+        shard_file = "{}/shard_{}.csv".format(savedir, index)
+        annotations.iloc[rows].to_csv(shard_file, index=False)
+        shard_files.append(shard_file)
+    
+    try:
+        with create_executor(model_path, workers=workers, threads=threads) as executor:
+            futures = [executor.submit(predict_csv_shard, x) for x in shard_files]
+            results = [future.result() for future in futures]
+    finally:
+        shutil.rmtree(savedir)
+    
+    return pd.concat(results, ignore_index=True)
+
+def predict_tiles(model_path, rgb_paths, HSI_glob, savedir, workers=None, threads=1, **kwargs):
+    """Predict tiles in parallel, one tile per task, see predict.predict_tile
+    Args:
+        model_path: path to a model written by main.TreeModel.save_model
+        rgb_paths: list of RGB tiles
+        HSI_glob: glob to search hyperspectral .tif files
+        savedir: directory to write outputs
+        workers: number of worker processes, defaults to the number of cores divided by threads
+        threads: torch threads per worker
+        **kwargs: passed to predict.predict_tile
+    Returns:
+        filenames: list of written shapefiles in the order of rgb_paths
+    """
+    if workers is None:
+        workers = default_workers(threads)
+
+    HSI_pool = neon_paths.sensor_index(glob.glob(HSI_glob, recursive=True))
+    futures = []
+    with create_executor(model_path, workers=workers, threads=threads) as executor:
+        for rgb_path in rgb_paths:
+            try:
+                with rasterio.open(rgb_path) as src:
+                    bounds = src.bounds
+                HSI_path = neon_paths.find_sensor_path(lookup_pool=HSI_pool, bounds=bounds)
+            except Exception as e:
+                print("{} failed with {}".format(rgb_path, e))
+                continue
+            futures.append((rgb_path, executor.submit(predict_tile_shard, rgb_path, HSI_path, savedir, kwargs)))
+
+        filenames = []
+        for rgb_path, future in futures:
+            try:
+                filename = future.result()
+            except Exception as e:
+                print("{} failed with {}".format(rgb_path, e))
+                continue
+            if filename is not None:
+                filenames.append(filename)
+
+    return filenames
@@ -6,8 +6,9 @@ import sys
 import socket
 import subprocess
 from dask_jobqueue import SLURMCluster
-from dask.distributed import Client
+from dask.distributed import Client, LocalCluster, WorkerPlugin
 import gc
+import os
 
 def collect():
     gc.collect()
@@ -97,4 +98,61 @@ def start(cpus=0, gpus=0, mem_size="10GB"):
     #Start dask
     dask_client.run_on_scheduler(start_tunnel)
 
-    return dask_client
\ No newline at end of file
+    return dask_client
+
+def set_threads(threads):
+    """Limit torch intra-op threads so that local workers do not oversubscribe the machine"""
+    import torch
+    torch.set_num_threads(threads)
+
+class ThreadLimit(WorkerPlugin):
+    """Apply set_threads on every worker, including workers restarted by a nanny after the plugin was registered"""
+    def __init__(self, threads):
+        self.threads = threads
+    
+    def setup(self, worker):
+        set_threads(self.threads)
+    
+def start_local(workers=None, threads_per_worker=1, mem_size=None):
+    """Start a dask cluster of worker processes on this machine. Each worker keeps its own DeepForest model and raster handles.
+    Workers are started with spawn or forkserver and import the calling script, so scripts must call this from an if __name__ == "__main__" guard, see train.py
+    Args:
+        workers: number of worker processes, defaults to the number of cores divided by threads_per_worker
+        threads_per_worker: threads for each worker, also used as the torch thread count
+        mem_size: memory limit per worker, for example "10GB". Defaults to an even share of system memory
+    Returns:
+        dask_client: a dask client connected to the local cluster
+    """
+    if workers is None:
+        workers = max(1, os.cpu_count() // threads_per_worker)
+    if mem_size is None:
+        mem_size = "auto"
+        
+    cluster = LocalCluster(n_workers=workers,
+                           threads_per_worker=threads_per_worker,
+                           processes=True,
+                           memory_limit=mem_size,
+                           dashboard_address=":8781")
+    dask_client = Client(cluster)
+    dask_client.register_worker_plugin(ThreadLimit(threads_per_worker))
+    
+    return dask_client
+
+def start_from_config(config):
+    """Create a dask client from the cluster section of the config
+    Args:
+        config: DeepTreeAttention config dict, see config.yml
+    Returns:
+        dask_client: a dask client, or None if config["cluster"] is blank and data generation should run serially
+    """
+    if config["cluster"] is None:
+        return None
+    elif config["cluster"] == "local":
+        return start_local(workers=config["cluster_workers"], threads_per_worker=config["cluster_threads"], mem_size=config["cluster_memory"])
+    elif config["cluster"] == "slurm":
+        if not config["cluster_workers"]:
+            raise ValueError("cluster_workers must be set to the number of SLURM workers to request for cluster: slurm")
+        mem_size = config["cluster_memory"] or "10GB"
+        return start(cpus=config["cluster_workers"], mem_size=mem_size)
+    else:
+        raise ValueError("Unknown cluster {}, choose local, slurm or leave blank".format(config["cluster"]))
@@ -0,0 +1,128 @@
+#Prediction diagnostics. Draw predicted crowns and field stems on RGB imagery in worker processes with a non-interactive backend
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import matplotlib
+import rasterio
+from src import neon_paths
+from src import patches
+
+#Crown and stem tables loaded once per worker process, see init_worker
+_crowns = None
+_points = None
+
+def set_tables(crowns, points):
+    """Keep the crown and point tables for all tasks of this process"""
+    global _crowns, _points
+    _crowns = crowns.drop_duplicates("individual").set_index("individual").geometry
+    _points = points
+
+def init_worker(crowns, points):
+    """Set a non-interactive backend in a worker process, see set_tables"""
+    matplotlib.use("Agg")
+    set_tables(crowns, points)
+
+def plot_individuals(rows, img_path, savedir):
+    """Draw a set of crowns from the same RGB tile
+    Args:
+        rows: list of (individual, true_taxa, pred_taxa)
+        img_path: RGB tile containing the crowns
+        savedir: directory to save {individual}.png
+    Returns:
+        images: list of (filename, image name)
+    """
+    from matplotlib import pyplot as plt
+    from matplotlib.collections import PatchCollection
+    from descartes import PolygonPatch
+    from rasterio.plot import show
+
+    src = patches.open_raster(img_path)
+    images = []
+    for individual, true_taxa, pred_taxa in rows:
+        geom = _crowns.loc[individual]
+        left, bottom, right, top = geom.bounds
+        window = rasterio.windows.from_bounds(left-10, bottom-10, right+10, top+10, transform=src.transform)
+        img = src.read(window=window)
+        img_transform = src.window_transform(window=window)
+
+        #Plot crown
+        fig, ax = plt.subplots()
+        show(img, ax=ax, transform=img_transform)
+        ax.add_collection(PatchCollection([PolygonPatch(geom, edgecolor='red', facecolor='none')], match_original=True))
+
+        #Plot field coordinate
+        stem = _points[_points.individual == individual]
+        stem.plot(ax=ax)
+
+        filename = "{}/{}.png".format(savedir, individual)
+        fig.savefig(filename)
+        plt.close(fig)
+        images.append((filename, "crown: {}, True: {}, Predicted {}".format(individual, true_taxa, pred_taxa)))
+
+    return images
+
+def render_predictions(df, crowns, points, rgb_pool, savedir, experiment=None, workers=None, chunk_size=20):
+    """Render prediction diagnostics in parallel and optionally upload them to comet
+    Args:
+        df: predictions with individual, true_taxa and pred_taxa columns, see main.TreeModel.predict_dataloader
+        crowns: geodataframe of crowns with an individual column
+        points: geodataframe of field stems with an individual column
+        rgb_pool: list of RGB paths or a neon_paths.sensor_index
+        savedir: directory to save images
+        experiment: optional comet experiment, each finished chunk of images is uploaded together
+        workers: number of worker processes, defaults to the number of cores. 0 renders in this process. Workers are spawned and import the calling script, which must use an if __name__ == "__main__" guard
+        chunk_size: maximum number of crowns drawn by a single task, crowns in a chunk share an RGB tile
+    Returns:
+        images: list of (filename, image name)
+    """
+    if isinstance(rgb_pool, list):
+        rgb_pool = neon_paths.sensor_index(rgb_pool)
+
+    #Group crowns by RGB tile so that each task opens a single tile
+    crown_geoms = crowns.drop_duplicates("individual").set_index("individual").geometry
+    tiles = {}
+    for row in df.itertuples():
+        if row.individual not in crown_geoms.index:
+            print("No crown for individual {}, skipping".format(row.individual))
+            continue
+        try:
+            img_path = neon_paths.find_sensor_path(lookup_pool=rgb_pool, bounds=crown_geoms.loc[row.individual].bounds)
+        except Exception as e:
+            print("No RGB tile for individual {}: {}".format(row.individual, e))
+            continue
+        tiles.setdefault(img_path, []).append((row.individual, row.true_taxa, row.pred_taxa))
+
+    chunks = []
+    for img_path, rows in tiles.items():
+        for index in range(0, len(rows), chunk_size):
+            chunks.append((rows[index:index + chunk_size], img_path))
+
+    images = []
+    if workers == 0:
+        #Draw with the backend of the calling session
+        set_tables(crowns, points)
+        for rows, img_path in chunks:
+            chunk_images = plot_individuals(rows, img_path, savedir)
+            log_images(experiment, chunk_images)
+            images.extend(chunk_images)
+    else:
+        #Spawn rather than fork the training process, which already runs torch and logging threads, see shard.create_executor
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(crowns, points)) as executor:
+            futures = [executor.submit(plot_individuals, rows, img_path, savedir) for rows, img_path in chunks]
+            for future in as_completed(futures):
+                try:
+                    chunk_images = future.result()
+                except Exception as e:
+                    print("Rendering failed with {}".format(e))
+                    continue
+                log_images(experiment, chunk_images)
+                images.extend(chunk_images)
+
+    return images
+
+def log_images(experiment, images):
+    """Upload a batch of rendered images to a comet experiment"""
+    if experiment is None:
+        return
+    for filename, name in images:
+        experiment.log_image(filename, name=name)
@@ -0,0 +1,75 @@
+#Test CHM
+from src import CHM
+from src import start_cluster
+import geopandas as gpd
+import numpy as np
+import os
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+
+@pytest.fixture()
+def CHM_pool(tmpdir):
+    """A small synthetic CHM tile named in the NEON schema"""
+    path = "{}/NEON_D01_HARV_DP3_726000_4699000_CHM.tif".format(tmpdir)
+    heights = np.full((100, 100), 20, dtype="float32")
+    transform = from_origin(726000, 4699100, 1, 1)
+    with rasterio.open(path, "w", driver="GTiff", height=100, width=100, count=1, dtype="float32", crs="EPSG:32618", transform=transform) as dst:
+        dst.write(heights, 1)
+
+    return "{}/*.tif".format(tmpdir)
+
+@pytest.fixture()
+def shp():
+    geometry = [Point(726010, 4699010).buffer(2), Point(726050, 4699050).buffer(2)]
+    shp = gpd.GeoDataFrame({"individualID":["a","b"],"plotID":["HARV_001","HARV_001"],"height":[18, None]}, geometry=geometry)
+
+    return shp
+
+def test_CHM_height(CHM_pool, shp):
+    result = CHM.CHM_height(shp, CHM_pool)
+    assert all(result.CHM_height == 20)
+    assert result.height.iloc[1] == 20
+
+def test_CHM_height_cache(CHM_pool, shp, tmpdir, monkeypatch):
+    cache_path = "{}/CHM_cache.csv".format(tmpdir)
+    result = CHM.CHM_height(shp, CHM_pool, cache_path=cache_path)
+    assert os.path.exists(cache_path)
+    assert len(CHM.read_cache(cache_path)) == 2
+
+    #Second pass should not touch the raster
+    def fail(*args, **kwargs):
+        raise AssertionError("zonal_stats called for a cached record")
+    monkeypatch.setattr(CHM.rasterstats, "zonal_stats", fail)
+    cached_result = CHM.CHM_height(shp, CHM_pool, cache_path=cache_path)
+    assert all(cached_result.CHM_height == result.CHM_height)
+
+def test_CHM_height_cache_miss(CHM_pool, shp, tmpdir):
+    cache_path = "{}/CHM_cache.csv".format(tmpdir)
+    CHM.CHM_height(shp, CHM_pool, cache_path=cache_path)
+
+    #A moved stem is a new key
+    shp.loc[0, "geometry"] = Point(726020, 4699020).buffer(2)
+    CHM.CHM_height(shp, CHM_pool, cache_path=cache_path)
+    assert len(CHM.read_cache(cache_path)) == 3
+
+def test_read_cache_mtime(CHM_pool, shp, tmpdir):
+    cache_path = "{}/CHM_cache.csv".format(tmpdir)
+    CHM.CHM_height(shp, CHM_pool, cache_path=cache_path)
+    
+    #Modification times are exact integers after the csv round trip
+    cache = CHM.read_cache(cache_path)
+    CHM_path = list(cache.keys())[0][2]
+    assert all([key[3] == os.stat(CHM_path).st_mtime_ns for key in cache])
+
+def test_CHM_height_client(CHM_pool, shp, tmpdir):
+    client = start_cluster.start_local(workers=2)
+    cache_path = "{}/CHM_cache.csv".format(tmpdir)
+    try:
+        result = CHM.CHM_height(shp, CHM_pool, cache_path=cache_path, client=client)
+    finally:
+        client.close()
+    
+    assert all(result.CHM_height == 20)
+    assert len(CHM.read_cache(cache_path)) == 2
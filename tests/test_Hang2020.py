@@ -17,6 +17,21 @@ def test_conv_module_maxpooling():
     output = m(image, pool = True)
     assert output.shape == (20,64,5,5)
 
+@pytest.mark.parametrize("block",["separable","spectral"])
+def test_conv_module_block(block):
+    m = Hang2020.conv_module(in_channels=369, filters=32, maxpool_kernel=(2,2), block=block)
+    image = torch.randn(20, 369, 11, 11)
+    output = m(image, pool = True)
+    assert output.shape == (20,32,5,5)
+    
+    #The factorized blocks are smaller than the dense 3x3 convolution across all bands
+    dense = Hang2020.conv_module(in_channels=369, filters=32)
+    assert sum([x.numel() for x in m.parameters()]) < sum([x.numel() for x in dense.parameters()])
+
+def test_conv_module_unknown_block():
+    with pytest.raises(ValueError):
+        Hang2020.conv_module(in_channels=369, filters=32, block="winograd")
+
 @pytest.mark.parametrize("conv_dimension",[(20,32,11,11),(20,64,5,5),(20,128,2,2)])
 def test_spatial_attention(conv_dimension):
     """Check spectral attention for each convoutional dimension"""
@@ -63,4 +78,82 @@ def test_Hang2020():
     m = Hang2020.Hang2020(bands=3, classes=10)
     image = torch.randn(20, 3, 11, 11)
     output = m(image)
-    assert output.shape == (20,10)    
\ No newline at end of file
+    assert output.shape == (20,10)    
+
+@pytest.mark.parametrize("stem",["shared","reduce"])
+def test_Hang2020_stem(stem):
+    m = Hang2020.Hang2020(bands=369, classes=10, stem=stem)
+    image = torch.randn(20, 369, 11, 11)
+    output = m(image)
+    assert output.shape == (20,10)
+    
+    #The stem replaces the full band convolution of both networks
+    baseline = Hang2020.Hang2020(bands=369, classes=10)
+    assert sum([x.numel() for x in m.parameters()]) < sum([x.numel() for x in baseline.parameters()])
+
+@pytest.mark.parametrize("block",["separable","spectral"])
+def test_Hang2020_block(block):
+    image = torch.randn(20, 369, 11, 11)
+    for network in [Hang2020.Hang2020, Hang2020.vanilla_CNN]:
+        m = network(bands=369, classes=10, block=block)
+        output = m(image)
+        assert output.shape == (20,10)
+        
+        #The whole network is smaller than with dense blocks
+        dense = network(bands=369, classes=10)
+        assert sum([x.numel() for x in m.parameters()]) < sum([x.numel() for x in dense.parameters()])
+
+def test_conv_module_spectral_widening():
+    #Widening blocks have no bands to reduce and keep the full convolution
+    m = Hang2020.conv_module(in_channels=32, filters=64, block="spectral")
+    assert isinstance(m.conv_layer, torch.nn.Conv2d)
+
+def test_Hang2020_heads():
+    m = Hang2020.Hang2020(bands=3, classes=10)
+    image = torch.randn(20, 3, 11, 11)
+    
+    #Without deep supervision only the final heads are computed
+    m(image)
+    assert m.spectral_network.heads == "final"
+    assert m.intermediate_scores == []
+    output = m.spectral_network(image)
+    assert output[0] is None
+    assert output[-1].shape == (20,10)
+    
+def test_Hang2020_deep_supervision():
+    m = Hang2020.Hang2020(bands=3, classes=10, deep_supervision=True)
+    image = torch.randn(20, 3, 11, 11)
+    m(image)
+    assert len(m.intermediate_scores) == 4
+    assert m.intermediate_scores[0].shape == (20,10)
+    
+    m.eval()
+    m(image)
+    assert m.spatial_network.heads == "final"
+    assert m.intermediate_scores == []
+
+def test_Hang2020_stage_scores():
+    m = Hang2020.Hang2020(bands=3, classes=10)
+    m.eval()
+    image = torch.randn(20, 3, 11, 11)
+    with torch.no_grad():
+        scores = m.stage_scores(image)
+        assert len(scores) == 3
+        assert torch.allclose(scores[-1], m(image), atol=1e-6)
+
+def test_Hang2020_forward_early_exit():
+    m = Hang2020.Hang2020(bands=3, classes=10)
+    m.eval()
+    image = torch.randn(20, 3, 11, 11)
+    with torch.no_grad():
+        stage_scores = m.stage_scores(image)
+        
+        #Every crown exits at the first layer
+        scores, exit_stages = m.forward_early_exit(image, thresholds=[0, 0])
+        assert all(exit_stages == 0)
+        assert torch.allclose(scores, stage_scores[0], atol=1e-6)
+        
+        #No crown exits early
+        scores, exit_stages = m.forward_early_exit(image, thresholds=[1.01, 1.01])
+        assert all(exit_stages == 2)
+        assert torch.allclose(scores, m(image), atol=1e-6)
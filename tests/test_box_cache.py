@@ -0,0 +1,55 @@
+#Test DeepForest prediction cache
+from src import box_cache
+import geopandas as gpd
+import glob
+import os
+import types
+from shapely.geometry import box
+
+ROOT = os.path.dirname(os.path.dirname(box_cache.__file__))
+rgb_path = "{}/tests/data/2019_D01_HARV_DP3_726000_4699000_image_crop.tif".format(ROOT)
+
+def boxes():
+    return gpd.GeoDataFrame({"score":[0.5, 0.6], "label":"Tree", "box_id":[0, 1]}, geometry=[box(0,0,1,1), box(1,1,2,2)])
+
+def test_cache_key():
+    key = box_cache.cache_key(rgb_path, bounds=[0, 0, 10, 10], expand=40, release="1.0")
+    assert key == box_cache.cache_key(rgb_path, bounds=[0, 0, 10, 10], expand=40, release="1.0")
+    assert key != box_cache.cache_key(rgb_path, bounds=[0, 0, 10, 10], expand=40, release="1.1")
+    assert key != box_cache.cache_key(rgb_path, bounds=[0, 0, 10, 10], expand=20, release="1.0")
+
+def test_release_version(tmpdir):
+    #Releases are written to the same file name, the version follows the weights
+    weights = "{}/NEON.pt".format(tmpdir)
+    with open(weights, "wb") as f:
+        f.write(b"first release")
+    deepforest_model = types.SimpleNamespace(release_state_dict=weights)
+    first = box_cache.release_version(deepforest_model)
+    assert first == box_cache.release_version(deepforest_model)
+    
+    with open(weights, "wb") as f:
+        f.write(b"second release weights")
+    assert box_cache.release_version(deepforest_model) != first
+    assert box_cache.release_version(types.SimpleNamespace()) is None
+
+def test_read_write(tmpdir):
+    hit, cached = box_cache.read(tmpdir, "a")
+    assert not hit
+    
+    box_cache.write(tmpdir, "a", boxes())
+    hit, cached = box_cache.read(tmpdir, "a")
+    assert hit
+    assert cached.shape[0] == 2
+    
+    #Windows without trees are cached too
+    box_cache.write(tmpdir, "b", None)
+    hit, cached = box_cache.read(tmpdir, "b")
+    assert hit
+    assert cached is None
+
+def test_evict(tmpdir):
+    for key in ["a", "b", "c"]:
+        box_cache.write(tmpdir, key, boxes())
+    size = os.path.getsize("{}/a.parquet".format(tmpdir))
+    box_cache.evict(tmpdir, max_size=(size * 2) / 1e9)
+    assert len(glob.glob("{}/*.parquet".format(tmpdir))) == 2
@@ -1,9 +1,11 @@
 #Test data module
 from src import data
+from src import start_cluster
 import pytest
 import pandas as pd
 import tempfile
 import numpy as np
+import torch
 
 import os
 ROOT = os.path.dirname(os.path.dirname(data.__file__))
@@ -57,6 +59,41 @@ def test_TreeDataset(dm, config,tmpdir):
     
     assert len(data_loader) == annotations.shape[0]
     
+def test_channels_last_collate(config):
+    ds = data.TreeDataset(csv_file="{}/tests/data/processed/train.csv".format(ROOT), config=config)
+    individuals, inputs, labels = data.channels_last_collate([ds[0], ds[1]])
+    assert inputs["HSI"].shape == (2, 3, config["image_size"], config["image_size"])
+    assert inputs["HSI"].is_contiguous(memory_format=torch.channels_last)
+    assert labels.shape == (2,)
+    
+def test_DistributedWeightedSampler():
+    dataset = list(range(10))
+    weights = [0] * 5 + [1] * 5
+    samplers = [data.DistributedWeightedSampler(dataset, weights=weights, num_replicas=2, rank=rank) for rank in range(2)]
+    indices = [list(x) for x in samplers]
+    
+    #Each process draws half of the epoch from the weighted distribution
+    assert all([len(x) == 5 for x in indices])
+    assert all([x >= 5 for x in indices[0] + indices[1]])
+    
+    #A new epoch gives a new sample
+    samplers[0].set_epoch(1)
+    assert len(list(samplers[0])) == 5
+    
+def test_train_test_split_client(config, tmpdir):
+    shp = pd.DataFrame({"plotID":np.repeat(np.arange(20), 4), "taxonID":np.tile(["A","B"], 40), "siteID":"HARV"})
+    split_config = dict(config, iterations=5, min_samples=0, test_fraction=0.3)
+    train, test = data.train_test_split(shp, savedir=tmpdir, config=split_config)
+    
+    #Workers draw the same splits as a serial run
+    client = start_cluster.start_local(workers=2)
+    try:
+        client_train, client_test = data.train_test_split(shp, savedir=tmpdir, config=split_config, client=client)
+    finally:
+        client.close()
+    
+    assert sorted(test.plotID.unique()) == sorted(client_test.plotID.unique())
+    
 def test_resample(config, dm, tmpdir):
     #Set to a smaller number to ensure easy calculation
     data_loader = dm.train_dataloader()
@@ -0,0 +1,77 @@
+#Test distillation
+from src import data
+from src import main
+from src.models import Hang2020
+from src.models import distill
+import os
+import pytest
+import tempfile
+import torch
+from pytorch_lightning import Trainer
+
+ROOT = os.path.dirname(os.path.dirname(data.__file__))
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+@pytest.fixture(scope="session")
+def config():
+    #Turn of CHM filtering for the moment
+    config = data.read_config(config_path="{}/config.yml".format(ROOT))
+    config["min_CHM_height"] = None
+    config["iterations"] = 1
+    config["rgb_sensor_pool"] = "{}/tests/data/*.tif".format(ROOT)
+    config["HSI_sensor_pool"] = "{}/tests/data/*.tif".format(ROOT)
+    config["min_samples"] = 1
+    config["crop_dir"] = tempfile.gettempdir()
+    config["bands"] = 3
+    config["classes"] = 2
+    config["top_k"] = 1
+    config["convert_h5"] = False
+    
+    return config
+
+#Data module
+@pytest.fixture(scope="session")
+def dm(config):
+    csv_file = "{}/tests/data/sample_neon.csv".format(ROOT)           
+    if not "GITHUB_ACTIONS" in os.environ:
+        regen = False
+    else:
+        regen = True
+    
+    dm = data.TreeData(config=config, csv_file=csv_file, regenerate=regen, data_dir="{}/tests/data".format(ROOT)) 
+    dm.setup()    
+    
+    return dm
+
+@pytest.mark.parametrize("neighbourhood",[1, 3])
+def test_spectral_student(neighbourhood):
+    m = distill.spectral_student(bands=369, classes=10, neighbourhood=neighbourhood)
+    image = torch.randn(20, 369, 11, 11)
+    output = m(image)
+    assert output.shape == (20,10)
+    
+def test_predict_pixels():
+    m = distill.spectral_student(bands=369, classes=10)
+    m.eval()
+    image = torch.randn(369, 11, 11)
+    scores = m.predict_pixels(image)
+    assert scores.shape == (10, 11, 11)
+    
+    #The center pixel matches the crop prediction
+    assert torch.allclose(scores[:, 5, 5], m(image.unsqueeze(0))[0], atol=1e-5)
+
+def test_DistillationModel(config, dm, tmpdir):
+    teacher = main.TreeModel(model=Hang2020.vanilla_CNN(bands=3, classes=2), classes=2, label_dict=dm.species_label_dict, config=config)
+    student = distill.spectral_student(bands=3, classes=2)
+    m = distill.DistillationModel(model=student, teacher=teacher, classes=2, label_dict=dm.species_label_dict, config=config)
+    trainer = Trainer(fast_dev_run=True)
+    trainer.fit(m, datamodule=dm)
+    
+    #Teacher is frozen and stays in eval mode
+    assert not teacher.training
+    assert not any([x.requires_grad for x in teacher.parameters()])
+    
+    #The student is saved as a TreeModel
+    m.save_model("{}/student.pt".format(tmpdir))
+    loaded = main.load_model("{}/student.pt".format(tmpdir))
+    assert isinstance(loaded.model, distill.spectral_student)
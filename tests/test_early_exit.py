@@ -0,0 +1,53 @@
+#Test early exit prediction
+from src import early_exit
+from src import quantize
+from src.models import Hang2020
+import os
+import pytest
+import torch
+
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+@pytest.fixture()
+def data_loader():
+    """Batches in the TreeDataset format"""
+    batches = []
+    for x in range(3):
+        batches.append((["a"] * 8, {"HSI":torch.randn(8, 3, 11, 11)}, torch.randint(0, 2, (8,))))
+    
+    return batches
+
+def test_calibrate(data_loader):
+    m = Hang2020.Hang2020(bands=3, classes=2, deep_supervision=True)
+    thresholds = early_exit.calibrate(m, data_loader, max_accuracy_drop=0.01)
+    assert len(thresholds) == 2
+    
+    #Any accuracy is accepted, every crown can exit at the lowest confidence of the first layer
+    thresholds = early_exit.calibrate(m, data_loader, max_accuracy_drop=1)
+    assert thresholds[0] <= 1
+
+def test_calibrate_accuracy_drop(data_loader):
+    #The whole cascade stays within the tolerated drop
+    m = Hang2020.Hang2020(bands=3, classes=2, deep_supervision=True)
+    thresholds = early_exit.calibrate(m, data_loader, max_accuracy_drop=0.05)
+    results = early_exit.report(m, data_loader, thresholds=thresholds, repeat=1)
+    assert results["early_exit_accuracy"] >= results["accuracy"] - 0.05 - 1e-6
+
+def test_report(data_loader):
+    m = Hang2020.Hang2020(bands=3, classes=2)
+    results = early_exit.report(m, data_loader, thresholds=[0, 0], repeat=1)
+    assert results["exit_distribution"][0] == 1
+    
+    results = early_exit.report(m, data_loader, thresholds=[1.01, 1.01], repeat=1)
+    assert results["exit_distribution"][2] == 1
+    assert results["early_exit_accuracy"] == results["accuracy"]
+
+def test_can_exit_early(data_loader):
+    assert not early_exit.can_exit_early(Hang2020.Hang2020(bands=3, classes=2))
+    assert not early_exit.can_exit_early(Hang2020.vanilla_CNN(bands=3, classes=2))
+    m = Hang2020.Hang2020(bands=3, classes=2, deep_supervision=True)
+    assert early_exit.can_exit_early(m)
+    
+    #Quantized networks are graph modules without stages
+    quantized = quantize.quantize_model(m, mode="static", data_loader=data_loader)
+    assert not early_exit.can_exit_early(quantized)
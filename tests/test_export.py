@@ -0,0 +1,63 @@
+#Test export and the lean runtime
+from src import data
+from src import export
+from src import main
+from src import runtime
+from src.models import Hang2020
+from src.models import metadata
+import numpy as np
+import os
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(data.__file__))
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+@pytest.fixture(scope="session")
+def config():
+    config = data.read_config(config_path="{}/config.yml".format(ROOT))
+    config["bands"] = 3
+    config["classes"] = 2
+    config["top_k"] = 1
+    
+    return config
+
+@pytest.fixture()
+def m(config):
+    model = Hang2020.Hang2020(bands=3, classes=2)
+    m = main.TreeModel(model=model, classes=2, config=config, label_dict={"ACRU":0,"BELE":1})
+    
+    return m
+
+@pytest.fixture()
+def metadata_m(config):
+    model = metadata.metadata_sensor_fusion(bands=3, sites=2, classes=2)
+    m = metadata.MetadataModel(model=model, classes=2, config=config, label_dict={"ACRU":0,"BELE":1})
+    
+    return m
+
+def test_export(m, tmpdir):
+    path = export.export(m, "{}/model.pt".format(tmpdir))
+    exported = runtime.ExportedModel(path)
+    assert exported.labels == ["ACRU","BELE"]
+    
+    #Crops of different sizes
+    crops = [np.random.randint(0, 10000, size=(3, x, x)) for x in [8, 11, 15]]
+    class_probs = exported.predict_proba(crops)
+    expected = np.concatenate([export.eager_predict(m, torch.tensor(x, dtype=torch.float32).unsqueeze(0)).numpy() for x in crops])
+    np.testing.assert_allclose(class_probs, expected, atol=1e-5)
+    
+    labels, scores = exported.predict(crops)
+    assert all([x in ["ACRU","BELE"] for x in labels])
+
+def test_export_metadata(metadata_m, tmpdir):
+    path = export.export(metadata_m, "{}/model.pt".format(tmpdir))
+    exported = runtime.ExportedModel(path)
+    assert exported.metadata
+    
+    crops = [np.random.randint(0, 10000, size=(3, 11, 11)) for x in range(4)]
+    class_probs = exported.predict_proba(crops, sites=[0, 1, 1, 0])
+    assert class_probs.shape == (4, 2)
+    
+    with pytest.raises(ValueError):
+        exported.predict_proba(crops)
@@ -1,8 +1,11 @@
 #Test generate
 from src import generate
 import glob
+import numpy as np
 import geopandas as gpd
 import pandas as pd
+import pytest
+from shapely.geometry import Point, box
 from deepforest import main
 import os
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
@@ -78,4 +81,80 @@ def test_generate_crops(tmpdir):
         convert_h5=False, sensor_glob="{}/tests/data/*.tif".format(ROOT), savedir=tmpdir, label_dict={"ACRU":0,"BELE":1}, site_dict={"HARV":0})
     
     assert not annotations.empty
-    assert all([x in ["image_path","label","site"] for x in annotations.columns])
\ No newline at end of file
+    assert all([x in ["image_path","label","site"] for x in annotations.columns])
+
+def test_load_deepforest():
+    m = generate.load_deepforest()
+    assert generate.load_deepforest() is m
+
+def test_predict_trees_batch():
+    m = generate.load_deepforest()
+    bounds = [plot_data.total_bounds, plot_data.total_bounds + np.array([20, 20, 20, 20])]
+    batch_boxes = generate.predict_trees_batch(deepforest_model=m, rgb_path=rgb_path, bounds=bounds, batch_size=2)
+    assert len(batch_boxes) == 2
+    
+    #Each window matches the unbatched prediction box for box
+    for window, window_boxes in zip(bounds, batch_boxes):
+        boxes = generate.predict_trees(deepforest_model=m, rgb_path=rgb_path, bounds=window)
+        assert window_boxes.shape[0] == boxes.shape[0]
+        for column in ["xmin", "ymin", "xmax", "ymax"]:
+            assert np.array_equal(window_boxes[column].values.astype(float), boxes[column].values.astype(float))
+        assert window_boxes.score.values.astype(float) == pytest.approx(boxes.score.values.astype(float), rel=1e-5)
+        assert list(window_boxes.label) == list(boxes.label)
+        assert all(window_boxes.geometry.geom_equals(boxes.geometry))
+    
+def test_run_tile(tmpdir):
+    df = gpd.read_file(data_path)
+    plots = list(df.plotID.unique())
+    results = generate.run_tile(rgb_path=rgb_path, plots=plots, df=df, savedir=tmpdir, raw_box_savedir=None)
+    
+    assert len(results) > 0
+    assert len(glob.glob("{}/*.shp".format(tmpdir))) > 0
+
+def test_generate_crops_chunks(tmpdir):
+    data_path = "{}/tests/data/crown.shp".format(ROOT)
+    gdf = gpd.read_file(data_path)
+    chunks = generate.chunk_crowns(gdf, chunk_size=1)
+    assert len(chunks) == gdf.shape[0]
+    
+    annotations = generate.generate_crops(
+        gdf=gdf, rgb_glob="{}/tests/data/*.tif".format(ROOT),
+        convert_h5=False, sensor_glob="{}/tests/data/*.tif".format(ROOT), savedir=tmpdir, label_dict={"ACRU":0,"BELE":1}, site_dict={"HARV":0}, chunk_size=1)
+    
+    assert not annotations.empty
+
+def test_match_boxes():
+    points = gpd.GeoDataFrame({"individual":["a","b","c"], "height":[10, 20, 5], "plotID":"HARV_001"},
+                              geometry=[Point(0.5, 0.5), Point(0.7, 0.7), Point(10, 10)])
+    #Two boxes contain a and b, a third box further from the stems overlaps both
+    boxes = gpd.GeoDataFrame({"xmin":[0,0,0.5], "ymin":[0,0,0.5], "xmax":[1,3,10.5], "ymax":[1,3,10.5], "score":[0.9,0.8,0.7], "label":"Tree", "box_id":[0,1,2]},
+                             geometry=[box(0,0,1,1), box(0,0,3,3), box(0.5,0.5,10.5,10.5)])
+    merged_boxes = generate.match_boxes(boxes, points)
+    
+    #a and b share their closest box, the tallest point is kept
+    assert merged_boxes.box_id.is_unique
+    assert "b" in merged_boxes.individual.values
+    assert "a" not in merged_boxes.individual.values
+    assert merged_boxes[merged_boxes.individual == "c"].box_id.iloc[0] == 2
+
+def test_box_geometry():
+    geometry = generate.box_geometry(xmin=[0, 1], ymin=[0, 1], xmax=[1, 3], ymax=[2, 4])
+    assert len(geometry) == 2
+    assert geometry[1].equals(box(1, 1, 3, 4))
+    
+def test_create_boxes():
+    fixed_boxes = generate.create_boxes(plot_data)
+    assert fixed_boxes.box_id.str.startswith("fixed_box_").all()
+
+def test_predict_trees_cache(tmpdir, monkeypatch):
+    m = generate.load_deepforest()
+    boxes = generate.predict_trees(deepforest_model=m, rgb_path=rgb_path, bounds=plot_data.total_bounds, cache_dir=tmpdir)
+    
+    #Cached windows do not run the model
+    def fail(*args, **kwargs):
+        raise AssertionError("DeepForest called for a cached window")
+    monkeypatch.setattr(m, "predict_image", fail)
+    monkeypatch.setattr(generate, "predict_images", fail)
+    
+    cached_boxes = generate.predict_trees(deepforest_model=m, rgb_path=rgb_path, bounds=plot_data.total_bounds, cache_dir=tmpdir)
+    assert cached_boxes.shape[0] == boxes.shape[0]
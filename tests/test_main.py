@@ -8,6 +8,7 @@ import pytest
 import pandas as pd
 from pytorch_lightning import Trainer
 import tempfile
+import torch
 
 ROOT = os.path.dirname(os.path.dirname(data.__file__))
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
@@ -68,6 +69,22 @@ def test_fit(config, m, dm):
     trainer = Trainer(fast_dev_run=True)
     trainer.fit(m,datamodule=dm)
     
+def test_fit_ddp_cpu(config, dm):
+    ddp_config = config.copy()
+    ddp_config["accelerator"] = "ddp_cpu"
+    ddp_config["num_processes"] = 2
+    ddp_config["epochs"] = 1
+    ddp_config["fast_dev_run"] = False
+    model = Hang2020.vanilla_CNN(bands=3, classes=2)
+    m = main.TreeModel(model=model, classes=2, config=ddp_config, label_dict=dm.species_label_dict)
+    before = [x.detach().clone() for x in m.model.parameters()]
+    trainer = main.build_trainer(ddp_config, limit_train_batches=2, limit_val_batches=1)
+    trainer.fit(m, datamodule=dm)
+    
+    #The trained weights are returned from the spawned processes
+    assert trainer.is_global_zero
+    assert any([not torch.equal(x, y) for x, y in zip(before, m.model.parameters())])
+
 def test_predict_dataloader(config, m, dm, experiment):
     df = m.predict_dataloader(dm.val_dataloader(), experiment = experiment)
     input_data = pd.read_csv("{}/tests/data/processed/test.csv".format(ROOT))    
@@ -93,4 +110,73 @@ def test_predict_crown(config, m, dm):
     label, score = m.predict_crown(geom = gdf.geometry[0], sensor_path = "{}/tests/data/2019_D01_HARV_DP3_726000_4699000_image_crop.tif".format(ROOT))
     
     assert label in dm.species_label_dict.keys()
-    assert score > 0 
\ No newline at end of file
+    assert score > 0 
+
+def test_predict_crowns(config, m, dm):
+    gdf = gpd.read_file("{}/tests/data/crown.shp".format(ROOT))
+    results = m.predict_crowns(gdf, batch_size=2)
+    
+    assert results.shape[0] == gdf.shape[0]
+    assert all([x in dm.species_label_dict.keys() for x in results.pred_taxa])
+    assert all([x in results.columns for x in dm.species_label_dict.keys()])
+    
+    #No crowns
+    results = m.predict_crowns(gdf.iloc[:0])
+    assert results.empty
+    assert "pred_taxa" in results.columns
+
+def test_channels_last(config, dm):
+    channels_last_config = config.copy()
+    channels_last_config["channels_last"] = True
+    model = Hang2020.vanilla_CNN(bands=3, classes=2)
+    m = main.TreeModel(model=model, classes=2, config=channels_last_config, label_dict=dm.species_label_dict)
+    assert m.model.conv1.conv_layer.weight.is_contiguous(memory_format=torch.channels_last)
+    
+    batch = next(iter(dm.val_dataloader()))
+    individual, inputs, y = batch
+    class_probs = m.predict_proba(inputs)
+    assert class_probs.shape == (inputs["HSI"].shape[0], 2)
+    
+def test_autocast(config, dm):
+    bf16_config = config.copy()
+    bf16_config["precision"] = "bf16"
+    model = Hang2020.vanilla_CNN(bands=3, classes=2)
+    m = main.TreeModel(model=model, classes=2, config=bf16_config, label_dict=dm.species_label_dict)
+    batch = next(iter(dm.val_dataloader()))
+    if not main.BF16_SUPPORTED:
+        with pytest.raises(ValueError):
+            m.training_step(batch, 0)
+    else:
+        loss = m.training_step(batch, 0)
+        assert loss.dtype == torch.float32
+
+def test_predict_early_exit(config, dm):
+    early_exit_config = config.copy()
+    early_exit_config["early_exit_thresholds"] = [0.9, 0.9]
+    batch = next(iter(dm.val_dataloader()))
+    individual, inputs, y = batch
+    
+    #The intermediate heads are only trained with deep supervision
+    model = Hang2020.Hang2020(bands=3, classes=2)
+    m = main.TreeModel(model=model, classes=2, config=early_exit_config, label_dict=dm.species_label_dict)
+    m.eval()
+    with pytest.raises(ValueError):
+        m.predict(inputs)
+    
+    model = Hang2020.Hang2020(bands=3, classes=2, deep_supervision=True)
+    m = main.TreeModel(model=model, classes=2, config=early_exit_config, label_dict=dm.species_label_dict)
+    m.eval()
+    with torch.no_grad():
+        assert m.predict(inputs).shape == (inputs["HSI"].shape[0], 2)
+
+def test_stream_predictions(config, m, dm, tmpdir):
+    output = "{}/predictions.parquet".format(tmpdir)
+    crowns = m.stream_predictions(dm.val_dataloader(), output=output, top_k=2, aggregate=True)
+    predictions = pd.read_parquet(output)
+    input_data = pd.read_csv("{}/tests/data/processed/test.csv".format(ROOT))
+    
+    assert predictions.shape[0] == input_data.shape[0]
+    assert all([x in predictions.columns for x in ["individual","crown","pred_taxa_0","score_0","pred_taxa_1","score_1","true_taxa"]])
+    assert crowns.shape[0] == predictions.crown.nunique()
+    assert crowns.votes.sum() == predictions.shape[0]
+    assert all(crowns.score_0 >= crowns.score_1)
@@ -2,6 +2,7 @@
 from src.models import metadata
 from src import data
 import torch
+from torch.nn import functional as F
 import tempfile
 import os
 import pytest
@@ -54,8 +55,67 @@ def test_metadata_sensor_fusion():
     prediction = m(image, sites.int())
     assert prediction.shape == (20,10)
 
+def test_metadata_sensor_fusion_site_table():
+    sites = torch.tensor([0, 2, 1, 2])
+    image = torch.randn(4, 3, 11, 11)
+    m = metadata.metadata_sensor_fusion(bands=3, sites=3, classes=10)
+    m.eval()
+    with torch.no_grad():
+        prediction = m(image, sites.int())
+        assert m.site_table.shape == (3, 10)
+        
+        #The lookup matches the metadata branch
+        expected = m.metadata_model(sites)
+        assert torch.allclose(m.site_table[sites], expected)
+        
+        #The forward pass matches the uncached fusion
+        expected_prediction = F.relu(m.fc1(torch.cat([expected, m.sensor_model(image)], dim=1)))
+        assert torch.allclose(prediction, expected_prediction, atol=1e-6)
+    assert "site_table" not in m.state_dict()
+    
+    #New weights or training clear the table
+    m.load_state_dict(m.state_dict())
+    assert m.site_table is None
+    m(image, sites.int())
+    m.train()
+    assert m.site_table is None
+    
+def test_site_prior():
+    m = metadata.metadata_sensor_fusion(bands=3, sites=3, classes=10)
+    m.eval()
+    prior = m.site_prior([0, 1])
+    assert prior.shape == (2, 10)
+    assert torch.allclose(prior.sum(dim=1), torch.ones(2))
+    
+    #The prior comes from the metadata branch alone
+    with torch.no_grad():
+        expected = F.softmax(m.metadata_model(torch.tensor([0, 1])), dim=1)
+    assert torch.allclose(prior, expected, atol=1e-6)
+
 def test_MetadataModel(config, dm):
     model = metadata.metadata_sensor_fusion(sites=1, classes=2, bands=3)
     m = metadata.MetadataModel(model=model, classes=2, label_dict=dm.species_label_dict, config=config)
     trainer = Trainer(fast_dev_run=True)
     trainer.fit(m,datamodule=dm)    
+    
+def test_MetadataModel_deep_supervision(config, dm):
+    model = metadata.metadata_sensor_fusion(sites=1, classes=2, bands=3, deep_supervision=True)
+    m = metadata.MetadataModel(model=model, classes=2, label_dict=dm.species_label_dict, config=config)
+    images = torch.randn(20, 3, 11, 11)
+    y = torch.randint(0, 2, (20,))
+    model(images, torch.zeros(20).int())
+    assert m.auxiliary_loss(y) > 0
+    
+    trainer = Trainer(fast_dev_run=True)
+    trainer.fit(m,datamodule=dm)
+
+def test_MetadataModel_early_exit(config):
+    #Metadata models cannot exit early, thresholds are not silently ignored
+    early_exit_config = config.copy()
+    early_exit_config["early_exit_thresholds"] = [0.9, 0.9]
+    model = metadata.metadata_sensor_fusion(sites=2, classes=2, bands=3, deep_supervision=True)
+    m = metadata.MetadataModel(model=model, classes=2, label_dict={"ACRU":0,"BELE":1}, config=early_exit_config)
+    m.eval()
+    inputs = {"HSI":torch.randn(4, 3, 11, 11), "site":torch.tensor([0, 1, 0, 1])}
+    with pytest.raises(ValueError):
+        m.predict(inputs)
@@ -0,0 +1,17 @@
+#Test neon_paths
+from src import neon_paths
+import glob
+import os
+
+ROOT = os.path.dirname(os.path.dirname(neon_paths.__file__))
+lookup_pool = glob.glob("{}/tests/data/**/*.tif".format(ROOT), recursive=True)
+bounds = (726100, 4699100, 726110, 4699110)
+
+def test_sensor_index():
+    index = neon_paths.sensor_index(lookup_pool)
+    assert "726000_4699000" in index
+    assert len(index["726000_4699000"]) == len(lookup_pool)
+    
+def test_find_sensor_path_index():
+    index = neon_paths.sensor_index(lookup_pool)
+    assert neon_paths.find_sensor_path(lookup_pool=index, bounds=bounds) == neon_paths.find_sensor_path(lookup_pool=lookup_pool, bounds=bounds)
@@ -25,4 +25,11 @@ def test_crop_hsi(tmpdir):
     gdf = gpd.read_file("{}/tests/data/crown.shp".format(ROOT))
     patch = patches.crop(bounds=gdf.geometry[0].bounds,sensor_path="{}/tests/data/hsi/2019_HARV_6_726000_4699000_image_crop_hyperspectral.tif".format(ROOT), savedir=tmpdir, basename="test")
     img = rasterio.open(patch).read()
-    assert img.shape[0] == 369    
\ No newline at end of file
+    assert img.shape[0] == 369    
+
+def test_open_raster():
+    path = "{}/tests/data/2019_D01_HARV_DP3_726000_4699000_image_crop.tif".format(ROOT)
+    src = patches.open_raster(path)
+    assert patches.open_raster(path) is src
+    patches.close_rasters()
+    assert src.closed
@@ -0,0 +1,85 @@
+#Test tile prediction
+from src import data
+from src import generate
+from src import main
+from src import predict
+from src.models import Hang2020
+import geopandas as gpd
+import pandas as pd
+import os
+import pytest
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(data.__file__))
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+rgb_path = "{}/tests/data/2019_D01_HARV_DP3_726000_4699000_image_crop.tif".format(ROOT)
+
+@pytest.fixture(scope="session")
+def config():
+    config = data.read_config(config_path="{}/config.yml".format(ROOT))
+    config["rgb_sensor_pool"] = "{}/tests/data/*.tif".format(ROOT)
+    config["HSI_sensor_pool"] = "{}/tests/data/*.tif".format(ROOT)
+    config["crop_dir"] = tempfile.gettempdir()
+    config["bands"] = 3
+    config["classes"] = 2
+    config["top_k"] = 1
+    
+    return config
+
+@pytest.fixture(scope="session")
+def m(config):
+    model = Hang2020.vanilla_CNN(bands=3, classes=2)
+    m = main.TreeModel(model=model, classes=2, config=config, label_dict={"ACRU":0,"BELE":1})
+    
+    return m
+
+def test_block_windows():
+    blocks = predict.block_windows(width=1000, height=500, block_size=400, overlap=50)
+    assert len(blocks) == 6
+    
+    #Cores cover the raster without overlap
+    area = sum([(core[2] - core[0]) * (core[3] - core[1]) for window, core in blocks])
+    assert area == 1000 * 500
+    window, core = blocks[0]
+    assert window.width == 450
+
+def test_predict_tile_crowns():
+    deepforest_model = generate.load_deepforest()
+    crowns = predict.predict_tile_crowns(deepforest_model, rgb_path, block_size=200, overlap=50)
+    assert not crowns.empty
+    assert crowns.box_id.is_unique
+    
+def test_classify_crowns(m):
+    gdf = gpd.read_file("{}/tests/data/crown.shp".format(ROOT))
+    results = predict.classify_crowns(m, gdf, sensor_path=rgb_path, batch_size=2)
+    assert results.shape[0] == gdf.shape[0]
+    assert all([x in ["ACRU","BELE"] for x in results.label])
+    assert all(results[["ACRU","BELE"]].sum(axis=1).round(3) == 1)
+
+def test_predict_tile(m, tmpdir):
+    filename = predict.predict_tile(m, rgb_path=rgb_path, HSI_path=rgb_path, savedir=tmpdir, block_size=200, overlap=50)
+    crowns = gpd.read_file(filename)
+    assert not crowns.empty
+    assert "taxonID" in crowns.columns
+
+def test_Predictor(m):
+    df = pd.read_csv("{}/tests/data/sample_neon.csv".format(ROOT))
+    predictor = predict.Predictor(m)
+    coordinates = list(zip(df.itcEasting[:3], df.itcNorthing[:3]))
+    results = predictor.predict_points(coordinates)
+    
+    assert results.shape[0] == 3
+    assert all([x in ["ACRU","BELE"] for x in results.pred_taxa])
+    
+    #Reuse for a second query
+    results = predictor.predict_points(coordinates[:1], fixed_box=False)
+    assert results.shape[0] == 1
+    
+    #A point without a crown has no prediction
+    results = predictor.predict_points([(0, 0)], fixed_box=False)
+    assert results.shape[0] == 1
+    assert results.pred_taxa.isnull().all()
+    
+    #The missing tile is reported rather than a missing crown
+    with pytest.raises(ValueError, match="Cannot find an RGB tile"):
+        m.predict_xy((0, 0), fixed_box=False)
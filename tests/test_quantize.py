@@ -0,0 +1,87 @@
+#Test quantization
+from src import data
+from src import quantize
+from src.models import Hang2020
+from src.models import metadata
+import os
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(data.__file__))
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+@pytest.fixture(scope="session")
+def config():
+    config = data.read_config(config_path="{}/config.yml".format(ROOT))
+    config["bands"] = 3
+    config["classes"] = 2
+    config["top_k"] = 1
+    
+    return config
+
+@pytest.fixture()
+def data_loader():
+    """Batches in the TreeDataset format"""
+    batches = []
+    for x in range(3):
+        inputs = {"HSI":torch.randn(8, 3, 11, 11), "site":torch.randint(0, 2, (8,))}
+        batches.append((["a"] * 8, inputs, torch.randint(0, 2, (8,))))
+    
+    return batches
+
+def test_explicit_padding():
+    m = Hang2020.Hang2020(bands=3, classes=2)
+    m.eval()
+    image = torch.randn(4, 3, 11, 11)
+    with torch.no_grad():
+        expected = m(image)
+        quantize.explicit_padding(m)
+        result = m(image)
+    assert torch.allclose(result, expected, atol=1e-6)
+
+@pytest.mark.parametrize("model",[Hang2020.vanilla_CNN(bands=3, classes=2), Hang2020.Hang2020(bands=3, classes=2), Hang2020.Hang2020(bands=3, classes=2, stem="shared")])
+@pytest.mark.parametrize("mode",["dynamic","static"])
+def test_quantize_model(model, mode, data_loader):
+    quantized = quantize.quantize_model(model, mode=mode, data_loader=data_loader)
+    with torch.no_grad():
+        output = quantized(torch.randn(4, 3, 11, 11))
+    assert output.shape == (4, 2)
+    
+    #The float model is not modified
+    assert all([x.padding == "same" for x in model.modules() if isinstance(x, torch.nn.Conv2d) and x.kernel_size != (1, 1)])
+
+def test_quantize_model_heads(data_loader):
+    #Attention heads stay in float, the engine is restored
+    engine = torch.backends.quantized.engine
+    quantized = quantize.quantize_model(Hang2020.Hang2020(bands=3, classes=2), mode="static", data_loader=data_loader)
+    assert torch.backends.quantized.engine == engine
+    for network in [quantized.spectral_network, quantized.spatial_network]:
+        for name in ["attention_1", "attention_2", "attention_3"]:
+            head = getattr(network, name).fc1
+            assert type(head) is torch.nn.Linear
+            assert head.weight.dtype == torch.float
+
+def test_quantize_static_requires_data():
+    with pytest.raises(ValueError):
+        quantize.quantize_model(Hang2020.vanilla_CNN(bands=3, classes=2), mode="static")
+
+def test_quantize(config, data_loader):
+    model = metadata.metadata_sensor_fusion(bands=3, sites=2, classes=2)
+    m = metadata.MetadataModel(model=model, classes=2, config=config, label_dict={"ACRU":0,"BELE":1})
+    quantized_m = quantize.quantize(m, mode="static", data_loader=data_loader)
+    assert isinstance(quantized_m, metadata.MetadataModel)
+    
+    class_probs = quantized_m.predict_proba(data_loader[0][1])
+    assert class_probs.shape == (8, 2)
+    
+    #int8 predictions agree with the float model on the calibration crops
+    m.eval()
+    with torch.no_grad():
+        for individual, inputs, targets in data_loader:
+            expected = m.predict_proba(inputs)
+            class_probs = quantized_m.predict_proba(inputs)
+            assert torch.mean(torch.abs(class_probs - expected)) < 0.05
+    
+    results = quantize.report(m, quantized_m, data_loader, repeat=1)
+    assert "speedup" in results
+    assert abs(results["accuracy_delta"]) <= 0.25
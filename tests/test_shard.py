@@ -0,0 +1,73 @@
+#Test sharded inference
+from src import data
+from src import main
+from src import shard
+from src.models import Hang2020
+import geopandas as gpd
+import os
+import pytest
+import tempfile
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(data.__file__))
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+rgb_path = "{}/tests/data/2019_D01_HARV_DP3_726000_4699000_image_crop.tif".format(ROOT)
+
+@pytest.fixture(scope="session")
+def config():
+    config = data.read_config(config_path="{}/config.yml".format(ROOT))
+    config["rgb_sensor_pool"] = "{}/tests/data/*.tif".format(ROOT)
+    config["HSI_sensor_pool"] = "{}/tests/data/*.tif".format(ROOT)
+    config["crop_dir"] = tempfile.gettempdir()
+    config["convert_h5"] = False
+    config["bands"] = 3
+    config["classes"] = 2
+    config["top_k"] = 1
+    
+    return config
+
+@pytest.fixture(scope="session")
+def model_path(config):
+    model = Hang2020.vanilla_CNN(bands=3, classes=2)
+    m = main.TreeModel(model=model, classes=2, config=config, label_dict={"ACRU":0,"BELE":1})
+    model_path = "{}/model.pt".format(tempfile.mkdtemp())
+    m.save_model(model_path)
+    
+    return model_path
+
+def test_load_model(model_path):
+    m = main.load_model(model_path)
+    assert m.classes == 2
+    assert m.index_to_label[1] == "BELE"
+    assert not m.training
+
+def test_predict_crowns(model_path):
+    gdf = gpd.read_file("{}/tests/data/crown.shp".format(ROOT))
+    expected = main.load_model(model_path).predict_crowns(gdf)
+    results = shard.predict_crowns(model_path, gdf, workers=2, shards_per_worker=2)
+    
+    assert results.shape[0] == gdf.shape[0]
+    assert all(results.index == gdf.index)
+    assert all(results.pred_taxa == expected.pred_taxa)
+    
+    #No crowns
+    results = shard.predict_crowns(model_path, gdf.iloc[:0], workers=2)
+    assert results.empty
+    assert "pred_taxa" in results.columns
+
+def test_predict_dataloader(config, model_path):
+    csv_file = "{}/tests/data/processed/test.csv".format(ROOT)
+    m = main.load_model(model_path)
+    ds = data.TreeDataset(csv_file=csv_file, config=config)
+    expected = m.predict_dataloader(torch.utils.data.DataLoader(ds, batch_size=config["batch_size"], shuffle=False))
+    results = shard.predict_dataloader(model_path, csv_file, workers=2, shards_per_worker=2)
+    
+    assert results.shape[0] == expected.shape[0]
+    assert all(results.individual == expected.individual)
+    assert all(results.pred_label == expected.pred_label)
+
+def test_predict_tiles(model_path, tmpdir):
+    filenames = shard.predict_tiles(model_path, rgb_paths=[rgb_path], HSI_glob="{}/tests/data/*.tif".format(ROOT), savedir=tmpdir, workers=1, block_size=200, overlap=50)
+    assert len(filenames) == 1
+    crowns = gpd.read_file(filenames[0])
+    assert "taxonID" in crowns.columns
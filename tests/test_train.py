@@ -0,0 +1,36 @@
+#Test training script
+from src import data
+import os
+import subprocess
+import sys
+import tempfile
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(data.__file__))
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+def test_train_ddp_cpu(tmpdir):
+    #Spawned training processes import train.py, only the main guard trains
+    config = data.read_config(config_path="{}/config.yml".format(ROOT))
+    config["rgb_sensor_pool"] = "{}/tests/data/*.tif".format(ROOT)
+    config["HSI_sensor_pool"] = "{}/tests/data/*.tif".format(ROOT)
+    config["crop_dir"] = tempfile.gettempdir()
+    config["bands"] = 3
+    config["convert_h5"] = False
+    config["cluster"] = None
+    config["gpus"] = 0
+    config["workers"] = 0
+    config["accelerator"] = "ddp_cpu"
+    config["num_processes"] = 2
+    config["epochs"] = 1
+    config["fast_dev_run"] = False
+    config_path = "{}/config.yml".format(tmpdir)
+    with open(config_path, "w") as f:
+        yaml.dump(config, f)
+    
+    result = subprocess.run(
+        [sys.executable, "train.py", "--config", config_path, "--data_dir", "{}/tests/data".format(ROOT), "--no_log"],
+        cwd=ROOT, capture_output=True, text=True, timeout=900)
+    
+    assert result.returncode == 0, result.stderr
+    assert "RuntimeError" not in result.stderr
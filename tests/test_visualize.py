@@ -0,0 +1,48 @@
+#Test visualize
+from src import visualize
+import geopandas as gpd
+import numpy as np
+import os
+import pandas as pd
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+
+@pytest.fixture()
+def rgb_pool(tmpdir):
+    """A small synthetic RGB tile named in the NEON schema"""
+    path = "{}/2019_HARV_6_726000_4699000_image.tif".format(tmpdir)
+    image = np.random.randint(0, 255, size=(3, 100, 100)).astype("uint8")
+    transform = from_origin(726000, 4699100, 1, 1)
+    with rasterio.open(path, "w", driver="GTiff", height=100, width=100, count=3, dtype="uint8", crs="EPSG:32618", transform=transform) as dst:
+        dst.write(image)
+
+    return [path]
+
+@pytest.fixture()
+def crowns():
+    points = [Point(726020, 4699020), Point(726050, 4699050), Point(726080, 4699080)]
+    crowns = gpd.GeoDataFrame({"individual":["a","b","c"]}, geometry=[x.buffer(3) for x in points], crs="EPSG:32618")
+    stems = gpd.GeoDataFrame({"individual":["a","b","c"]}, geometry=points, crs="EPSG:32618")
+    
+    return crowns, stems
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_render_predictions(rgb_pool, crowns, tmpdir, workers):
+    crowns, stems = crowns
+    df = pd.DataFrame({"individual":["a","b","c","d"],"true_taxa":["ACRU","BELE","ACRU","BELE"],"pred_taxa":["ACRU","ACRU","ACRU","BELE"]})
+    images = visualize.render_predictions(df, crowns=crowns, points=stems, rgb_pool=rgb_pool, savedir=tmpdir, workers=workers, chunk_size=2)
+    
+    #individual d has no crown
+    assert len(images) == 3
+    for filename, name in images:
+        assert os.path.exists(filename)
+
+def test_render_predictions_backend(rgb_pool, crowns, tmpdir):
+    #Rendering in process keeps the backend of the session
+    crowns, stems = crowns
+    backend = visualize.matplotlib.get_backend()
+    df = pd.DataFrame({"individual":["a"],"true_taxa":["ACRU"],"pred_taxa":["ACRU"]})
+    visualize.render_predictions(df, crowns=crowns, points=stems, rgb_pool=rgb_pool, savedir=tmpdir, workers=0)
+    assert visualize.matplotlib.get_backend() == backend
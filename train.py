@@ -1,69 +1,96 @@
 #Train
 import comet_ml
-from src import main
+import argparse
 from src import data
 from src import start_cluster
+from src.main import build_trainer
 from src.models import metadata
 import torch
-from pytorch_lightning import Trainer
-import os
 import subprocess
 from pytorch_lightning.loggers import CometLogger
 import pandas as pd
 from pandas.util import hash_pandas_object
-import numpy as np
 
-#Create datamodule
-#client = start_cluster.start(cpus=40, mem_size="5GB")
-client = None
-data_module = data.TreeData(csv_file="data/raw/neon_vst_data_2021.csv", regenerate=False, client=client, metadata=True)
-data_module.setup()
-comet_logger = CometLogger(project_name="DeepTreeAttention", workspace=data_module.config["comet_workspace"],auto_output_logging = "simple")
-if client:
-    client.close()
+def main(config_path="config.yml", csv_file="data/raw/neon_vst_data_2021.csv", data_dir=None, log=True):
+    """Train and evaluate a metadata sensor fusion model. Spawned training and dask worker processes import this file, so it runs only from the main guard
+    Args:
+        config_path: path to config.yml
+        csv_file: raw NEON field data, see data.TreeData
+        data_dir: optional data location, see data.TreeData
+        log: log parameters, data and results to comet
+    Returns:
+        m: trained model
+        results: crown predictions of the validation data, None on distributed processes other than global rank zero
+    """
+    #Create datamodule
+    config = data.read_config(config_path)
+    client = start_cluster.start_from_config(config)
+    data_module = data.TreeData(csv_file=csv_file, regenerate=False, client=client, config=config, metadata=True, data_dir=data_dir)
+    data_module.setup()
+    if client:
+        client.close()
 
-comet_logger.experiment.log_parameter("commit hash",subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip())
+    #The data module is copied to each process in distributed training
+    data_module.client = None
 
-#Hash train and test
-train = pd.read_csv("data/processed/train.csv")
-test = pd.read_csv("data/processed/test.csv")
-comet_logger.experiment.log_parameter("train_hash",hash_pandas_object(train))
-comet_logger.experiment.log_parameter("test_hash",hash_pandas_object(test))
-comet_logger.experiment.log_table("train.csv", train)
-comet_logger.experiment.log_table("test.csv", test)
+    #Hash train and test
+    train = pd.read_csv("{}/processed/train.csv".format(data_module.data_dir))
+    test = pd.read_csv("{}/processed/test.csv".format(data_module.data_dir))
+    if log:
+        comet_logger = CometLogger(project_name="DeepTreeAttention", workspace=data_module.config["comet_workspace"],auto_output_logging = "simple")
+        experiment = comet_logger.experiment
+        experiment.log_parameter("commit hash",subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip())
+        experiment.log_parameter("train_hash",hash_pandas_object(train))
+        experiment.log_parameter("test_hash",hash_pandas_object(test))
+        experiment.log_table("train.csv", train)
+        experiment.log_table("test.csv", test)
+    else:
+        comet_logger = None
+        experiment = None
 
-model = metadata.metadata_sensor_fusion(sites=data_module.num_sites, classes=data_module.num_classes, bands=data_module.config["bands"])
-m = metadata.MetadataModel(
-    model=model, 
-    classes=data_module.num_classes, 
-    label_dict=data_module.species_label_dict, 
-    config=data_module.config)
+    model = metadata.metadata_sensor_fusion(sites=data_module.num_sites, classes=data_module.num_classes, bands=data_module.config["bands"], stem=data_module.config["stem"], deep_supervision=data_module.config["deep_supervision"], block=data_module.config["conv_block"])
+    m = metadata.MetadataModel(
+        model=model,
+        classes=data_module.num_classes,
+        label_dict=data_module.species_label_dict,
+        config=data_module.config)
 
-comet_logger.experiment.log_parameters(m.config)
+    if experiment:
+        experiment.log_parameters(m.config)
 
-#Create trainer
-trainer = Trainer(
-    gpus=data_module.config["gpus"],
-    fast_dev_run=data_module.config["fast_dev_run"],
-    max_epochs=data_module.config["epochs"],
-    accelerator=data_module.config["accelerator"],
-    checkpoint_callback=False,
-    logger=comet_logger)
+    #Create trainer
+    trainer = build_trainer(data_module.config, logger=comet_logger)
+    trainer.fit(m, datamodule=data_module)
 
-trainer.fit(m, datamodule=data_module)
-results = m.evaluate_crowns(data_module.val_dataloader(), experiment=comet_logger.experiment)
+    #Evaluate once, other distributed processes stop here
+    if not trainer.is_global_zero:
+        return m, None
 
-#Confusion matrix
-comet_logger.experiment.log_confusion_matrix(
-    test.label.values,
-    predictions,
-    labels=list(data_module.species_label_dict.keys()),
-    max_categories=len(data_module.species_label_dict.keys())
-)  
+    results = m.evaluate_crowns(data_module.val_dataloader(), experiment=experiment)
 
-#Log spectral spatial weight
-alpha_weight = m.model.weighted_average.detach().numpy()
-comet_logger.experiment.log_parameter("spectral_spatial weight", alpha_weight)
+    if experiment:
+        #Confusion matrix
+        experiment.log_confusion_matrix(
+            results.label.values,
+            results.pred_label.values,
+            labels=list(data_module.species_label_dict.keys()),
+            max_categories=len(data_module.species_label_dict.keys())
+        )
 
-#Log prediction
-comet_logger.experiment.log_table("test_predictions.csv", results)
+        #Log spectral spatial weight
+        alpha_weight = torch.sigmoid(m.model.sensor_model.alpha).detach().numpy()
+        experiment.log_parameter("spectral_spatial weight", alpha_weight)
+
+        #Log prediction
+        experiment.log_table("test_predictions.csv", results)
+
+    return m, results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Train a metadata sensor fusion model")
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--data_dir", default=None)
+    parser.add_argument("--no_log", action="store_true", help="Train and evaluate without logging to comet")
+    args, unknown = parser.parse_known_args()
+
+    main(config_path=args.config, data_dir=args.data_dir, log=not args.no_log)